@@ -1,6 +1,7 @@
 """Business logic managers package."""
 from .message_manager import MessageManager
 from .conversation_manager import ConversationManager
+from .attachment_manager import AttachmentManager
+from .avatar_manager import AvatarManager
 
-__all__ = ['MessageManager', 'ConversationManager']
-
+__all__ = ['MessageManager', 'ConversationManager', 'AttachmentManager', 'AvatarManager']
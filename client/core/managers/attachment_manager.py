@@ -0,0 +1,209 @@
+"""Attachment manager for fetching message attachments on demand."""
+import base64
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from ...utils.cache_paths import cache_dir, read_cached, write_cached
+
+
+class AttachmentManager(QObject):
+    """
+    Fetches attachment contents lazily and caches them.
+
+    Messages only carry attachment metadata. Contents are requested with
+    ``get_attachment`` the first time a widget needs them and are kept in a
+    bounded in-memory LRU cache plus an on-disk cache keyed by SHA-256, so
+    each attachment crosses the network at most once per machine.
+
+    Images may also advertise server-side previews (``thumbnail.sizes``).
+    Contents are addressed by *variant*: the preview size in pixels, or 0
+    for the original file.
+    """
+
+    # message_id, variant (preview size, 0 = original), data
+    attachment_ready = pyqtSignal(int, int, bytes)
+    # message_id, error
+    attachment_failed = pyqtSignal(int, str)
+    # message_id, updated attachment metadata
+    attachment_updated = pyqtSignal(int, dict)
+    # message_id, saved path
+    download_finished = pyqtSignal(int, str)
+
+    def __init__(self, client, max_memory_bytes: int = 64 * 1024 * 1024,
+                 disk_cache_dir: Optional[str] = None):
+        """
+        Initialize attachment manager.
+
+        Args:
+            client: SocketClient used to send requests
+            max_memory_bytes: Upper bound for the in-memory cache
+            disk_cache_dir: Directory for cached attachments (default: ~/.chatlan/cache/attachments)
+        """
+        super().__init__()
+        self.client = client
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_cache_dir = disk_cache_dir or cache_dir("attachments")
+        self._memory: "OrderedDict[Tuple[int, int], bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._pending: Set[Tuple[int, int]] = set()
+        self._pending_downloads: Dict[int, str] = {}
+
+    @staticmethod
+    def preview_variant(attachment: Dict, display_size: int) -> int:
+        """
+        Pick the smallest server preview that covers a display size.
+
+        Args:
+            attachment: Attachment metadata from a message dict
+            display_size: Largest side (pixels) the image is shown at
+
+        Returns:
+            Preview size in pixels, or 0 if the original is needed
+        """
+        thumbnail = attachment.get('thumbnail') or {}
+        for size in sorted(thumbnail.get('sizes') or []):
+            if size >= display_size:
+                return size
+        return 0
+
+    def get_cached(self, attachment: Dict, variant: int = 0) -> Optional[bytes]:
+        """
+        Return cached attachment contents without touching the network.
+
+        A cached original is also returned when a preview is asked for.
+
+        Args:
+            attachment: Attachment metadata from a message dict
+            variant: Preview size in pixels, or 0 for the original
+
+        Returns:
+            Attachment bytes, or None if not cached
+        """
+        message_id = attachment.get('id')
+        file_hash = attachment.get('hash')
+        for candidate in ((variant, 0) if variant else (0,)):
+            key = (message_id, candidate)
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+            if file_hash:
+                data = read_cached(self.disk_cache_dir, file_hash, candidate)
+                if data is not None:
+                    self._remember(key, data)
+                    return data
+        return None
+
+    def request(self, attachment: Dict, variant: int = 0) -> Optional[bytes]:
+        """
+        Return attachment contents, fetching them from the server if needed.
+
+        When the contents are not cached, a single ``get_attachment`` request
+        is sent and ``attachment_ready`` is emitted once they arrive.
+
+        Args:
+            attachment: Attachment metadata from a message dict
+            variant: Preview size in pixels, or 0 for the original
+
+        Returns:
+            Attachment bytes if already cached, otherwise None
+        """
+        data = self.get_cached(attachment, variant)
+        if data is not None:
+            return data
+        message_id = attachment.get('id')
+        key = (message_id, variant)
+        if message_id is not None and key not in self._pending:
+            if self.client.get_attachment(message_id, size=variant or None):
+                self._pending.add(key)
+        return None
+
+    def save_to(self, attachment: Dict, save_path: str) -> bool:
+        """
+        Save an attachment to disk.
+
+        Cached contents are written directly; otherwise the file is fetched
+        with the resumable chunked download and ``download_finished`` is
+        emitted when it completes.
+
+        Args:
+            attachment: Attachment metadata from a message dict
+            save_path: Destination path
+
+        Returns:
+            True if the file was written immediately
+        """
+        data = self.get_cached(attachment)
+        if data is not None:
+            with open(save_path, 'wb') as f:
+                f.write(data)
+            return True
+        message_id = attachment.get('id')
+        self._pending_downloads[message_id] = save_path
+        self.client.download_file(message_id, save_path)
+        return False
+
+    def handle_attachment(self, message: Dict):
+        """
+        Handle an ``attachment`` response from the server.
+
+        Args:
+            message: Response dictionary
+        """
+        message_id = message.get('message_id')
+        variant = message.get('size') or 0
+        self._pending.discard((message_id, variant))
+        if not message.get('success'):
+            self._pending = {key for key in self._pending if key[0] != message_id}
+            self.attachment_failed.emit(message_id, message.get('error', 'Unknown error'))
+            return
+        try:
+            data = base64.b64decode(message.get('data') or '')
+        except (ValueError, TypeError) as e:
+            self.attachment_failed.emit(message_id, str(e))
+            return
+        file_hash = (message.get('attachment') or {}).get('hash')
+        if file_hash:
+            write_cached(self.disk_cache_dir, file_hash, data, variant)
+        self._remember((message_id, variant), data)
+        self.attachment_ready.emit(message_id, variant, data)
+
+    def handle_attachment_updated(self, message: Dict):
+        """
+        Handle an ``attachment_updated`` event (e.g. previews became available).
+
+        Args:
+            message: Event dictionary
+        """
+        attachment = message.get('attachment')
+        if attachment:
+            self.attachment_updated.emit(message.get('message_id'), attachment)
+
+    def handle_download(self, message: Dict):
+        """
+        Handle the end of a chunked download started by :meth:`save_to`.
+
+        Args:
+            message: ``download_complete`` or ``download_error`` dictionary
+        """
+        message_id = message.get('message_id')
+        save_path = self._pending_downloads.pop(message_id, None)
+        if save_path is None:
+            return
+        if message.get('success'):
+            self.download_finished.emit(message_id, message.get('save_path') or save_path)
+        else:
+            self.attachment_failed.emit(message_id, message.get('error', 'Unknown error'))
+
+    def _remember(self, key: Tuple[int, int], data: bytes):
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        if len(data) > self.max_memory_bytes:
+            return
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
@@ -0,0 +1,127 @@
+"""Avatar manager for fetching and caching user avatars by hash."""
+import base64
+from typing import Dict, Optional, Set
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtGui import QPixmap
+
+from ...utils.cache_paths import cache_dir, read_cached, write_cached
+
+
+class AvatarManager(QObject):
+    """
+    Resolves user avatars from their ``avatar_hash``.
+
+    User dicts only carry the hash of the current avatar. The image is read
+    from a persistent on-disk cache, or fetched once with ``get_avatar``, and
+    decoded into a QPixmap once per hash; a new hash (the user changed their
+    avatar) is the only thing that triggers another fetch and decode.
+    Avatars are requested as a server-side preview of ``preview_size``
+    pixels when one exists.
+    """
+
+    preview_size = 256
+
+    # user_id, avatar_hash
+    avatar_ready = pyqtSignal(int, str)
+
+    def __init__(self, client, disk_cache_dir: Optional[str] = None):
+        """
+        Initialize avatar manager.
+
+        Args:
+            client: SocketClient used to send requests
+            disk_cache_dir: Directory for cached avatars (default: ~/.chatlan/cache/avatars)
+        """
+        super().__init__()
+        self.client = client
+        self.disk_cache_dir = disk_cache_dir or cache_dir("avatars")
+        # avatar_hash -> decoded pixmap
+        self._pixmaps: Dict[str, QPixmap] = {}
+        # user_id -> avatar_hash currently shown for that user
+        self._user_hashes: Dict[int, str] = {}
+        self._pending: Set[int] = set()
+
+    def get_pixmap(self, user_data: Dict) -> Optional[QPixmap]:
+        """
+        Return the decoded avatar of a user.
+
+        When the avatar is neither decoded nor on disk, a single
+        ``get_avatar`` request is sent and ``avatar_ready`` is emitted once
+        it arrives.
+
+        Args:
+            user_data: User dictionary carrying ``id`` and ``avatar_hash``
+
+        Returns:
+            Avatar pixmap, or None if the user has no avatar or it is not loaded yet
+        """
+        user_id = user_data.get('id')
+        avatar_hash = user_data.get('avatar_hash')
+        if not avatar_hash:
+            return None
+        pixmap = self._pixmaps.get(avatar_hash)
+        if pixmap is None:
+            data = (read_cached(self.disk_cache_dir, avatar_hash, self.preview_size)
+                    or read_cached(self.disk_cache_dir, avatar_hash))
+            if data is not None:
+                pixmap = self._decode(avatar_hash, data)
+        if pixmap is not None:
+            self._set_user_hash(user_id, avatar_hash)
+            return pixmap
+        if user_id is not None and user_id not in self._pending:
+            if self.client.get_avatar(user_id, self._user_hashes.get(user_id), size=self.preview_size):
+                self._pending.add(user_id)
+        return None
+
+    def current_hashes(self) -> Set[str]:
+        """
+        Return the avatar hashes currently in use.
+
+        Returns:
+            Set of the latest known avatar hash of each user
+        """
+        return set(self._user_hashes.values())
+
+    def handle_avatar(self, message: Dict):
+        """
+        Handle an ``avatar`` response from the server.
+
+        Args:
+            message: Response dictionary
+        """
+        user_id = message.get('user_id')
+        self._pending.discard(user_id)
+        avatar_hash = message.get('avatar_hash')
+        if not message.get('success') or not avatar_hash:
+            return
+        if message.get('not_modified'):
+            if avatar_hash not in self._pixmaps:
+                return
+        else:
+            try:
+                data = base64.b64decode(message.get('data') or '')
+            except (ValueError, TypeError):
+                return
+            if not write_cached(self.disk_cache_dir, avatar_hash, data, message.get('size') or 0):
+                return
+            if self._decode(avatar_hash, data) is None:
+                return
+        self._set_user_hash(user_id, avatar_hash)
+        self.avatar_ready.emit(user_id, avatar_hash)
+
+    def _decode(self, avatar_hash: str, data: bytes) -> Optional[QPixmap]:
+        pixmap = QPixmap()
+        if not pixmap.loadFromData(data):
+            return None
+        self._pixmaps[avatar_hash] = pixmap
+        return pixmap
+
+    def _set_user_hash(self, user_id: Optional[int], avatar_hash: str):
+        if user_id is None:
+            return
+        old_hash = self._user_hashes.get(user_id)
+        self._user_hashes[user_id] = avatar_hash
+        # Drop the previous version once no user shows it any more
+        if old_hash and old_hash != avatar_hash and old_hash not in self._user_hashes.values():
+            self._pixmaps.pop(old_hash, None)
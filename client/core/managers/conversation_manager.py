@@ -2,6 +2,7 @@
 from typing import List, Dict, Optional
 from datetime import datetime
 
+from common.text import search_key
 from ..models.conversation import Conversation
 from ..models.user import User
 from ..models.message import Message
@@ -20,6 +21,8 @@ class ConversationManager:
         self.current_user_id = current_user_id
         self.conversations: List[Conversation] = []
         self.contacts: List[User] = []
+        # Accent-folded "display name username" per contact, computed once per update
+        self.contact_search_keys: Dict[int, str] = {}
     
     def update_conversations(self, conversations_data: List[Dict]) -> List[Conversation]:
         """
@@ -104,16 +107,107 @@ class ConversationManager:
             existing.last_message = conv.last_message
             existing.updated_at = conv.updated_at
             existing.unread_count = conv.unread_count
-            return existing
+            conv = existing
         else:
             # Add new conversation
             self.conversations.append(conv)
-            # Re-sort
-            self.conversations.sort(
-                key=lambda c: c.updated_at or datetime.min,
-                reverse=True
-            )
-            return conv
+        # Re-sort
+        self.conversations.sort(
+            key=lambda c: c.updated_at or datetime.min,
+            reverse=True
+        )
+        return conv
+    
+    def apply_conversation_update(self, update: Dict) -> Optional[Conversation]:
+        """
+        Apply a ``conversation_updated`` event (sent with every ``new_message``) in place.
+        
+        Args:
+            update: Event with ``group_id`` or ``other_user_id``, ``last_message_id``,
+                ``last_message_preview``, ``sender_id``, ``updated_at`` and ``unread_delta``
+            
+        Returns:
+            Updated Conversation instance, or None if the conversation is not in the
+            list yet (the full list must then be requested from the server)
+        """
+        if update.get('group_id'):
+            conv = self.get_conversation_by_group_id(update['group_id'])
+        else:
+            conv = self.get_conversation_by_user_id(update.get('other_user_id'))
+        if conv is None:
+            return None
+        
+        message_id = update.get('last_message_id')
+        current_id = conv.last_message.id if conv.last_message else None
+        if not isinstance(current_id, int) or (isinstance(message_id, int) and message_id > current_id):
+            conv.last_message = Message.from_dict({
+                'id': message_id,
+                'sender_id': update.get('sender_id'),
+                'receiver_id': None if update.get('group_id') else (
+                    self.current_user_id if update.get('sender_id') != self.current_user_id
+                    else update.get('other_user_id')),
+                'group_id': update.get('group_id'),
+                'content': update.get('last_message_preview', ''),
+                'message_type': update.get('message_type') or 'text',
+                'timestamp': update.get('updated_at', ''),
+            })
+            conv.updated_at = conv.last_message.timestamp
+        conv.unread_count = max(0, (conv.unread_count or 0) + (update.get('unread_delta') or 0))
+        # Re-sort
+        self.conversations.sort(
+            key=lambda c: c.updated_at or datetime.min,
+            reverse=True
+        )
+        return conv
+    
+    def mark_conversation_read(self, group_id: Optional[int] = None,
+                               other_user_id: Optional[int] = None) -> bool:
+        """
+        Reset the local unread badge of a conversation (e.g. when it is opened).
+        
+        Args:
+            group_id: Group ID for group conversations
+            other_user_id: Other user ID for private conversations
+            
+        Returns:
+            True if the unread count changed, False otherwise
+        """
+        if group_id:
+            conv = self.get_conversation_by_group_id(group_id)
+        else:
+            conv = self.get_conversation_by_user_id(other_user_id)
+        if conv is None or not conv.unread_count:
+            return False
+        conv.unread_count = 0
+        return True
+    
+    def remove_group_conversation(self, group_id: int) -> bool:
+        """
+        Remove a group conversation (e.g. after leaving the group).
+        
+        Args:
+            group_id: Group ID
+            
+        Returns:
+            True if the conversation was removed, False otherwise
+        """
+        original_len = len(self.conversations)
+        self.conversations = [
+            c for c in self.conversations
+            if not (c.is_group and c.group_id == group_id)
+        ]
+        return len(self.conversations) < original_len
+    
+    def last_message_id(self) -> Optional[int]:
+        """
+        Get the newest message ID among the conversation summaries.
+        
+        Returns:
+            Highest ``last_message`` ID, or None if no conversation has messages
+        """
+        ids = [c.last_message.id for c in self.conversations
+               if c.last_message and isinstance(c.last_message.id, int)]
+        return max(ids) if ids else None
     
     def update_contacts(self, online_users_data: List[Dict], 
                        all_users_data: List[Dict]) -> List[User]:
@@ -140,6 +234,9 @@ class ConversationManager:
             user_data['is_online'] = user_id in online_ids
         
         self.contacts = [User.from_dict(user_data) for user_data in all_users_dict.values()]
+        self.contact_search_keys = {
+            contact.id: search_key(f"{contact.display_name} {contact.username}") for contact in self.contacts
+        }
         return self.contacts
     
     def get_contacts(self) -> List[User]:
@@ -151,6 +248,25 @@ class ConversationManager:
         """
         return self.contacts
     
+    def filter_contacts(self, query: str) -> List[User]:
+        """
+        Get contacts whose display name or username contains the query.
+        
+        Matching ignores case and Vietnamese diacritics ("thanh" matches
+        "Thành"), using the same search key as the server's message search.
+        
+        Args:
+            query: Text typed in the contact search box
+            
+        Returns:
+            Matching User instances (all contacts for an empty query)
+        """
+        key = search_key(query)
+        if not key:
+            return self.contacts
+        return [contact for contact in self.contacts
+                if key in self.contact_search_keys.get(contact.id, "")]
+    
     def get_contact_by_id(self, user_id: int) -> Optional[User]:
         """
         Get contact by user ID.
@@ -181,6 +297,26 @@ class ConversationManager:
                 return contact
         return None
     
+    def set_online_users(self, user_ids: List[int]) -> List[User]:
+        """
+        Update the online flag of every contact from a list of online user IDs.
+        
+        Args:
+            user_ids: IDs of the users currently online
+            
+        Returns:
+            Contacts whose online state changed
+        """
+        online = set(user_ids)
+        changed = []
+        for contact in self.contacts:
+            is_online = contact.id in online
+            if contact.is_online != is_online:
+                contact.is_online = is_online
+                contact.status = "online" if is_online else "offline"
+                changed.append(contact)
+        return changed
+    
     def update_user_status(self, user_data: Dict) -> Optional[User]:
         """
         Update user status in contacts.
@@ -205,6 +341,7 @@ class ConversationManager:
             contact.last_seen = updated_user.last_seen
             if updated_user.avatar:
                 contact.avatar = updated_user.avatar
+            contact.avatar_hash = updated_user.avatar_hash
             return contact
         
         return None
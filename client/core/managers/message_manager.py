@@ -1,5 +1,5 @@
 """Message manager for handling message operations."""
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime
 import uuid
 
@@ -19,6 +19,10 @@ class MessageManager:
         """
         self.current_user_id = current_user_id
         self.message_cache: Dict[str, List[Message]] = {}  # Key: conversation_key
+        # Whether the server has older messages than the cached ones
+        self.has_older: Dict[str, bool] = {}
+        # Read position of each group member: {group_id: {user_id: last read message ID}}
+        self.group_read_cursors: Dict[int, Dict[int, int]] = {}
     
     def _get_conversation_key(self, group_id: Optional[int] = None, 
                              other_user_id: Optional[int] = None) -> str:
@@ -96,6 +100,128 @@ class MessageManager:
         
         return unique_messages
     
+    def merge_messages(self, messages_data: List[Dict],
+                      group_id: Optional[int] = None,
+                      other_user_id: Optional[int] = None) -> List[Message]:
+        """
+        Merge a history page (e.g. older messages) into the cached messages.
+        
+        Args:
+            messages_data: List of message dictionaries
+            group_id: Group ID if group conversation
+            other_user_id: Other user ID if private conversation
+            
+        Returns:
+            All cached Message instances of the conversation
+        """
+        key = self._get_conversation_key(group_id, other_user_id)
+        cached = self.message_cache.setdefault(key, [])
+        seen_ids = {m.id for m in cached}
+        for msg in messages_data:
+            message = Message.from_dict(msg)
+            if message.id not in seen_ids:
+                seen_ids.add(message.id)
+                cached.append(message)
+        cached.sort(key=lambda m: m.timestamp)
+        return cached
+    
+    def set_has_older(self, has_older: bool,
+                      group_id: Optional[int] = None,
+                      other_user_id: Optional[int] = None):
+        """
+        Record whether the server has messages older than the cached ones.
+        
+        Args:
+            has_older: ``has_more`` flag of the latest history page
+            group_id: Group ID if group conversation
+            other_user_id: Other user ID if private conversation
+        """
+        self.has_older[self._get_conversation_key(group_id, other_user_id)] = has_older
+    
+    def oldest_message_id(self, group_id: Optional[int] = None,
+                          other_user_id: Optional[int] = None) -> Optional[int]:
+        """
+        Get the cursor for loading the previous history page.
+        
+        Args:
+            group_id: Group ID if group conversation
+            other_user_id: Other user ID if private conversation
+            
+        Returns:
+            ID of the oldest cached message, or None if there is nothing older to load
+        """
+        key = self._get_conversation_key(group_id, other_user_id)
+        ids = [m.id for m in self.message_cache.get(key, []) if m.id is not None]
+        if not ids or not self.has_older.get(key):
+            return None
+        return min(ids)
+    
+    def has_history(self, group_id: Optional[int] = None,
+                    other_user_id: Optional[int] = None) -> bool:
+        """
+        Check whether the conversation's history has been loaded and kept up to date.
+        
+        Args:
+            group_id: Group ID if group conversation
+            other_user_id: Other user ID if private conversation
+            
+        Returns:
+            True if the cached messages can be shown without asking the server
+        """
+        return self._get_conversation_key(group_id, other_user_id) in self.has_older
+    
+    def newest_message_id(self, group_id: Optional[int] = None,
+                          other_user_id: Optional[int] = None) -> Optional[int]:
+        """
+        Get the ID of the newest cached message of a conversation.
+        
+        Args:
+            group_id: Group ID if group conversation
+            other_user_id: Other user ID if private conversation
+            
+        Returns:
+            ID of the newest cached message, or None if nothing is cached
+        """
+        key = self._get_conversation_key(group_id, other_user_id)
+        ids = [m.id for m in self.message_cache.get(key, []) if isinstance(m.id, int)]
+        return max(ids) if ids else None
+    
+    def sync_marks(self) -> Dict[str, int]:
+        """
+        Get the high-water marks sent with a ``sync`` request after reconnecting.
+        
+        Returns:
+            ``{"group:<id>" | "user:<other user id>": newest cached message ID}``
+            for every conversation whose history has been loaded
+        """
+        marks = {}
+        for key in self.has_older:
+            kind, _, rest = key.partition('_')
+            if kind == 'group':
+                group_id, other_user_id = int(rest), None
+            else:
+                low, high = (int(part) for part in rest.split('_'))
+                group_id, other_user_id = None, (high if low == self.current_user_id else low)
+            sync_key = f"group:{group_id}" if group_id else f"user:{other_user_id}"
+            marks[sync_key] = self.newest_message_id(group_id, other_user_id) or 0
+        return marks
+    
+    @staticmethod
+    def parse_sync_key(sync_key: str) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Split a conversation key of a ``sync`` response.
+        
+        Args:
+            sync_key: ``"group:<id>"`` or ``"user:<other user id>"``
+            
+        Returns:
+            ``(group_id, other_user_id)`` with one of them set
+        """
+        kind, _, target = sync_key.partition(':')
+        if kind == 'group':
+            return int(target), None
+        return None, int(target)
+    
     def get_messages(self, group_id: Optional[int] = None,
                     other_user_id: Optional[int] = None) -> List[Message]:
         """
@@ -134,6 +260,47 @@ class MessageManager:
             return len(self.message_cache[key]) < original_len
         return False
     
+    def remove_messages(self, message_ids: List[int]) -> int:
+        """
+        Remove messages by ID from every cached conversation.
+        
+        Args:
+            message_ids: IDs of deleted messages
+            
+        Returns:
+            Number of messages removed
+        """
+        ids = set(message_ids)
+        removed = 0
+        for key, messages in self.message_cache.items():
+            kept = [m for m in messages if m.id not in ids]
+            removed += len(messages) - len(kept)
+            self.message_cache[key] = kept
+        return removed
+    
+    def clear_all(self):
+        """Drop every cached conversation (e.g. after a full snapshot from the server)."""
+        self.message_cache.clear()
+        self.has_older.clear()
+    
+    def update_attachment(self, message_id: int, attachment: Dict) -> bool:
+        """
+        Replace the attachment metadata of a cached message.
+        
+        Args:
+            message_id: ID of the message
+            attachment: New attachment metadata
+            
+        Returns:
+            True if the message was found, False otherwise
+        """
+        for messages in self.message_cache.values():
+            for message in messages:
+                if message.id == message_id:
+                    message.attachment = attachment
+                    return True
+        return False
+    
     def clear_conversation(self, group_id: Optional[int] = None,
                           other_user_id: Optional[int] = None):
         """
@@ -146,6 +313,7 @@ class MessageManager:
         key = self._get_conversation_key(group_id, other_user_id)
         if key in self.message_cache:
             del self.message_cache[key]
+        self.has_older.pop(key, None)
     
     def generate_client_message_id(self) -> str:
         """
@@ -156,6 +324,34 @@ class MessageManager:
         """
         return str(uuid.uuid4())
     
+    def apply_read_receipt(self, reader_id: int, last_read_message_id: int,
+                           group_id: Optional[int] = None,
+                           other_user_id: Optional[int] = None) -> bool:
+        """
+        Apply a ``read_receipt`` from another participant.
+        
+        Args:
+            reader_id: ID of the user who read the conversation
+            last_read_message_id: Every message up to this ID has been read
+            group_id: Group ID if group conversation
+            other_user_id: Other user ID if private conversation
+            
+        Returns:
+            True if a cached message of the current user changed to read
+        """
+        if group_id:
+            cursors = self.group_read_cursors.setdefault(group_id, {})
+            cursors[reader_id] = max(cursors.get(reader_id, 0), last_read_message_id)
+            return False
+        changed = False
+        key = self._get_conversation_key(group_id, other_user_id)
+        for message in self.message_cache.get(key, []):
+            if (isinstance(message.id, int) and message.id <= last_read_message_id
+                    and message.sender_id == self.current_user_id and not message.is_read):
+                message.is_read = True
+                changed = True
+        return changed
+    
     def mark_as_read(self, message_id: int,
                     group_id: Optional[int] = None,
                     other_user_id: Optional[int] = None) -> bool:
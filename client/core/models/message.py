@@ -18,6 +18,7 @@ class Message:
     file_name: Optional[str] = None
     file_data: Optional[bytes] = None
     file_size: Optional[int] = None
+    attachment: Optional[Dict] = None  # Metadata only; contents fetched on demand
     is_read: bool = False
     is_edited: bool = False
     reply_to_id: Optional[int] = None
@@ -69,6 +70,7 @@ class Message:
             file_name=data.get('file_name'),
             file_data=file_data,
             file_size=data.get('file_size'),
+            attachment=data.get('attachment'),
             is_read=data.get('is_read', False),
             is_edited=data.get('is_edited', False),
             reply_to_id=data.get('reply_to_id'),
@@ -103,6 +105,8 @@ class Message:
             result['file_data'] = base64.b64encode(self.file_data).decode()
         if self.file_size:
             result['file_size'] = self.file_size
+        if self.attachment:
+            result['attachment'] = self.attachment
         if self.reply_to_id:
             result['reply_to_id'] = self.reply_to_id
         if self.client_message_id:
@@ -13,6 +13,7 @@ class User:
     display_name: str
     email: Optional[str] = None
     avatar: Optional[bytes] = None
+    avatar_hash: Optional[str] = None  # Avatar contents are fetched by hash on demand
     status: str = "offline"
     status_message: Optional[str] = None
     is_online: bool = False
@@ -68,6 +69,7 @@ class User:
             display_name=data.get('display_name', data.get('username', '')),
             email=data.get('email'),
             avatar=avatar,
+            avatar_hash=data.get('avatar_hash'),
             status=data.get('status', 'offline'),
             status_message=data.get('status_message'),
             is_online=data.get('is_online', False),
@@ -95,6 +97,8 @@ class User:
         if self.avatar:
             import base64
             result['avatar'] = base64.b64encode(self.avatar).decode()
+        if self.avatar_hash:
+            result['avatar_hash'] = self.avatar_hash
         if self.status_message:
             result['status_message'] = self.status_message
         if self.last_seen:
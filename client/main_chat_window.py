@@ -21,14 +21,14 @@ from PyQt5.QtGui import (QFont, QPixmap, QPainter, QColor, QBrush, QIcon,
                         QTextCursor, QTextCharFormat, QKeySequence, QCursor, QFontMetrics)
 
 from .socket_client import SocketClient
-from .ui.widgets import ChatBubble
+from .ui.widgets import AttachmentImageLabel, ChatBubble
 from .ui.dialogs import (
     CreateGroupDialog, MediaViewerDialog, SearchResultDialog,
     UserProfileDialog, EmojiPicker
 )
 from .ui.components import Sidebar, ChatArea, InfoSidebar
 from .core.models import Message, User, Conversation
-from .core.managers import MessageManager, ConversationManager
+from .core.managers import AttachmentManager, AvatarManager, MessageManager, ConversationManager
 from .utils import resource_path
 import client.resources_rc
 
@@ -51,11 +51,19 @@ class MainChatWindow(QMainWindow):
         self.current_chat_user = None
         self.current_chat_type = None   # "group" or "private"
         self.current_group_id = None     # Initialize group_id
+        # Đang chờ trang lịch sử cũ hơn (tránh gửi trùng khi cuộn lên đầu)
+        self.loading_older_messages = False
+        # Dialog kết quả tìm kiếm đang mở (nhận thêm trang khi bấm "Tải thêm")
+        self.search_dialog = None
+        # Mốc thay đổi cho gói tin sync khi kết nối lại (server gửi lúc đăng nhập)
+        self.sync_change_id = user_data.get('change_id')
         
         # Initialize managers
         try:
             self.message_manager = MessageManager(self.user_data['user']['id'])
             self.conversation_manager = ConversationManager(self.user_data['user']['id'])
+            self.attachment_manager = AttachmentManager(self.client)
+            self.avatar_manager = AvatarManager(self.client)
         except Exception as e:
             raise ValueError(f"Không thể khởi tạo managers: {str(e)}")
         
@@ -63,6 +71,8 @@ class MainChatWindow(QMainWindow):
         self.message_cache = {}  # Will be replaced by MessageManager
         self.conversations = []  # Will be replaced by ConversationManager
         self.contacts = []
+        # Avatar hình tròn đã vẽ: {(avatar_hash, size): QPixmap}
+        self._avatar_pixmaps = {}
         
         self.typing_timer = QTimer()
         self.typing_timer.timeout.connect(self.stop_typing)
@@ -142,7 +152,8 @@ class MainChatWindow(QMainWindow):
         """Hiển thị dialog thông tin của một người dùng."""
         if not user_data:
             return
-        dialog = UserProfileDialog(user_data, self)
+        avatar_pixmap = self.avatar_manager.get_pixmap(user_data)
+        dialog = UserProfileDialog(user_data, self, avatar_pixmap=avatar_pixmap)
         dialog.exec_()
 
 
@@ -175,6 +186,7 @@ class MainChatWindow(QMainWindow):
 
     def clear_chat_display(self):
         """Xóa sạch tất cả các bubble tin nhắn trên màn hình."""
+        self.loading_older_messages = False
         self.chat_area.clear_messages()
 
 
@@ -203,8 +215,10 @@ class MainChatWindow(QMainWindow):
     def setup_client_connections(self):
         """Kết nối signals từ socket client"""
         self.client.message_received.connect(self.on_message_received)
+        self.client.connected.connect(self.on_reconnected)
         self.client.disconnected.connect(self.on_disconnected)
         self.client.error_occurred.connect(self.on_error_occurred)
+        self.avatar_manager.avatar_ready.connect(self.on_avatar_ready)
     
     def init_ui(self):
         print("Initializing UI")
@@ -263,13 +277,14 @@ class MainChatWindow(QMainWindow):
         self.chat_area.search_clicked.connect(self.show_search_dialog)
         self.chat_area.clear_chat_clicked.connect(self.clear_current_chat)
         self.chat_area.info_sidebar_toggled.connect(self.toggle_info_sidebar)
+        self.chat_area.load_older_requested.connect(self.load_older_messages)
         # Set input handlers
         self.chat_area.set_message_input_handler(self.on_message_input_changed)
         self.chat_area.set_message_input_event_filter(self)
         self.main_splitter.addWidget(self.chat_area)
         
         # Phần 3: Sidebar phải (thông tin hội thoại) - Sử dụng Component mới
-        self.info_sidebar = InfoSidebar(self)
+        self.info_sidebar = InfoSidebar(self, attachment_manager=self.attachment_manager)
         # Connect signals
         self.info_sidebar.add_member_clicked.connect(self.show_add_member_dialog)
         self.info_sidebar.remove_member_clicked.connect(self.remove_member)
@@ -583,11 +598,9 @@ class MainChatWindow(QMainWindow):
             for i, msg in enumerate(messages[:6]):
                 row, col = divmod(i, num_columns)
                 try:
-                    pixmap = QPixmap()
-                    pixmap.loadFromData(base64.b64decode(msg['file_data']))
-                    img_label = QLabel()
-                    img_label.setPixmap(pixmap.scaled(85, 85, Qt.KeepAspectRatioByExpanding, Qt.SmoothTransformation))
-                    img_label.setFixedSize(85, 85)
+                    img_label = AttachmentImageLabel(msg, self.attachment_manager, size=85,
+                                                     aspect_mode=Qt.KeepAspectRatioByExpanding,
+                                                     fixed_size=True)
                     img_label.setStyleSheet("border-radius: 8px;")
                     layout.addWidget(img_label, row, col)
                 except Exception as e:
@@ -610,7 +623,8 @@ class MainChatWindow(QMainWindow):
 
     def show_media_viewer(self, title, messages, media_type):
         """Mở dialog để xem toàn bộ media/file."""
-        dialog = MediaViewerDialog(title, messages, media_type, self)
+        dialog = MediaViewerDialog(title, messages, media_type, self,
+                                   attachment_manager=self.attachment_manager)
         dialog.exec_()
 
     # >>> THAY THẾ HÀM create_media_box <<<
@@ -630,11 +644,7 @@ class MainChatWindow(QMainWindow):
             for i, msg in enumerate(messages[:6]):
                 row, col = divmod(i, num_columns)
                 try:
-                    pixmap = QPixmap()
-                    pixmap.loadFromData(base64.b64decode(msg['file_data']))
-                    img_label = QLabel()
-                    img_label.setPixmap(pixmap.scaled(80, 80, Qt.KeepAspectRatio, Qt.SmoothTransformation))
-                    img_label.setFixedSize(80, 80)
+                    img_label = AttachmentImageLabel(msg, self.attachment_manager, size=80, fixed_size=True)
                     img_label.setStyleSheet("border: 1px solid #ddd; border-radius: 8px;")
                     content_layout.addWidget(img_label, row, col)
                 except Exception as e:
@@ -926,18 +936,37 @@ class MainChatWindow(QMainWindow):
         """)
     
     def create_user_avatar_pixmap(self, user_data, size=50):
-        """Tạo avatar pixmap từ user_data"""
-        avatar_data = user_data.get('avatar')
-        if avatar_data:
-            try:
-                image_data = base64.b64decode(avatar_data)
-                pixmap = QPixmap()
-                pixmap.loadFromData(image_data)
-                return self.create_circular_avatar(pixmap, size)
-            except:
-                return self.create_default_avatar_pixmap(user_data, size)
-        else:
+        """
+        Tạo avatar pixmap từ user_data.
+
+        user_data chỉ mang avatar_hash; ảnh được AvatarManager đọc từ cache hoặc
+        tải về, và avatar hình tròn được vẽ một lần cho mỗi (hash, kích thước).
+        """
+        avatar_hash = user_data.get('avatar_hash')
+        if not avatar_hash:
             return self.create_default_avatar_pixmap(user_data, size)
+        key = (avatar_hash, size)
+        if key not in self._avatar_pixmaps:
+            pixmap = self.avatar_manager.get_pixmap(user_data)
+            if pixmap is None:
+                # Chưa tải xong: hiện avatar mặc định, on_avatar_ready sẽ vẽ lại
+                return self.create_default_avatar_pixmap(user_data, size)
+            self._avatar_pixmaps[key] = self.create_circular_avatar(pixmap, size)
+        return self._avatar_pixmaps[key]
+
+    @pyqtSlot(int, str)
+    def on_avatar_ready(self, user_id, avatar_hash):
+        """Vẽ lại avatar khi AvatarManager tải xong một phiên bản mới."""
+        # Bỏ các bản đã vẽ của phiên bản cũ
+        current = self.avatar_manager.current_hashes()
+        self._avatar_pixmaps = {
+            key: pixmap for key, pixmap in self._avatar_pixmaps.items()
+            if key[0] in current
+        }
+        user = self.user_data.get('user', {})
+        if user.get('id') == user_id:
+            user['avatar_hash'] = avatar_hash
+            self.sidebar.set_user_avatar(self.create_user_avatar_pixmap(user))
     
     def create_default_avatar_pixmap(self, user_data, size):
         """Tạo avatar mặc định"""
@@ -1023,12 +1052,21 @@ class MainChatWindow(QMainWindow):
                 self.update_conversations(message.get('conversations', []))
             
             elif message_type == 'get_messages':
-                self.update_messages(message.get('messages', []))
+                self.update_messages(message.get('messages', []), page=message)
+            
+            elif message_type == 'sync':
+                self.apply_sync(message)
+            
+            elif message_type == 'read_receipt':
+                self.apply_read_receipt(message)
             
             elif message_type == 'new_message':
                 print(f"DEBUG: Received new_message from server: {message.get('message')}")
                 self.add_new_message(message.get('message'))
 
+            elif message_type == 'conversation_updated':
+                self.apply_conversation_update(message)
+
             elif message_type == 'user_status':
                 self.update_user_status_display(message.get('user'))
             
@@ -1041,8 +1079,17 @@ class MainChatWindow(QMainWindow):
             elif message_type == 'search_results':
                 query = message.get('query', '')
                 results = message.get('messages', [])
-                search_dialog = SearchResultDialog(query, results, self)
-                search_dialog.exec_()
+                if message.get('cursor'):
+                    # Trang tiếp theo của dialog đang mở
+                    if self.search_dialog and self.search_dialog.query == query:
+                        self.search_dialog.append_results(results, message.get('next_cursor'))
+                else:
+                    self.search_dialog = SearchResultDialog(query, results, self,
+                                                            next_cursor=message.get('next_cursor'))
+                    self.search_dialog.load_more_requested.connect(
+                        lambda q, cursor: self.client.search_messages(q, cursor=cursor))
+                    self.search_dialog.exec_()
+                    self.search_dialog = None
             elif message_type == 'group_members_list':
                 # Cập nhật sidebar với danh sách thành viên mới
                 if message.get('group_id') == self.current_group_id and self.info_sidebar.isVisible():
@@ -1060,6 +1107,17 @@ class MainChatWindow(QMainWindow):
                 if self.current_group_id == group_id:
                     self.show_welcome_screen()
                 QMessageBox.information(self, "Thông báo", "Bạn đã bị xóa khỏi một nhóm.")
+            elif message_type == 'attachment':
+                self.attachment_manager.handle_attachment(message)
+            elif message_type == 'download_complete':
+                self.attachment_manager.handle_download(message)
+            elif message_type == 'avatar':
+                self.avatar_manager.handle_avatar(message)
+            elif message_type == 'attachment_updated':
+                self.message_manager.update_attachment(message.get('message_id'), message.get('attachment'))
+                self.attachment_manager.handle_attachment_updated(message)
+            elif message_type == 'upload_complete':
+                self.status_bar.showMessage("Đã gửi file", 3000)
             elif message_type == 'add_member_response' or message_type == 'remove_member_response':
                 self.status_bar.showMessage(message.get('message', 'Thao tác hoàn tất.'), 3000)
             # Xử lý khi có thông báo về nhóm mới
@@ -1082,7 +1140,25 @@ class MainChatWindow(QMainWindow):
 
         else: # Xử lý lỗi
             error_msg = message.get('error', 'Unknown error')
-            if message_type == 'create_group':
+            if message_type == 'attachment':
+                self.attachment_manager.handle_attachment(message)
+            elif message_type == 'avatar':
+                self.avatar_manager.handle_avatar(message)
+            elif message_type in ('download_complete', 'download_error'):
+                self.attachment_manager.handle_download(message)
+            elif message_type == 'search_results':
+                if self.search_dialog:
+                    self.search_dialog.update_status()
+                self.status_bar.showMessage(f"Lỗi: {error_msg}", 5000)
+            elif message_type == 'get_messages':
+                self.loading_older_messages = False
+                self.status_bar.showMessage(f"Lỗi: {error_msg}", 5000)
+            elif message_type == 'sync':
+                # Không đồng bộ được phần chênh lệch: tải lại như trước
+                self.message_manager.clear_all()
+                self.refresh_data()
+                self._reopen_current_chat()
+            elif message_type == 'create_group':
                  QMessageBox.critical(self, "Lỗi tạo nhóm", f"Không thể tạo nhóm:\n{error_msg}")
             else:
                 self.status_bar.showMessage(f"Lỗi: {error_msg}", 5000)
@@ -1103,6 +1179,97 @@ class MainChatWindow(QMainWindow):
             if hasattr(self.chat_area, 'file_btn'):
                 self.chat_area.file_btn.setEnabled(False)
     
+    @pyqtSlot()
+    def on_reconnected(self):
+        """Kết nối lại thành công: bật lại ô nhập và chỉ xin phần bị bỏ lỡ (sync)."""
+        self.connection_label.setText("🟢 Đã kết nối")
+        self.connection_label.setStyleSheet("color: #28a745; font-weight: bold;")
+        if hasattr(self, 'chat_area') and self.chat_area:
+            if hasattr(self.chat_area, 'message_input'):
+                self.chat_area.message_input.setEnabled(True)
+            if hasattr(self.chat_area, 'file_btn'):
+                self.chat_area.file_btn.setEnabled(True)
+            self.chat_area.set_send_button_enabled(bool(self.chat_area.get_message_text().strip()))
+        marks = self.message_manager.sync_marks()
+        last_ids = [message_id for message_id in (self.conversation_manager.last_message_id(), *marks.values())
+                    if message_id]
+        self.client.sync(marks, self.sync_change_id, max(last_ids) if last_ids else None)
+    
+    def apply_sync(self, delta: Dict):
+        """
+        Áp dụng phản hồi sync: gộp tin nhắn còn thiếu, bỏ tin đã bị xóa và cập
+        nhật các hội thoại thay đổi. Server gửi ``snapshot`` khi khoảng chênh
+        lệch quá lớn: tải lại toàn bộ như lúc đăng nhập.
+        """
+        self.sync_change_id = delta.get('change_id', self.sync_change_id)
+        if delta.get('snapshot'):
+            self.message_manager.clear_all()
+            self.update_contacts([], delta.get('all_users', []))
+            self.conversation_manager.set_online_users(delta.get('online_user_ids', []))
+            self.update_conversations(delta.get('conversations', []))
+            self._reopen_current_chat()
+            return
+        
+        for key in delta.get('cleared', []):
+            group_id, other_user_id = MessageManager.parse_sync_key(key)
+            self.message_manager.update_messages([], group_id=group_id, other_user_id=other_user_id)
+            self.message_manager.set_has_older(False, group_id=group_id, other_user_id=other_user_id)
+        for message_ids in delta.get('deleted', {}).values():
+            self.message_manager.remove_messages(message_ids)
+        for key, page in delta.get('messages', {}).items():
+            group_id, other_user_id = MessageManager.parse_sync_key(key)
+            if page.get('reset'):
+                # Thiếu quá nhiều tin: thay bằng trang mới nhất, tin cũ hơn tải khi cuộn lên
+                self.message_manager.update_messages(page.get('messages', []), group_id=group_id,
+                                                     other_user_id=other_user_id)
+                self.message_manager.set_has_older(page.get('has_more', False), group_id=group_id,
+                                                   other_user_id=other_user_id)
+            else:
+                self.message_manager.merge_messages(page.get('messages', []), group_id=group_id,
+                                                    other_user_id=other_user_id)
+        
+        for group_id in delta.get('left_groups', []):
+            self.conversation_manager.remove_group_conversation(group_id)
+            self.message_manager.clear_conversation(group_id=group_id)
+        for conversation in delta.get('conversations', []):
+            self.conversation_manager.add_or_update_conversation(conversation)
+        self.refresh_conversations_list()
+        if self.conversation_manager.set_online_users(delta.get('online_user_ids', [])):
+            self.refresh_contacts_list()
+        
+        if self.current_chat_type == "group" and self.current_group_id in delta.get('left_groups', []):
+            self.show_welcome_screen()
+        elif self.current_chat_type:
+            group_id = self.current_group_id if self.current_chat_type == "group" else None
+            other_user_id = self.current_chat_user['id'] if self.current_chat_type == "private" and self.current_chat_user else None
+            self.message_count_label.setText(
+                f"{len(self.message_manager.get_messages(group_id=group_id, other_user_id=other_user_id))} tin nhắn")
+            self.refresh_messages_display()
+            if other_user_id and f"user:{other_user_id}" in delta.get('messages', {}):
+                self.client.mark_messages_read(self.current_chat_user['username'])
+    
+    def apply_read_receipt(self, receipt: Dict):
+        """Người khác đã đọc đến một tin nhắn: cập nhật trạng thái đã đọc của tin mình gửi."""
+        group_id = receipt.get('group_id')
+        other_user_id = receipt.get('other_user_id')
+        changed = self.message_manager.apply_read_receipt(
+            receipt.get('reader_id'), receipt.get('last_read_message_id', 0),
+            group_id=group_id, other_user_id=other_user_id)
+        if changed and self.current_chat_type == "private" and self.current_chat_user \
+                and self.current_chat_user.get('id') == other_user_id:
+            self.refresh_messages_display(keep_distance=self.chat_area.distance_from_bottom())
+    
+    def _reopen_current_chat(self):
+        """Mở lại hội thoại đang xem (tải lại lịch sử nếu cache đã bị xóa)."""
+        if self.current_chat_type == "private" and self.current_chat_user:
+            self.start_private_chat(self.current_chat_user)
+        elif self.current_chat_type == "group" and self.current_group_id:
+            conversation = self.conversation_manager.get_conversation_by_group_id(self.current_group_id)
+            if conversation:
+                self.start_group_chat(conversation.group_id, conversation.display_name)
+            else:
+                self.show_welcome_screen()
+    
     @pyqtSlot(str)
     def on_error_occurred(self, error_message):
         """Xử lý lỗi"""
@@ -1111,17 +1278,21 @@ class MainChatWindow(QMainWindow):
     def update_contacts(self, online_users, all_users):
         """Cập nhật danh sách liên hệ"""
         # Update ConversationManager
-        contacts = self.conversation_manager.update_contacts(online_users, all_users)
-        # Update Sidebar component
-        contacts_dict = [c.to_dict() if hasattr(c, 'to_dict') else c.__dict__ for c in contacts]
-        self.sidebar.update_contacts(contacts_dict)
+        self.conversation_manager.update_contacts(online_users, all_users)
+        self.refresh_contacts_list()
     
     def refresh_contacts_list(self):
-        """Làm mới danh sách liên hệ"""
-        # This is now handled by Sidebar component
-        contacts = self.conversation_manager.get_contacts()
+        """Làm mới danh sách liên hệ (chỉ các liên hệ khớp ô tìm kiếm)."""
+        contacts = self.conversation_manager.filter_contacts(self.sidebar.contact_search.text())
         contacts_dict = [c.to_dict() if hasattr(c, 'to_dict') else c.__dict__ for c in contacts]
         self.sidebar.update_contacts(contacts_dict)
+        for contact in contacts_dict:
+            item = QListWidgetItem()
+            contact_widget = self.create_contact_widget(contact)
+            item.setSizeHint(contact_widget.sizeHint())
+            item.contact_data = contact
+            self.sidebar.contacts_list.addItem(item)
+            self.sidebar.contacts_list.setItemWidget(item, contact_widget)
     
     # >>> THAY THẾ HÀM create_contact_widget <<<
     def create_contact_widget(self, contact):
@@ -1467,27 +1638,71 @@ class MainChatWindow(QMainWindow):
         
         return widget
     
-    def update_messages(self, messages: List[Dict]):
-        """Cập nhật tin nhắn vào cache và hiển thị."""
+    def update_messages(self, messages: List[Dict], page: Optional[Dict] = None):
+        """
+        Cập nhật tin nhắn vào cache và hiển thị.
+
+        ``page`` là phản hồi get_messages: trang có ``before_id`` (cuộn lên xem
+        tin cũ) được gộp vào cache và giữ nguyên vị trí đang xem, trang khác
+        thay thế cache của hội thoại.
+        """
+        page = page or {}
         group_id = self.current_group_id if self.current_chat_type == "group" else None
         other_user_id = self.current_chat_user['id'] if self.current_chat_type == "private" and self.current_chat_user else None
         
         if not group_id and not other_user_id:
             return
+        # Bỏ qua trang của hội thoại khác (người dùng đã chuyển chat trước khi server trả lời)
+        if page.get('group_id') and page.get('group_id') != group_id:
+            return
+        if page.get('other_user') and (group_id or self.current_chat_user.get('username') != page.get('other_user')):
+            return
 
         print(f"Updating messages. Received {len(messages)} messages.")
         
         # Lưu vào MessageManager
-        self.message_manager.update_messages(messages, group_id=group_id, other_user_id=other_user_id)
+        is_older_page = page.get('before_id') is not None
+        if is_older_page:
+            self.loading_older_messages = False
+            cached = self.message_manager.merge_messages(messages, group_id=group_id, other_user_id=other_user_id)
+        else:
+            cached = self.message_manager.update_messages(messages, group_id=group_id, other_user_id=other_user_id)
+        self.message_manager.set_has_older(page.get('has_more_before', page.get('has_more', False)),
+                                           group_id=group_id, other_user_id=other_user_id)
         
         # Cập nhật số lượng tin nhắn hiển thị
-        self.message_count_label.setText(f"{len(messages)} tin nhắn")
+        self.message_count_label.setText(f"{len(cached)} tin nhắn")
         
         # Vẽ lại màn hình chat
-        self.refresh_messages_display() 
+        if is_older_page:
+            self.refresh_messages_display(keep_distance=self.chat_area.distance_from_bottom())
+        else:
+            self.refresh_messages_display()
+
+    def load_older_messages(self):
+        """Tải trang tin nhắn cũ hơn khi người dùng cuộn lên đầu lịch sử chat."""
+        if self.loading_older_messages:
+            return
+        group_id = self.current_group_id if self.current_chat_type == "group" else None
+        other_user_id = self.current_chat_user['id'] if self.current_chat_type == "private" and self.current_chat_user else None
+        if not group_id and not other_user_id:
+            return
+        before_id = self.message_manager.oldest_message_id(group_id=group_id, other_user_id=other_user_id)
+        if before_id is None:
+            return
+        self.loading_older_messages = True
+        if group_id:
+            self.client.get_messages(group_id=group_id, before_id=before_id)
+        else:
+            self.client.get_messages(other_user=self.current_chat_user['username'], before_id=before_id)
     
-    def refresh_messages_display(self):
-        """Làm mới hiển thị tin nhắn từ cache."""
+    def refresh_messages_display(self, keep_distance: Optional[int] = None):
+        """
+        Làm mới hiển thị tin nhắn từ cache.
+
+        ``keep_distance``: khoảng cách tới đáy cần giữ lại (khi thêm tin cũ ở
+        phía trên); None thì cuộn xuống cuối.
+        """
         self.chat_area.clear_messages()
         
         group_id = self.current_group_id if self.current_chat_type == "group" else None
@@ -1501,8 +1716,11 @@ class MainChatWindow(QMainWindow):
             message_dict = message.to_dict() if hasattr(message, 'to_dict') else message.__dict__
             self.add_message_bubble(message_dict)
         
-        # Cuộn xuống dưới cùng sau khi thêm tin nhắn
-        QTimer.singleShot(100, self.scroll_to_bottom)
+        if keep_distance is None:
+            # Cuộn xuống dưới cùng sau khi thêm tin nhắn
+            QTimer.singleShot(100, self.scroll_to_bottom)
+        else:
+            QTimer.singleShot(100, lambda: self.chat_area.scroll_to_distance_from_bottom(keep_distance))
         
     def add_message_bubble(self, message_data):
         """Thêm bubble tin nhắn vào layout."""
@@ -1513,7 +1731,7 @@ class MainChatWindow(QMainWindow):
         current_user_id = self.user_data['user']['id']
         is_own_message = message_data['sender']['id'] == current_user_id
         
-        bubble = ChatBubble(message_data, is_own_message)
+        bubble = ChatBubble(message_data, is_own_message, attachment_manager=self.attachment_manager)
         
         # Chèn bubble vào ChatArea component
         self.chat_area.add_message_widget(bubble)
@@ -1599,14 +1817,35 @@ class MainChatWindow(QMainWindow):
             print(f"DEBUG: Displaying message - group_id={group_id_for_msg}, other_user_id={other_user_id_for_msg}, current_group={current_group_id}, current_user={current_other_user_id}")
             self.add_message_bubble(message_data)
             self.scroll_to_bottom()
-            # Nếu là chat riêng, đánh dấu đã đọc
-            if not group_id_for_msg:
-                self.client.mark_messages_read(message_data['sender']['username'])
+            # Đánh dấu đã đọc tin nhắn của người khác đang hiển thị
+            if sender_id != current_user_id:
+                if group_id_for_msg:
+                    self.client.mark_messages_read(group_id=group_id_for_msg, message_id=message_data.get('id'))
+                else:
+                    self.client.mark_messages_read(message_data['sender']['username'],
+                                                   message_id=message_data.get('id'))
         else:
             print(f"DEBUG: Not displaying message - group_id={group_id_for_msg}, other_user_id={other_user_id_for_msg}, current_group={current_group_id}, current_user={current_other_user_id}")
-        
-        # Luôn làm mới danh sách hội thoại để cập nhật tin nhắn cuối và thứ tự
-        self.client.get_conversations()
+        # Tin nhắn cuối và thứ tự của danh sách hội thoại được cập nhật bởi gói
+        # tin conversation_updated đi kèm, không cần gọi lại get_conversations
+
+    def is_current_chat(self, group_id=None, other_user_id=None):
+        """Hội thoại đang mở trên màn hình có phải là hội thoại này không."""
+        if group_id:
+            return self.current_chat_type == "group" and self.current_group_id == group_id
+        return (self.current_chat_type == "private" and bool(self.current_chat_user)
+                and self.current_chat_user.get('id') == other_user_id)
+
+    def apply_conversation_update(self, update):
+        """Cập nhật tại chỗ một hội thoại trong danh sách theo gói tin conversation_updated."""
+        if self.is_current_chat(update.get('group_id'), update.get('other_user_id')):
+            # Hội thoại đang mở: tin nhắn đã được hiển thị và đánh dấu đã đọc
+            update = dict(update, unread_delta=0)
+        if self.conversation_manager.apply_conversation_update(update) is None:
+            # Hội thoại chưa có trong danh sách (tin nhắn đầu tiên): lấy đủ thông tin từ server
+            self.client.get_conversations()
+            return
+        self.refresh_conversations_list()
 
     
     
@@ -1660,11 +1899,8 @@ class MainChatWindow(QMainWindow):
     
     def remove_message(self, message_id):
         """Xóa tin nhắn"""
-        # Remove from messages list
-        self.messages = [msg for msg in self.messages if msg['id'] != message_id]
-        
-        # Refresh display
-        self.refresh_messages_display()
+        if self.message_manager.remove_messages([message_id]):
+            self.refresh_messages_display(keep_distance=self.chat_area.distance_from_bottom())
     
     def scroll_to_bottom(self):
         """Cuộn xuống cuối"""
@@ -1672,7 +1908,7 @@ class MainChatWindow(QMainWindow):
         scrollbar.setValue(scrollbar.maximum())
     
     def start_private_chat(self, user_data):
-        """Bắt đầu chat riêng và LUÔN LUÔN tải lịch sử chat."""
+        """Bắt đầu chat riêng; tải lịch sử nếu chưa có trong cache."""
         # Ensure user_data is a dict
         if not isinstance(user_data, dict):
             if hasattr(user_data, 'to_dict'):
@@ -1701,22 +1937,24 @@ class MainChatWindow(QMainWindow):
         # Kích hoạt các nút nhập liệu
         self.chat_area.set_send_button_enabled(bool(self.chat_area.get_message_text().strip()))
         
-        # --- LOGIC QUAN TRỌNG ---
-        # Xóa cache cũ (nếu có) và luôn yêu cầu server cung cấp lịch sử mới nhất.
-        # Điều này đảm bảo dữ liệu luôn được làm mới khi mở lại cuộc trò chuyện.
+        # Lịch sử đã tải được giữ mới bằng new_message/message_deleted và gói tin
+        # sync khi kết nối lại, nên mở lại hội thoại không cần hỏi server
         other_user_id = user_data.get('id')
-        if other_user_id:
-            self.message_manager.clear_conversation(other_user_id=other_user_id)
-        
-        print(f"Requesting message history for user: {username}")
-        self.client.get_messages(other_user=username)
+        if other_user_id and self.message_manager.has_history(other_user_id=other_user_id):
+            self.show_cached_messages(other_user_id=other_user_id)
+        else:
+            print(f"Requesting message history for user: {username}")
+            self.client.get_messages(other_user=username)
 
         # Đánh dấu các tin nhắn là đã đọc
         self.client.mark_messages_read(user_data['username'])
+        if self.conversation_manager.mark_conversation_read(other_user_id=other_user_id):
+            # Làm mới sau khi xử lý xong sự kiện chọn hội thoại (danh sách sẽ được vẽ lại)
+            QTimer.singleShot(0, self.refresh_conversations_list)
 
     # >>> THAY THẾ HÀM NÀY <<<
     def start_group_chat(self, group_id, group_name):
-        """Bắt đầu chat nhóm và LUÔN LUÔN tải lịch sử chat."""
+        """Bắt đầu chat nhóm; tải lịch sử nếu chưa có trong cache."""
         print(f"Starting group chat for group: {group_name} (ID: {group_id})")
         self.clear_chat_display()
         self.current_chat_type = "group"
@@ -1729,11 +1967,22 @@ class MainChatWindow(QMainWindow):
 
         self.chat_area.set_send_button_enabled(bool(self.chat_area.get_message_text().strip()))
 
-        # Xóa cache cũ và yêu cầu lịch sử mới từ server
-        self.message_manager.clear_conversation(group_id=group_id)
+        if self.message_manager.has_history(group_id=group_id):
+            self.show_cached_messages(group_id=group_id)
+        else:
+            print(f"Requesting message history for group ID: {group_id}")
+            self.client.get_messages(group_id=group_id)
 
-        print(f"Requesting message history for group ID: {group_id}")
-        self.client.get_messages(group_id=group_id)
+        # Đánh dấu đã đọc nhóm (read cursor, không cập nhật từng tin nhắn)
+        self.client.mark_messages_read(group_id=group_id)
+        if self.conversation_manager.mark_conversation_read(group_id=group_id):
+            QTimer.singleShot(0, self.refresh_conversations_list)
+
+    def show_cached_messages(self, group_id=None, other_user_id=None):
+        """Hiển thị lịch sử đã có trong cache của hội thoại vừa mở."""
+        messages = self.message_manager.get_messages(group_id=group_id, other_user_id=other_user_id)
+        self.message_count_label.setText(f"{len(messages)} tin nhắn")
+        self.refresh_messages_display()
 
 
     
@@ -1771,15 +2020,16 @@ class MainChatWindow(QMainWindow):
             group_name = conversation.get('group_name')
             self.start_group_chat(group_id, group_name)
     
-    def on_contact_selected(self, item):
-        """Xử lý khi chọn contact"""
-        widget = self.contacts_list.itemWidget(item)
-        if widget and hasattr(widget, 'contact_data'):
-            contact = widget.contact_data
+    def on_contact_selected(self, contact):
+        """Xử lý khi chọn contact (Sidebar gửi dữ liệu contact của item)."""
+        if isinstance(contact, dict) and contact.get('username'):
             self.start_private_chat(contact)
     
     def filter_contacts(self):
-        """Lọc danh sách liên hệ"""
+        """
+        Lọc danh sách liên hệ theo ô tìm kiếm, không phân biệt hoa thường và
+        dấu tiếng Việt (cùng khóa tìm kiếm với tin nhắn trên server).
+        """
         self.refresh_contacts_list()
     
     def on_message_input_changed(self):
@@ -1908,16 +2158,13 @@ class MainChatWindow(QMainWindow):
                     QMessageBox.warning(self, "Cảnh báo", "File quá lớn! Kích thước tối đa là 10MB.")
                     return
                 
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
-                
                 file_name = os.path.basename(file_path)
                 
-                # SỬA LỜI GỌI HÀM Ở ĐÂY
+                # File được đọc và gửi theo chunk trên thread riêng của client
                 if self.current_chat_type == "group":
-                    self.client.upload_file(file_data, file_name, group_id=self.current_group_id)
+                    self.client.upload_file(file_path, group_id=self.current_group_id)
                 elif self.current_chat_user:
-                    self.client.upload_file(file_data, file_name, receiver=self.current_chat_user['username'])
+                    self.client.upload_file(file_path, receiver=self.current_chat_user['username'])
                 
                 self.status_bar.showMessage(f"Đang gửi file: {file_name}", 3000)
                 
@@ -1959,7 +2206,7 @@ class MainChatWindow(QMainWindow):
         search_text, ok = QInputDialog.getText(
             self, 
             "Tìm kiếm tin nhắn", 
-            "Nhập từ khóa tìm kiếm:"
+            "Nhập từ khóa tìm kiếm (\"cụm từ\" để tìm chính xác, từ* để tìm theo tiền tố):"
         )
         
         if ok and search_text.strip():
@@ -1,10 +1,16 @@
+import hashlib
+import os
 import socket
-import json
 import threading
 import time
+import uuid
 from typing import Optional, Callable, Dict, Any,List 
 from PyQt5.QtCore import QObject, pyqtSignal
+from common.protocol import (DEFAULT_CHUNK_SIZE, FrameDecoder, ProtocolError, decode_chunk,
+                             decode_json, encode_chunk, encode_frame)
 class SocketClient(QObject):
+    RECV_BUFFER_SIZE = 64 * 1024
+
     # Signals
     connected = pyqtSignal()
     disconnected = pyqtSignal()
@@ -23,6 +29,12 @@ class SocketClient(QObject):
         self.reconnect_thread: Optional[threading.Thread] = None
         self.auto_reconnect = True
         self.reconnect_delay = 5  # seconds
+        # Gói tin JSON và chunk upload được gửi từ nhiều thread
+        self._send_lock = threading.Lock()
+        # Upload đang chờ server chấp nhận hoặc đang gửi: {client_upload_id: thông tin upload}
+        self.pending_uploads: Dict[str, Dict[str, Any]] = {}
+        # Download đang nhận dở: {download_id: thông tin download}
+        self.pending_downloads: Dict[str, Dict[str, Any]] = {}
     def connect_to_server(self, host: str, port: int) -> bool:
         """Kết nối đến server"""
         self.host = host
@@ -68,10 +80,10 @@ class SocketClient(QObject):
             self.error_occurred.emit("Không có kết nối đến server")
             return False
         try:
-            data = json.dumps(message, ensure_ascii=False).encode('utf-8')
-            print(f"DEBUG CLIENT SEND -> RAW DATA: {data.decode('utf-8')}")
+            data = encode_frame(message)
+            print(f"DEBUG CLIENT SEND -> {message.get('type')} ({len(data)} bytes)")
             # Use sendall to ensure all data is sent
-            self.socket.sendall(data)
+            self._send_raw(data)
             print(f"DEBUG: Successfully sent {len(data)} bytes")
             return True
         except Exception as e:
@@ -79,6 +91,10 @@ class SocketClient(QObject):
             self.error_occurred.emit(f"Lỗi gửi tin nhắn: {str(e)}")
             self._handle_connection_lost()
             return False
+    def _send_raw(self, data: bytes):
+        """Gửi một frame đã mã hóa; khóa để frame của các thread không xen lẫn nhau."""
+        with self._send_lock:
+            self.socket.sendall(data)
     def register(self, username: str, password: str, display_name: str = "", email: str = "") -> bool:
         """Đăng ký tài khoản"""
         return self.send_message({
@@ -124,27 +140,241 @@ class SocketClient(QObject):
         if client_message_id: # THÊM KHỐI IF NÀY
             message['client_message_id'] = client_message_id
         return self.send_message(message)
-    def upload_file(self, file_data: bytes, file_name: str, receiver: str = None, group_id: int = None) -> bool:
-        """Upload file đến chat riêng hoặc nhóm."""
+    def upload_file(self, file_path: str, receiver: str = None, group_id: int = None) -> bool:
+        """
+        Upload file đến chat riêng hoặc nhóm theo từng chunk.
+
+        Chỉ gửi ``begin_upload`` (tên, kích thước, SHA-256); dữ liệu được đọc từ
+        đĩa và gửi theo chunk sau khi server trả về ``upload_ready``, nên file
+        quá lớn bị từ chối trước khi gửi byte nào.
+        """
         if not self.session_token:
             return False
-        import base64
+        if not group_id and not receiver:
+            return False
+        try:
+            file_size = os.path.getsize(file_path)
+            sha256 = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(DEFAULT_CHUNK_SIZE), b''):
+                    sha256.update(block)
+        except OSError as e:
+            self.error_occurred.emit(f"Không thể đọc file: {str(e)}")
+            return False
+
+        client_upload_id = uuid.uuid4().hex
         message = {
-            'type': 'upload_file',
+            'type': 'begin_upload',
             'session_token': self.session_token,
-            'file_name': file_name,
-            'file_data': base64.b64encode(file_data).decode('utf-8'),
+            'client_upload_id': client_upload_id,
+            'file_name': os.path.basename(file_path),
+            'file_size': file_size,
+            'sha256': sha256.hexdigest(),
         }
         if group_id:
             message['group_id'] = group_id
-        elif receiver:
+        else:
             message['receiver'] = receiver
+        self.pending_uploads[client_upload_id] = {
+            'file_path': file_path,
+            'file_size': file_size,
+            'target': {'group_id': group_id} if group_id else {'receiver': receiver},
+        }
+        if not self.send_message(message):
+            self.pending_uploads.pop(client_upload_id, None)
+            return False
+        return True
+    def cancel_upload(self, upload_id: str) -> bool:
+        """Hủy một upload đang gửi."""
+        for info in self.pending_uploads.values():
+            if info.get('upload_id') == upload_id:
+                info['cancelled'] = True
+        return self.send_message({
+            'type': 'cancel_upload',
+            'session_token': self.session_token,
+            'upload_id': upload_id
+        })
+    def _handle_upload_message(self, message: dict):
+        """Theo dõi trạng thái upload từ các phản hồi của server."""
+        message_type = message.get('type')
+        client_upload_id = message.get('client_upload_id')
+        if message_type == 'upload_ready':
+            info = self.pending_uploads.get(client_upload_id)
+            if info is None:
+                return
+            info['upload_id'] = message['upload_id']
+            # Mỗi lần server chấp nhận (kể cả khi resume) là một lượt gửi mới;
+            # thread gửi của lượt cũ tự dừng khi thấy generation thay đổi
+            info['generation'] = info.get('generation', 0) + 1
+            threading.Thread(
+                target=self._send_upload_chunks,
+                args=(client_upload_id, info['generation'], message.get('offset') or 0,
+                      message.get('chunk_size') or DEFAULT_CHUNK_SIZE),
+                daemon=True).start()
+        elif message_type in ('upload_complete', 'upload_error', 'upload_cancelled'):
+            if client_upload_id:
+                self.pending_uploads.pop(client_upload_id, None)
+                return
+            upload_id = message.get('upload_id')
+            for key, info in list(self.pending_uploads.items()):
+                if info.get('upload_id') == upload_id:
+                    info['cancelled'] = True
+                    self.pending_uploads.pop(key, None)
+    def _send_upload_chunks(self, client_upload_id: str, generation: int, offset: int, chunk_size: int):
+        """Đọc file từ đĩa và gửi từng chunk bắt đầu từ ``offset``, sau đó gửi ``commit_upload``."""
+        info = self.pending_uploads.get(client_upload_id)
+        if info is None:
+            return
+        upload_id = info['upload_id']
+        try:
+            f = open(info['file_path'], 'rb')
+        except OSError as e:
+            self.error_occurred.emit(f"Lỗi upload file: {str(e)}")
+            self.pending_uploads.pop(client_upload_id, None)
+            self.cancel_upload(upload_id)
+            return
+        with f:
+            f.seek(offset)
+            while not info.get('cancelled') and info.get('generation') == generation:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                if not self.connected_flag or not self.socket:
+                    return  # Gửi tiếp từ offset server đã nhận sau khi kết nối lại
+                try:
+                    self._send_raw(encode_chunk(upload_id, offset, data))
+                except OSError:
+                    return  # Thread nhận sẽ phát hiện mất kết nối và reconnect
+                offset += len(data)
+        if info.get('cancelled') or info.get('generation') != generation:
+            return
+        print(f"DEBUG: Upload {upload_id} sent {offset} bytes")
+        self.send_message({
+            'type': 'commit_upload',
+            'session_token': self.session_token,
+            'upload_id': upload_id
+        })
+    def get_attachment(self, message_id: int, size: int = None) -> bool:
+        """
+        Yêu cầu nội dung file đính kèm của một tin nhắn (tin nhắn chỉ mang metadata).
+
+        Nếu có ``size`` (px), server trả về ảnh thu nhỏ gần nhất thay vì file gốc.
+        """
+        if not self.session_token:
+            return False
+        return self.send_message({
+            'type': 'get_attachment',
+            'session_token': self.session_token,
+            'message_id': message_id,
+            'size': size
+        })
+    def get_avatar(self, user_id: int, avatar_hash: str = None, size: int = None) -> bool:
+        """Yêu cầu avatar của user; gửi kèm hash đang cache để server trả not_modified nếu không đổi."""
+        if not self.session_token:
+            return False
+        return self.send_message({
+            'type': 'get_avatar',
+            'session_token': self.session_token,
+            'user_id': user_id,
+            'avatar_hash': avatar_hash,
+            'size': size
+        })
+    def download_file(self, message_id: int, save_path: str) -> bool:
+        """
+        Tải file đính kèm của một tin nhắn về ``save_path``.
+
+        Dữ liệu được ghi vào ``save_path + '.part'``; nếu file này đã có từ lần
+        tải trước bị gián đoạn thì chỉ tải tiếp phần còn thiếu.
+        """
+        if not self.session_token:
+            return False
+        part_path = save_path + '.part'
+        download_id = uuid.uuid4().hex
+        self.pending_downloads[download_id] = {
+            'message_id': message_id,
+            'save_path': save_path,
+            'part_path': part_path,
+        }
+        return self._request_download(download_id)
+    def _request_download(self, download_id: str) -> bool:
+        info = self.pending_downloads.get(download_id)
+        if info is None:
+            return False
+        if info.get('file') is None:
+            info['file'] = open(info['part_path'], 'ab')
         else:
-            # Mặc định gửi vào nhóm chung nếu không có đích cụ thể
-            # Hoặc bạn có thể trả về lỗi ở đây
-            return False 
-        
-        return self.send_message(message)
+            info['file'].flush()
+        offset = os.path.getsize(info['part_path'])
+        info['offset'] = offset
+        return self.send_message({
+            'type': 'download_file',
+            'session_token': self.session_token,
+            'download_id': download_id,
+            'message_id': info['message_id'],
+            'offset': offset
+        })
+    def _handle_download_chunk(self, payload: bytes):
+        """Ghi một chunk nhị phân của download vào file ``.part``."""
+        try:
+            download_id, offset, data = decode_chunk(payload)
+        except ProtocolError as e:
+            print(f"DEBUG: Invalid binary frame: {e}")
+            return
+        info = self.pending_downloads.get(download_id)
+        if info is None or info.get('file') is None:
+            return
+        if offset != info['offset']:
+            print(f"DEBUG: Download {download_id} chunk at {offset}, expected {info['offset']}")
+            return
+        info['file'].write(data)
+        info['offset'] += len(data)
+    def _handle_download_message(self, message: dict):
+        """Xin cửa sổ tiếp theo, hoặc hoàn tất/hủy download khi server báo kết thúc."""
+        download_id = message.get('download_id')
+        if message.get('type') == 'download_window':
+            # Đã nhận hết cửa sổ trước (chunk đến trước phản hồi): tải tiếp từ cuối file .part
+            self._request_download(download_id)
+            return
+        info = self.pending_downloads.pop(download_id, None)
+        if info is None:
+            return
+        if info.get('file') is not None:
+            info['file'].close()
+            info['file'] = None
+        if message.get('type') != 'download_complete':
+            if os.path.exists(info['part_path']):
+                os.remove(info['part_path'])
+            return
+        sha256 = hashlib.sha256()
+        with open(info['part_path'], 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        if info['offset'] != message.get('file_size') or sha256.hexdigest() != message.get('sha256'):
+            # Phần đã tải không khớp với file trên server: xóa để lần sau tải lại từ đầu
+            os.remove(info['part_path'])
+            message['success'] = False
+            message['error'] = "File tải về bị lỗi, vui lòng thử lại"
+            return
+        os.replace(info['part_path'], info['save_path'])
+        message['save_path'] = info['save_path']
+    def _resume_transfers(self):
+        """Sau khi kết nối lại: gửi tiếp các upload và tải tiếp các download dở dang."""
+        if not self.session_token:
+            return
+        for client_upload_id, info in list(self.pending_uploads.items()):
+            if info.get('upload_id'):
+                self.send_message({
+                    'type': 'resume_upload',
+                    'session_token': self.session_token,
+                    'upload_id': info['upload_id'],
+                    'client_upload_id': client_upload_id
+                })
+            else:
+                # Server chưa nhận begin_upload: bắt đầu lại
+                self.pending_uploads.pop(client_upload_id, None)
+                self.upload_file(info['file_path'], **info['target'])
+        for download_id in list(self.pending_downloads):
+            self._request_download(download_id)
     def get_contacts(self) -> bool:
         """Lấy danh sách liên hệ"""
         if not self.session_token:
@@ -161,33 +391,69 @@ class SocketClient(QObject):
             'type': 'get_conversations',
             'session_token': self.session_token
         })
-    def get_messages(self, other_user: str = None, group_id: int = None, limit: int = 50, offset: int = 0) -> bool:
-        """Lấy tin nhắn từ chat riêng hoặc chat nhóm."""
+    def get_messages(self, other_user: str = None, group_id: int = None, limit: int = 50,
+                     before_id: int = None, after_id: int = None, around_id: int = None) -> bool:
+        """
+        Lấy một trang tin nhắn từ chat riêng hoặc chat nhóm.
+
+        Không có con trỏ: trang mới nhất. ``before_id``: các tin cũ hơn (cuộn
+        lên), ``after_id``: các tin mới hơn, ``around_id``: các tin quanh một
+        tin nhắn (nhảy tới kết quả tìm kiếm).
+        """
         if not self.session_token:
             return False
         
         message = {
             'type': 'get_messages',
             'session_token': self.session_token,
-            'limit': limit,
-            'offset': offset
+            'limit': limit
         }
         # Thêm tham số phù hợp vào yêu cầu
         if group_id:
             message['group_id'] = group_id
         elif other_user:
             message['other_user'] = other_user
+        for key, value in (('before_id', before_id), ('after_id', after_id), ('around_id', around_id)):
+            if value is not None:
+                message[key] = value
         
         return self.send_message(message)
-    def mark_messages_read(self, sender: str) -> bool:
-        """Đánh dấu tin nhắn đã đọc"""
+    def sync(self, conversations: Dict[str, int], change_id: int = None, last_message_id: int = None) -> bool:
+        """
+        Đồng bộ sau khi kết nối lại: server chỉ gửi phần bị bỏ lỡ.
+
+        ``conversations``: {"group:<id>" | "user:<id>": id tin nhắn mới nhất đang
+        có} của các hội thoại đã tải lịch sử; ``change_id``: mốc thay đổi nhận
+        được lúc đăng nhập hoặc lần sync trước; ``last_message_id``: id tin nhắn
+        lớn nhất đã thấy.
+        """
         if not self.session_token:
             return False
         return self.send_message({
-            'type': 'mark_read',
+            'type': 'sync',
             'session_token': self.session_token,
-            'sender': sender
+            'conversations': conversations,
+            'change_id': change_id,
+            'last_message_id': last_message_id
         })
+    def mark_messages_read(self, sender: str = None, group_id: int = None, message_id: int = None) -> bool:
+        """
+        Đánh dấu đã đọc chat riêng với ``sender`` hoặc nhóm ``group_id``, đến
+        ``message_id`` (mặc định: tin nhắn mới nhất).
+        """
+        if not self.session_token:
+            return False
+        message = {
+            'type': 'mark_read',
+            'session_token': self.session_token
+        }
+        if group_id:
+            message['group_id'] = group_id
+        else:
+            message['sender'] = sender
+        if message_id is not None:
+            message['message_id'] = message_id
+        return self.send_message(message)
     def start_typing(self, other_user: str = None, is_group: bool = False) -> bool:
         """Bắt đầu gõ"""
         if not self.session_token:
@@ -224,17 +490,23 @@ class SocketClient(QObject):
         if status_message:
             message['status_message'] = status_message
         return self.send_message(message)
-    def search_messages(self, query: str, limit: int = 20) -> bool:
-        """Tìm kiếm tin nhắn"""
+    def search_messages(self, query: str, limit: int = 20, cursor: str = None) -> bool:
+        """
+        Tìm kiếm tin nhắn. ``"cụm từ"`` tìm các từ liền nhau, ``từ*`` tìm theo
+        tiền tố; ``cursor`` là ``next_cursor`` của trang trước để tải thêm.
+        """
         if not self.session_token:
             return False
         
-        return self.send_message({
+        message = {
             'type': 'search_messages',
             'session_token': self.session_token,
             'query': query,
             'limit': limit
-        })
+        }
+        if cursor:
+            message['cursor'] = cursor
+        return self.send_message(message)
     def delete_message(self, message_id: int) -> bool:
         """Xóa tin nhắn"""
         if not self.session_token:
@@ -254,6 +526,20 @@ class SocketClient(QObject):
             'session_token': self.session_token,
             'other_user': other_user
         })
+    def pin_conversation(self, other_user: str = None, group_id: int = None, pinned: bool = True) -> bool:
+        """Ghim (hoặc bỏ ghim) chat riêng với ``other_user`` hoặc nhóm ``group_id`` lên đầu danh sách hội thoại"""
+        if not self.session_token:
+            return False
+        message = {
+            'type': 'pin_conversation',
+            'session_token': self.session_token,
+            'pinned': pinned
+        }
+        if group_id:
+            message['group_id'] = group_id
+        else:
+            message['other_user'] = other_user
+        return self.send_message(message)
     def upload_avatar(self, avatar_data: bytes) -> bool:
         """Upload avatar"""
         if not self.session_token:
@@ -266,74 +552,42 @@ class SocketClient(QObject):
         })
     def _receive_messages(self):
         """Thread nhận tin nhắn từ server"""
-        buffer = ""
+        decoder = FrameDecoder()
+        recv_buffer = bytearray(self.RECV_BUFFER_SIZE)
+        recv_view = memoryview(recv_buffer)
         while self.running and self.connected_flag:
             try:
                 if not self.socket:
                     break           
-                data = self.socket.recv(4096).decode('utf-8')
-                if not data:
+                received = self.socket.recv_into(recv_buffer)
+                if not received:
                     break
-                print(f"DEBUG CLIENT RECV <- RAW DATA: {data}")
-                buffer += data          
-                # Xử lý tất cả các gói JSON hoàn chỉnh có trong buffer
-                while True:
+                for frame in decoder.feed(recv_view[:received]):
+                    if frame.is_binary:
+                        self._handle_download_chunk(frame.payload)
+                        continue
                     try:
-                        # Tìm vị trí kết thúc của một đối tượng JSON
-                        # Giả định rằng mỗi gói JSON là một dictionary, bắt đầu bằng '{' và kết thúc bằng '}'
-                        # Đây là một giả định đơn giản, có thể cần cải tiến nếu server gửi các loại JSON khác
-                        start_index = buffer.find('{')
-                        if start_index == -1:
-                            # Không có JSON object nào trong buffer, xóa buffer và đợi dữ liệu mới
-                            buffer = ""
-                            break
-                        # Tìm dấu ngoặc đóng tương ứng
-                        brace_count = 0
-                        end_index = -1
-                        in_string = False
-                        for i in range(start_index, len(buffer)):
-                            char = buffer[i]
-                            if char == '"':
-                                # Bỏ qua các dấu ngoặc trong chuỗi
-                                if i > 0 and buffer[i-1] != '\\':
-                                    in_string = not in_string
-                            elif not in_string:
-                                if char == '{':
-                                    brace_count += 1
-                                elif char == '}':
-                                    brace_count -= 1
-                            if brace_count == 0 and i >= start_index:
-                                end_index = i
-                                break    
-                        if end_index != -1:
-                            # Đã tìm thấy một gói JSON hoàn chỉnh
-                            json_str = buffer[start_index : end_index + 1]
-                            message = json.loads(json_str)
-                            
-                            # Xử lý message
-                            if message.get('type') == 'login' or (message.get('success') and 'session_token' in message):
-                                self.session_token = message.get('session_token')
-                                self.user_id = message.get('user_id')
-                            self.message_received.emit(message)
-                            
-                            # Xóa gói JSON đã xử lý khỏi buffer
-                            buffer = buffer[end_index + 1:]
-                        else:
-                            # Chưa có gói JSON hoàn chỉnh, đợi thêm dữ liệu
-                            break          
-                    except json.JSONDecodeError:
-                        # Nếu có lỗi, có thể gói JSON chưa hoàn chỉnh hoặc bị lỗi
-                        # Chúng ta sẽ đợi thêm dữ liệu
-                        print(f"JSONDecodeError, buffer hiện tại: {buffer}")
-                        break # Thoát vòng lặp while True và đợi recv() tiếp
-                    except Exception as e:
-                        print(f"Lỗi xử lý buffer: {e}")
-                        buffer = "" # Xóa buffer để tránh lặp lỗi
-                        break 
+                        message = decode_json(frame.payload)
+                    except ValueError as e:
+                        print(f"Gói tin JSON không hợp lệ từ server: {e}")
+                        continue
+                    # Xử lý message
+                    if message.get('type') == 'login' or (message.get('success') and 'session_token' in message):
+                        self.session_token = message.get('session_token')
+                        self.user_id = message.get('user_id')
+                    if message.get('type', '').startswith('upload_'):
+                        self._handle_upload_message(message)
+                    elif message.get('type', '').startswith('download_'):
+                        self._handle_download_message(message)
+                    self.message_received.emit(message)
             except socket.timeout:
                 continue
             except ConnectionResetError:
                 break
+            except ProtocolError as e:
+                if self.running:
+                    self.error_occurred.emit(f"Lỗi protocol: {str(e)}")
+                break
             except Exception as e:
                 if self.running:
                     self.error_occurred.emit(f"Lỗi nhận tin nhắn: {str(e)}")
@@ -371,6 +625,7 @@ class SocketClient(QObject):
                 
                 if self.connect_to_server(self.host, self.port):
                     self.error_occurred.emit("Kết nối lại thành công!")
+                    self._resume_transfers()
                     break
                 else:
                     self.error_occurred.emit(f"Kết nối lại thất bại. Thử lại sau {self.reconnect_delay} giây...")
@@ -19,6 +19,7 @@ class ChatArea(QFrame):
     search_clicked = pyqtSignal()
     clear_chat_clicked = pyqtSignal()
     info_sidebar_toggled = pyqtSignal(bool)  # Emits toggle state
+    load_older_requested = pyqtSignal()  # Emitted when scrolled to the top of the history
     
     def __init__(self, parent=None):
         """
@@ -44,6 +45,7 @@ class ChatArea(QFrame):
         self.messages_scroll = QScrollArea()
         self.messages_scroll.setWidgetResizable(True)
         self.messages_scroll.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.messages_scroll.verticalScrollBar().valueChanged.connect(self._on_scroll_changed)
         
         # Widget containing all chat bubbles
         self.messages_container = QWidget()
@@ -268,6 +270,32 @@ class ChatArea(QFrame):
             self.messages_scroll.verticalScrollBar().maximum()
         )
     
+    def distance_from_bottom(self) -> int:
+        """
+        Get how far (in pixels) the message view is scrolled up from the bottom.
+        
+        Returns:
+            Distance from the bottom of the scroll range
+        """
+        scrollbar = self.messages_scroll.verticalScrollBar()
+        return scrollbar.maximum() - scrollbar.value()
+    
+    def scroll_to_distance_from_bottom(self, distance: int):
+        """
+        Restore a position saved with :meth:`distance_from_bottom`.
+        
+        Args:
+            distance: Distance from the bottom of the scroll range
+        """
+        scrollbar = self.messages_scroll.verticalScrollBar()
+        scrollbar.setValue(max(scrollbar.minimum(), scrollbar.maximum() - distance))
+    
+    def _on_scroll_changed(self, value: int):
+        """Request the previous history page when the top is reached."""
+        scrollbar = self.messages_scroll.verticalScrollBar()
+        if value == scrollbar.minimum() and scrollbar.maximum() > scrollbar.minimum():
+            self.load_older_requested.emit()
+    
     def set_typing_indicator(self, text: str, visible: bool = True):
         """
         Set typing indicator text and visibility.
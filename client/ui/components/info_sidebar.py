@@ -8,6 +8,7 @@ from PyQt5.QtCore import QSize
 from PyQt5.QtGui import QFont, QIcon, QPixmap
 
 from ...utils import resource_path
+from ..widgets.attachment_image import AttachmentImageLabel
 
 
 class InfoSidebar(QFrame):
@@ -18,15 +19,17 @@ class InfoSidebar(QFrame):
     remove_member_clicked = pyqtSignal(int)  # Emits member_id
     media_viewer_requested = pyqtSignal(str, list, str)  # title, messages, media_type
     
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, attachment_manager=None):
         """
         Initialize info sidebar component.
         
         Args:
             parent: Parent widget (MainChatWindow)
+            attachment_manager: AttachmentManager used to fetch image previews
         """
         super().__init__(parent)
         self.parent_window = parent
+        self.attachment_manager = attachment_manager
         self.setFixedWidth(320)
         self.setStyleSheet("background-color: #f0f2f5; border-left: 1px solid #e0e0e0;")
         self.init_ui()
@@ -157,17 +160,12 @@ class InfoSidebar(QFrame):
             layout = QGridLayout(content_widget)
             layout.setSpacing(5)
             num_columns = 3
-            import base64
             for i, msg in enumerate(messages[:max_preview]):
                 row, col = divmod(i, num_columns)
                 try:
-                    pixmap = QPixmap()
-                    pixmap.loadFromData(base64.b64decode(msg['file_data']))
-                    img_label = QLabel()
-                    img_label.setPixmap(
-                        pixmap.scaled(85, 85, Qt.KeepAspectRatioByExpanding, Qt.SmoothTransformation)
-                    )
-                    img_label.setFixedSize(85, 85)
+                    img_label = AttachmentImageLabel(msg, self.attachment_manager, size=85,
+                                                     aspect_mode=Qt.KeepAspectRatioByExpanding,
+                                                     fixed_size=True)
                     img_label.setStyleSheet("border-radius: 8px;")
                     layout.addWidget(img_label, row, col)
                 except Exception as e:
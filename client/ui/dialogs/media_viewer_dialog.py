@@ -1,16 +1,17 @@
 """Dialog for viewing media, files, or links."""
-import base64
 from typing import List, Dict
 from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QLabel, QScrollArea, 
                              QWidget, QGridLayout)
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPixmap
+
+from ..widgets.attachment_image import AttachmentImageLabel
 
 
 class MediaViewerDialog(QDialog):
     """Dialog to view all media, files, or links."""
     
-    def __init__(self, title: str, messages: List[Dict], media_type: str, parent=None):
+    def __init__(self, title: str, messages: List[Dict], media_type: str, parent=None,
+                 attachment_manager=None):
         """
         Initialize media viewer dialog.
         
@@ -19,6 +20,7 @@ class MediaViewerDialog(QDialog):
             messages: List of message dictionaries
             media_type: Type of media ('image', 'file', 'link')
             parent: Parent widget
+            attachment_manager: AttachmentManager used to fetch images
         """
         super().__init__(parent)
         self.setWindowTitle(title)
@@ -41,11 +43,7 @@ class MediaViewerDialog(QDialog):
                 for i, msg in enumerate(messages):
                     row, col = divmod(i, num_columns)
                     try:
-                        pixmap = QPixmap()
-                        pixmap.loadFromData(base64.b64decode(msg['file_data']))
-                        img_label = QLabel()
-                        img_label.setPixmap(pixmap.scaled(120, 120, Qt.KeepAspectRatio, Qt.SmoothTransformation))
-                        img_label.setFixedSize(120, 120)
+                        img_label = AttachmentImageLabel(msg, attachment_manager, size=120, fixed_size=True)
                         img_label.setStyleSheet("border: 1px solid #ddd; border-radius: 8px;")
                         content_layout.addWidget(img_label, row, col)
                     except Exception as e:
@@ -1,16 +1,20 @@
 """Dialog for displaying search results."""
-from typing import List, Dict
+from typing import List, Dict, Optional
 from datetime import datetime
 from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QLabel, 
                              QListWidget, QListWidgetItem, QPushButton, QWidget, QFrame)
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtGui import QFont
 
 
 class SearchResultDialog(QDialog):
     """Dialog to display search results."""
     
-    def __init__(self, query: str, results: List[Dict], parent=None):
+    # Emits (query, cursor) when the user asks for the next page of results
+    load_more_requested = pyqtSignal(str, str)
+    
+    def __init__(self, query: str, results: List[Dict], parent=None,
+                 next_cursor: Optional[str] = None):
         """
         Initialize search result dialog.
         
@@ -18,10 +22,12 @@ class SearchResultDialog(QDialog):
             query: Search query string
             results: List of message dictionaries matching the query
             parent: Parent widget
+            next_cursor: Cursor of the next result page, None if there are no more results
         """
         super().__init__(parent)
         self.query = query
-        self.results = results
+        self.results = list(results)
+        self.next_cursor = next_cursor
         self.setWindowTitle(f"Kết quả tìm kiếm cho: '{query}'")
         self.setMinimumSize(500, 600)
         self.init_ui()
@@ -31,29 +37,73 @@ class SearchResultDialog(QDialog):
         layout = QVBoxLayout(self)
         
         # Title
-        title_label = QLabel(f"{len(self.results)} kết quả được tìm thấy")
-        title_label.setFont(QFont("Arial", 12, QFont.Bold))
-        layout.addWidget(title_label)
+        self.title_label = QLabel()
+        self.title_label.setFont(QFont("Arial", 12, QFont.Bold))
+        layout.addWidget(self.title_label)
 
         # Results list
-        results_list = QListWidget()
+        self.results_list = QListWidget()
         if not self.results:
             no_result_item = QListWidgetItem("Không tìm thấy tin nhắn nào phù hợp.")
-            results_list.addItem(no_result_item)
+            self.results_list.addItem(no_result_item)
         else:
             for message in self.results:
-                item = QListWidgetItem()
-                item_widget = self.create_result_widget(message)
-                item.setSizeHint(item_widget.sizeHint())
-                results_list.addItem(item)
-                results_list.setItemWidget(item, item_widget)  # Fixed: correct order
+                self.add_result_item(message)
         
-        layout.addWidget(results_list)
+        layout.addWidget(self.results_list)
 
-        # Close button
+        # Load more / close buttons
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addStretch()
+        self.load_more_button = QPushButton("Tải thêm")
+        self.load_more_button.clicked.connect(self.request_more)
+        buttons_layout.addWidget(self.load_more_button)
         close_button = QPushButton("Đóng")
         close_button.clicked.connect(self.accept)
-        layout.addWidget(close_button, 0, Qt.AlignCenter)
+        buttons_layout.addWidget(close_button)
+        buttons_layout.addStretch()
+        layout.addLayout(buttons_layout)
+        self.update_status()
+
+    def add_result_item(self, message: Dict):
+        """
+        Append one result to the list.
+        
+        Args:
+            message: Message dictionary
+        """
+        item = QListWidgetItem()
+        item_widget = self.create_result_widget(message)
+        item.setSizeHint(item_widget.sizeHint())
+        self.results_list.addItem(item)
+        self.results_list.setItemWidget(item, item_widget)  # Fixed: correct order
+
+    def update_status(self):
+        """Refresh the result count and the load more button."""
+        suffix = "+" if self.next_cursor else ""
+        self.title_label.setText(f"{len(self.results)}{suffix} kết quả được tìm thấy")
+        self.load_more_button.setVisible(bool(self.next_cursor))
+        self.load_more_button.setEnabled(True)
+
+    def request_more(self):
+        """Ask for the next page of results."""
+        if self.next_cursor:
+            self.load_more_button.setEnabled(False)
+            self.load_more_requested.emit(self.query, self.next_cursor)
+
+    def append_results(self, results: List[Dict], next_cursor: Optional[str]):
+        """
+        Append the next page of results.
+        
+        Args:
+            results: List of message dictionaries
+            next_cursor: Cursor of the following page, None if there are no more results
+        """
+        for message in results:
+            self.results.append(message)
+            self.add_result_item(message)
+        self.next_cursor = next_cursor
+        self.update_status()
 
     def create_result_widget(self, message: Dict) -> QWidget:
         """
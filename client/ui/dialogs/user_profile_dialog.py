@@ -10,16 +10,18 @@ from PyQt5.QtGui import QFont, QPixmap, QPainter, QColor, QBrush, QIcon
 class UserProfileDialog(QDialog):
     """Dialog to display user profile information."""
     
-    def __init__(self, user_data: Dict, parent=None):
+    def __init__(self, user_data: Dict, parent=None, avatar_pixmap: Optional[QPixmap] = None):
         """
         Initialize user profile dialog.
         
         Args:
             user_data: Dictionary containing user data
             parent: Parent widget
+            avatar_pixmap: Decoded avatar (from AvatarManager), if available
         """
         super().__init__(parent)
         self.user_data = user_data
+        self.avatar_pixmap = avatar_pixmap
         self.setWindowTitle("Thông tin tài khoản")
         self.setFixedSize(350, 450)
         self.init_ui()
@@ -39,7 +41,7 @@ class UserProfileDialog(QDialog):
 
         avatar_label = QLabel()
         avatar_label.setFixedSize(100, 100)
-        avatar_pixmap = self.create_circular_avatar(self.user_data.get('avatar'), 100)
+        avatar_pixmap = self.create_circular_avatar(self.user_data.get('avatar'), 100, self.avatar_pixmap)
         avatar_label.setPixmap(avatar_pixmap)
         
         display_name_label = QLabel(self.user_data.get('display_name', 'N/A'))
@@ -97,25 +99,27 @@ class UserProfileDialog(QDialog):
         row_layout.addStretch()
         return row_layout
 
-    def create_circular_avatar(self, avatar_data: Optional[str], size: int) -> QPixmap:
+    def create_circular_avatar(self, avatar_data: Optional[str], size: int,
+                               pixmap: Optional[QPixmap] = None) -> QPixmap:
         """
         Create a circular avatar pixmap.
         
         Args:
             avatar_data: Base64 encoded avatar data
             size: Size of the avatar
+            pixmap: Already decoded avatar; takes precedence over avatar_data
             
         Returns:
             Circular pixmap of the avatar
         """
-        if avatar_data:
+        if pixmap is None and avatar_data:
             try:
                 image_data = base64.b64decode(avatar_data)
                 pixmap = QPixmap()
                 pixmap.loadFromData(image_data)
             except:
                 pixmap = self.create_default_avatar_pixmap(size)
-        else:
+        elif pixmap is None:
             pixmap = self.create_default_avatar_pixmap(size)
 
         scaled_pixmap = pixmap.scaled(size, size, Qt.KeepAspectRatioByExpanding, Qt.SmoothTransformation)
@@ -1,6 +1,6 @@
 """UI Widgets for the chat application."""
 from .clickable_frame import ClickableFrame
+from .attachment_image import AttachmentImageLabel
 from .chat_bubble import ChatBubble
 
-__all__ = ['ClickableFrame', 'ChatBubble']
-
+__all__ = ['ClickableFrame', 'AttachmentImageLabel', 'ChatBubble']
@@ -0,0 +1,111 @@
+"""AttachmentImageLabel widget - shows an image attachment fetched on demand."""
+import base64
+from typing import Dict, Optional
+
+from PyQt5.QtWidgets import QLabel
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QPixmap
+
+
+class AttachmentImageLabel(QLabel):
+    """
+    A QLabel that displays an image attachment once its contents arrive.
+
+    The smallest server preview that covers ``size`` is requested instead of
+    the original. While the server is still generating previews the label
+    waits for ``attachment_updated`` and falls back to the original after
+    ``PREVIEW_WAIT_MS``.
+    """
+
+    PREVIEW_WAIT_MS = 10000
+
+    def __init__(self, message_data: Dict, attachment_manager=None, size: int = 200,
+                 aspect_mode=Qt.KeepAspectRatio, fixed_size: bool = False, parent=None):
+        """
+        Initialize attachment image label.
+
+        Args:
+            message_data: Message dictionary carrying ``attachment`` metadata
+            attachment_manager: AttachmentManager used to fetch the contents
+            size: Bounding box (pixels) the image is scaled into
+            aspect_mode: Qt aspect ratio mode used for scaling
+            fixed_size: Whether the label is fixed to ``size`` x ``size``
+            parent: Parent widget
+        """
+        super().__init__(parent)
+        self.attachment = message_data.get('attachment') or {}
+        self.attachment_manager = attachment_manager
+        self.image_size = size
+        self.aspect_mode = aspect_mode
+        self.variant = 0
+        self._loaded = False
+        self.setAlignment(Qt.AlignCenter)
+        if fixed_size:
+            self.setFixedSize(size, size)
+        self.setText("🖼️ Đang tải ảnh...")
+
+        # Message cũ (hoặc tạo cục bộ) có thể vẫn mang dữ liệu inline
+        data = self._inline_data(message_data)
+        if data is not None:
+            self.set_image_data(data)
+        elif self.attachment_manager and self.attachment.get('id') is not None:
+            self.attachment_manager.attachment_ready.connect(self.on_attachment_ready)
+            self.attachment_manager.attachment_failed.connect(self.on_attachment_failed)
+            thumbnail = self.attachment.get('thumbnail') or {}
+            if thumbnail.get('pending') and not thumbnail.get('sizes'):
+                # Server đang tạo ảnh thu nhỏ: chờ thay vì tải ảnh gốc
+                self.attachment_manager.attachment_updated.connect(self.on_attachment_updated)
+                QTimer.singleShot(self.PREVIEW_WAIT_MS, self._load)
+            else:
+                self._load()
+
+    @staticmethod
+    def _inline_data(message_data: Dict) -> Optional[bytes]:
+        if not message_data.get('file_data'):
+            return None
+        try:
+            return base64.b64decode(message_data['file_data'])
+        except (ValueError, TypeError):
+            return None
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        self.variant = self.attachment_manager.preview_variant(self.attachment, self.image_size)
+        data = self.attachment_manager.request(self.attachment, self.variant)
+        if data is not None:
+            self.set_image_data(data)
+
+    def set_image_data(self, data: bytes):
+        """
+        Decode and display image bytes.
+
+        Args:
+            data: Encoded image bytes
+        """
+        pixmap = QPixmap()
+        pixmap.loadFromData(data)
+        if pixmap.isNull():
+            self.setText("⚠️ Không hiển thị được ảnh")
+            return
+        self.setPixmap(pixmap.scaled(self.image_size, self.image_size, self.aspect_mode,
+                                     Qt.SmoothTransformation))
+
+    def on_attachment_updated(self, message_id: int, attachment: Dict):
+        """Handle new attachment metadata (previews became available)."""
+        if message_id == self.attachment.get('id'):
+            self.attachment = attachment
+            self._load()
+
+    def on_attachment_ready(self, message_id: int, variant: int, data: bytes):
+        """Handle attachment contents arriving from the server."""
+        # Ảnh gốc luôn dùng được nếu server không có ảnh thu nhỏ phù hợp
+        if message_id == self.attachment.get('id') and variant in (self.variant, 0):
+            self.set_image_data(data)
+
+    def on_attachment_failed(self, message_id: int, error: str):
+        """Handle a failed attachment request."""
+        if message_id == self.attachment.get('id'):
+            self.setText("⚠️ Không tải được ảnh")
+            self.setToolTip(error)
@@ -13,12 +13,14 @@ from PyQt5.QtGui import QFont, QPixmap, QIcon, QFontMetrics
 
 from ...utils.resource_loader import resource_path
 from .clickable_frame import ClickableFrame
+from .attachment_image import AttachmentImageLabel
 
 
 class ChatBubble(QWidget):
     """Widget to display a single chat message bubble."""
     
-    def __init__(self, message_data: Dict, is_own_message: bool = False, parent=None):
+    def __init__(self, message_data: Dict, is_own_message: bool = False, parent=None,
+                 attachment_manager=None):
         """
         Initialize chat bubble.
         
@@ -26,10 +28,15 @@ class ChatBubble(QWidget):
             message_data: Dictionary containing message data
             is_own_message: Whether this is the current user's message
             parent: Parent widget
+            attachment_manager: AttachmentManager used to fetch attachment contents
         """
         super().__init__(parent)
         self.message_data = message_data
         self.is_own_message = is_own_message
+        self.attachment_manager = attachment_manager
+        # Đường dẫn file tạm cần mở khi download xong (open_file)
+        self._open_after_download: Optional[str] = None
+        self._manager_connected = False
         self.init_ui()
     
     def init_ui(self):
@@ -68,9 +75,10 @@ class ChatBubble(QWidget):
 
         # File/image content (if any)
         message_type = self.message_data.get('message_type', 'text')
-        if message_type == 'image' and self.message_data.get('file_data'):
+        has_attachment = bool(self.message_data.get('attachment') or self.message_data.get('file_data'))
+        if message_type == 'image' and has_attachment:
             self.add_image_content(message_layout)
-        elif message_type == 'file' and self.message_data.get('file_data'):
+        elif message_type == 'file' and has_attachment:
             self.add_file_content(message_layout)
 
         # Timestamp
@@ -96,22 +104,11 @@ class ChatBubble(QWidget):
         self.setLayout(layout)
     
     def add_image_content(self, layout: QVBoxLayout):
-        """Add image content to the message."""
+        """Add image content to the message (fetched on demand)."""
         try:
-            image_data = base64.b64decode(self.message_data['file_data'])
-            pixmap = QPixmap()
-            pixmap.loadFromData(image_data)
-            
-            # Scale image to fit
-            if not pixmap.isNull():
-                scaled_pixmap = pixmap.scaled(200, 200, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                
-                image_label = QLabel()
-                image_label.setPixmap(scaled_pixmap)
-                image_label.setAlignment(Qt.AlignCenter)
-                image_label.setStyleSheet("border: 1px solid #ddd; border-radius: 8px; margin: 5px;")
-                
-                layout.addWidget(image_label)
+            image_label = AttachmentImageLabel(self.message_data, self.attachment_manager, size=200)
+            image_label.setStyleSheet("border: 1px solid #ddd; border-radius: 8px; margin: 5px;")
+            layout.addWidget(image_label)
         except Exception as e:
             print(f"Error displaying image: {e}")
     
@@ -191,35 +188,76 @@ class ChatBubble(QWidget):
         
         layout.addWidget(file_frame)
         
+    def _attachment(self) -> Dict:
+        """Attachment metadata, falling back to the legacy top-level fields."""
+        return self.message_data.get('attachment') or {
+            'id': self.message_data.get('id'),
+            'name': self.message_data.get('file_name'),
+            'size': self.message_data.get('file_size'),
+        }
+
+    def _inline_file_data(self) -> Optional[bytes]:
+        if self.message_data.get('file_data'):
+            return base64.b64decode(self.message_data['file_data'])
+        return None
+
+    def _connect_manager(self):
+        """Listen for download results of this bubble's attachment."""
+        if self._manager_connected:
+            return
+        self.attachment_manager.download_finished.connect(self.on_download_finished)
+        self.attachment_manager.attachment_failed.connect(self.on_download_failed)
+        self._manager_connected = True
+
+    def _save_attachment(self, save_path: str) -> bool:
+        """
+        Write the attachment to ``save_path``.
+
+        Returns:
+            True if the file is already written, False if a download was started
+        """
+        file_data = self._inline_file_data()
+        if file_data is not None or not self.attachment_manager:
+            if file_data is None:
+                raise ValueError("Không có dữ liệu file")
+            with open(save_path, 'wb') as f:
+                f.write(file_data)
+            return True
+        self._connect_manager()
+        return self.attachment_manager.save_to(self._attachment(), save_path)
+
     def open_file(self):
-        """Open file with default application."""
+        """Open file with default application (downloaded on first open)."""
         try:
-            file_data = base64.b64decode(self.message_data['file_data'])
-            file_name = self.message_data.get('file_name', 'download')
+            file_name = os.path.basename(self.message_data.get('file_name') or 'download')
             
             # Save file to temp directory
             temp_dir = os.path.join(os.path.expanduser("~"), "Downloads", "ChatLAN_Temp")
             os.makedirs(temp_dir, exist_ok=True)
             temp_path = os.path.join(temp_dir, file_name)
 
-            with open(temp_path, 'wb') as f:
-                f.write(file_data)
-
-            # Open file with default application
-            if sys.platform == "win32":
-                os.startfile(temp_path)
-            elif sys.platform == "darwin":
-                subprocess.Popen(['open', temp_path])
+            if os.path.exists(temp_path) and os.path.getsize(temp_path) == self._attachment().get('size'):
+                self._launch(temp_path)
+            elif self._save_attachment(temp_path):
+                self._launch(temp_path)
             else:
-                subprocess.Popen(['xdg-open', temp_path])
+                self._open_after_download = temp_path
 
         except Exception as e:
             QMessageBox.critical(self, "Lỗi", f"Không thể mở file: {str(e)}")
 
+    def _launch(self, path: str):
+        """Open a local file with the default application."""
+        if sys.platform == "win32":
+            os.startfile(path)
+        elif sys.platform == "darwin":
+            subprocess.Popen(['open', path])
+        else:
+            subprocess.Popen(['xdg-open', path])
+
     def download_file(self):
-        """Download file."""
+        """Download file (fetched from the server when not cached)."""
         try:
-            file_data = base64.b64decode(self.message_data['file_data'])
             file_name = self.message_data.get('file_name', 'download')
             
             save_path, _ = QFileDialog.getSaveFileName(
@@ -229,14 +267,31 @@ class ChatBubble(QWidget):
                 "All Files (*)"
             )
             
-            if save_path:
-                with open(save_path, 'wb') as f:
-                    f.write(file_data)
-                
+            if save_path and self._save_attachment(save_path):
                 QMessageBox.information(self, "Thành công", f"File đã được lưu tại:\n{save_path}")
                 
         except Exception as e:
             QMessageBox.critical(self, "Lỗi", f"Không thể tải file: {str(e)}")
+
+    def on_download_finished(self, message_id: int, save_path: str):
+        """Handle completion of a download started by this bubble."""
+        if message_id != self._attachment().get('id'):
+            return
+        if self._open_after_download:
+            path, self._open_after_download = self._open_after_download, None
+            try:
+                self._launch(path)
+            except Exception as e:
+                QMessageBox.critical(self, "Lỗi", f"Không thể mở file: {str(e)}")
+        else:
+            QMessageBox.information(self, "Thành công", f"File đã được lưu tại:\n{save_path}")
+
+    def on_download_failed(self, message_id: int, error: str):
+        """Handle a failed download of this bubble's attachment."""
+        if message_id != self._attachment().get('id') or not self._manager_connected:
+            return
+        self._open_after_download = None
+        QMessageBox.critical(self, "Lỗi", f"Không thể tải file: {error}")
     
     def format_timestamp(self, timestamp_str: str) -> str:
         """Format timestamp accurately."""
@@ -1,5 +1,5 @@
 """Utility functions for the client application."""
 from .resource_loader import resource_path
+from .cache_paths import cache_dir, read_cached, write_cached
 
-__all__ = ['resource_path']
-
+__all__ = ['resource_path', 'cache_dir', 'read_cached', 'write_cached']
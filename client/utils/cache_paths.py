@@ -0,0 +1,96 @@
+"""Local cache directory utilities."""
+import hashlib
+import os
+import re
+from typing import Optional
+
+_SHA256_HEX = re.compile(r'^[0-9a-f]{64}$')
+
+
+def cache_dir(name: str) -> str:
+    """
+    Lấy (và tạo nếu chưa có) thư mục cache cục bộ của client.
+
+    Args:
+        name: Tên thư mục con, ví dụ ``attachments``
+
+    Returns:
+        Đường dẫn tuyệt đối đến ``~/.chatlan/cache/<name>``
+    """
+    path = os.path.join(os.path.expanduser("~"), ".chatlan", "cache", name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cached_file_path(directory: str, file_hash: str, variant: int = 0) -> Optional[str]:
+    """
+    Đường dẫn của một file trong cache đánh địa chỉ theo SHA-256.
+
+    Args:
+        directory: Thư mục cache
+        file_hash: SHA-256 (hex) của nội dung gốc
+        variant: Kích thước ảnh thu nhỏ (px), 0 cho nội dung gốc
+
+    Returns:
+        ``<directory>/<hash[:2]>/<hash>`` (hoặc ``<hash>.<variant>``), None nếu hash không hợp lệ
+    """
+    if not _SHA256_HEX.match(file_hash or ''):
+        return None
+    name = f"{file_hash}.{int(variant)}" if variant else file_hash
+    return os.path.join(directory, file_hash[:2], name)
+
+
+def read_cached(directory: str, file_hash: str, variant: int = 0) -> Optional[bytes]:
+    """
+    Đọc nội dung đã cache theo hash.
+
+    Args:
+        directory: Thư mục cache
+        file_hash: SHA-256 (hex) của nội dung gốc
+        variant: Kích thước ảnh thu nhỏ (px), 0 cho nội dung gốc
+
+    Returns:
+        Nội dung file, hoặc None nếu chưa có trong cache
+    """
+    path = cached_file_path(directory, file_hash, variant)
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def write_cached(directory: str, file_hash: str, data: bytes, variant: int = 0) -> bool:
+    """
+    Ghi nội dung vào cache sau khi kiểm tra hash.
+
+    Args:
+        directory: Thư mục cache
+        file_hash: SHA-256 (hex) mà server công bố cho nội dung gốc
+        data: Nội dung cần ghi
+        variant: Kích thước ảnh thu nhỏ (px), 0 cho nội dung gốc
+
+    Returns:
+        True nếu nội dung đã có (hoặc vừa được ghi) trong cache
+    """
+    path = cached_file_path(directory, file_hash, variant)
+    if not path:
+        return False
+    if os.path.exists(path):
+        return True
+    # Ảnh thu nhỏ do server tạo nên không có hash riêng để kiểm tra
+    if not variant and hashlib.sha256(data).hexdigest() != file_hash:
+        print(f"DEBUG: Cache hash mismatch, not caching {file_hash}")
+        return False
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        print(f"DEBUG: Cannot write cache file: {e}")
+        return False
@@ -0,0 +1,11 @@
+"""Code dùng chung giữa client và server (wire protocol, tiện ích)."""
+from .protocol import (
+    FrameDecoder, Frame, ProtocolError, encode_frame, encode_json, decode_json, pack_frame,
+    encode_chunk, decode_chunk
+)
+from .text import search_key
+
+__all__ = [
+    'FrameDecoder', 'Frame', 'ProtocolError', 'encode_frame', 'encode_json', 'decode_json', 'pack_frame',
+    'encode_chunk', 'decode_chunk', 'search_key'
+]
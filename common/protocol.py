@@ -0,0 +1,238 @@
+"""
+Wire protocol dùng chung cho client và server ChatLAN.
+
+Mỗi gói tin được đóng khung (frame) bởi một header cố định 8 byte:
+
+    +--------+---------+-------+----------------+
+    | magic  | version | flags | payload length |
+    | 2 byte | 1 byte  | 1 byte| 4 byte (BE)    |
+    +--------+---------+-------+----------------+
+
+Payload mặc định là JSON mã hóa UTF-8. Bộ giải mã làm việc trực tiếp trên
+``bytearray`` nên mỗi byte nhận được chỉ được xử lý một lần (O(n)), thay cho
+cách quét ngoặc nhọn trên toàn bộ buffer sau mỗi lần ``recv()``.
+
+Client cũ (gửi JSON trần, phân tách bằng ngoặc nhọn) vẫn được chấp nhận trong
+giai đoạn chuyển đổi: byte đầu tiên của kết nối quyết định chế độ.
+"""
+import json
+import re
+import struct
+from typing import List, NamedTuple, Optional, Tuple
+
+MAGIC = b'CL'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('!2sBBI')
+HEADER_SIZE = HEADER.size
+
+# Không có cờ nào được bật: payload là một đối tượng JSON
+FLAG_NONE = 0x00
+# Payload là dữ liệu nhị phân (chunk file), bắt đầu bằng CHUNK_HEADER
+FLAG_BINARY = 0x01
+
+# Header của một chunk nhị phân: transfer id (UUID, 16 byte) và offset (8 byte)
+CHUNK_HEADER = struct.Struct('!16sQ')
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Giới hạn kích thước payload để tránh client gửi độ dài rác làm cạn bộ nhớ
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+# Các ký tự có ý nghĩa khi quét JSON trần của client cũ
+_LEGACY_TOKENS = re.compile(rb'[{}"\\]')
+_WHITESPACE = b' \t\r\n'
+
+
+class ProtocolError(Exception):
+    """Dữ liệu nhận được không tuân theo wire protocol."""
+
+
+class Frame(NamedTuple):
+    flags: int
+    payload: bytes
+
+    @property
+    def is_binary(self) -> bool:
+        return bool(self.flags & FLAG_BINARY)
+
+
+def pack_frame(payload: bytes, flags: int = FLAG_NONE) -> bytes:
+    """Ghép header và payload thành một frame hoàn chỉnh."""
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Payload quá lớn: {len(payload)} bytes")
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, flags, len(payload)) + payload
+
+
+def encode_json(message: dict) -> bytes:
+    """Mã hóa một gói tin JSON thành bytes UTF-8."""
+    return json.dumps(message, ensure_ascii=False).encode('utf-8')
+
+
+def encode_frame(message: dict, flags: int = FLAG_NONE) -> bytes:
+    """Mã hóa một gói tin JSON thành frame sẵn sàng gửi đi."""
+    return pack_frame(encode_json(message), flags)
+
+
+def decode_json(payload: bytes) -> dict:
+    """Giải mã payload JSON của một frame."""
+    return json.loads(payload)
+
+
+def encode_chunk(transfer_id: str, offset: int, data: bytes) -> bytes:
+    """Đóng gói một chunk nhị phân của upload/download thành frame."""
+    try:
+        raw_id = bytes.fromhex(transfer_id)
+    except ValueError:
+        raise ProtocolError(f"Transfer id không hợp lệ: {transfer_id!r}")
+    if len(raw_id) != 16:
+        raise ProtocolError(f"Transfer id không hợp lệ: {transfer_id!r}")
+    return pack_frame(CHUNK_HEADER.pack(raw_id, offset) + data, FLAG_BINARY)
+
+
+def decode_chunk(payload: bytes) -> Tuple[str, int, memoryview]:
+    """Tách transfer id, offset và dữ liệu từ payload của một frame nhị phân."""
+    if len(payload) < CHUNK_HEADER.size:
+        raise ProtocolError("Chunk nhị phân thiếu header")
+    raw_id, offset = CHUNK_HEADER.unpack_from(payload)
+    return raw_id.hex(), offset, memoryview(payload)[CHUNK_HEADER.size:]
+
+
+class FrameDecoder:
+    """
+    Bộ giải mã frame tăng dần cho một kết nối.
+
+    Gọi ``feed()`` với mỗi khối dữ liệu nhận được; hàm trả về danh sách các
+    frame đã hoàn chỉnh. Dữ liệu dở dang được giữ lại cho lần gọi sau.
+    """
+
+    def __init__(self, allow_legacy: bool = False, max_payload: int = MAX_PAYLOAD_SIZE):
+        self.allow_legacy = allow_legacy
+        self.max_payload = max_payload
+        self._buffer = bytearray()
+        self._offset = 0
+        # None: chưa xác định, True: JSON trần (client cũ), False: frame có header
+        self._legacy: Optional[bool] = None
+        # Trạng thái quét JSON trần, giữ lại giữa các lần feed()
+        self._scan_pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._start = -1
+
+    @property
+    def is_legacy(self) -> Optional[bool]:
+        """Kết nối có đang dùng định dạng JSON trần của client cũ không."""
+        return self._legacy
+
+    @property
+    def buffered_bytes(self) -> int:
+        """Số byte đang chờ trong buffer."""
+        return len(self._buffer) - self._offset
+
+    def feed(self, data) -> List[Frame]:
+        """Nạp dữ liệu mới (bytes, bytearray hoặc memoryview) và trả về các frame hoàn chỉnh."""
+        if data:
+            self._buffer += data
+        if self._legacy is None and not self._detect_mode():
+            return []
+        frames = self._read_legacy() if self._legacy else self._read_framed()
+        self._compact()
+        return frames
+
+    def _detect_mode(self) -> bool:
+        buf = self._buffer
+        pos = self._offset
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+        self._offset = pos
+        if pos >= len(buf):
+            return False
+        if buf[pos] == ord('{'):
+            if not self.allow_legacy:
+                raise ProtocolError("Client gửi JSON không có header nhưng chế độ tương thích đã tắt")
+            self._legacy = True
+            self._scan_pos = pos
+            return True
+        if len(buf) - pos < len(MAGIC):
+            return False
+        if bytes(buf[pos:pos + len(MAGIC)]) != MAGIC:
+            raise ProtocolError("Magic không hợp lệ ở đầu kết nối")
+        self._legacy = False
+        return True
+
+    def _read_framed(self) -> List[Frame]:
+        frames = []
+        buf = self._buffer
+        view = memoryview(buf)
+        try:
+            while len(buf) - self._offset >= HEADER_SIZE:
+                magic, version, flags, length = HEADER.unpack_from(buf, self._offset)
+                if magic != MAGIC:
+                    raise ProtocolError("Magic không hợp lệ")
+                if version != PROTOCOL_VERSION:
+                    raise ProtocolError(f"Phiên bản protocol không được hỗ trợ: {version}")
+                if length > self.max_payload:
+                    raise ProtocolError(f"Payload quá lớn: {length} bytes")
+                end = self._offset + HEADER_SIZE + length
+                if len(buf) < end:
+                    break
+                frames.append(Frame(flags, bytes(view[self._offset + HEADER_SIZE:end])))
+                self._offset = end
+        finally:
+            view.release()
+        return frames
+
+    def _read_legacy(self) -> List[Frame]:
+        """Tách các đối tượng JSON trần; mỗi byte chỉ được quét một lần."""
+        frames = []
+        buf = self._buffer
+        pos = max(self._scan_pos, self._offset)
+        while True:
+            if self._start < 0:
+                # Bỏ qua dữ liệu rác giữa các đối tượng JSON
+                next_open = buf.find(b'{', pos)
+                if next_open == -1:
+                    self._offset = len(buf)
+                    pos = len(buf)
+                    break
+                self._start = next_open
+                self._depth = 0
+                self._in_string = False
+                pos = next_open
+            match = _LEGACY_TOKENS.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            token = buf[match.start()]
+            pos = match.end()
+            if self._in_string:
+                if token == ord('\\'):
+                    # Bỏ qua ký tự được escape; nếu chưa nhận đủ thì quét lại sau
+                    if pos >= len(buf):
+                        pos = match.start()
+                        break
+                    pos += 1
+                elif token == ord('"'):
+                    self._in_string = False
+            elif token == ord('"'):
+                self._in_string = True
+            elif token == ord('{'):
+                self._depth += 1
+            elif token == ord('}'):
+                self._depth -= 1
+                if self._depth == 0:
+                    frames.append(Frame(FLAG_NONE, bytes(buf[self._start:pos])))
+                    self._offset = pos
+                    self._start = -1
+        self._scan_pos = pos
+        return frames
+
+    def _compact(self):
+        # Chỉ dịch buffer một lần sau mỗi feed() thay vì sau mỗi frame
+        consumed = self._offset
+        if self._legacy and self._start >= 0:
+            consumed = min(consumed, self._start)
+        if consumed:
+            del self._buffer[:consumed]
+            self._offset -= consumed
+            self._scan_pos = max(0, self._scan_pos - consumed)
+            if self._start >= 0:
+                self._start -= consumed
@@ -0,0 +1,23 @@
+"""
+Chuẩn hóa văn bản cho tìm kiếm, dùng chung cho client và server.
+
+Người dùng thường gõ tiếng Việt không dấu ("thong bao" cho "thông báo"). Khóa
+tìm kiếm bỏ dấu, chuyển chữ thường và gộp khoảng trắng; server lưu sẵn khóa
+này cho mỗi tin nhắn khi ghi, client dùng cùng hàm để lọc danh bạ, nên không
+cần ``unaccent()`` hay so sánh có dấu lúc tìm.
+"""
+import re
+import unicodedata
+
+# "đ" không phải chữ "d" kèm dấu nên NFD không tách được
+_LETTER_MAP = str.maketrans({"đ": "d", "Đ": "d"})
+_SPACES = re.compile(r"\s+")
+
+
+def search_key(text: str) -> str:
+    """Khóa tìm kiếm của ``text``: ``"Thông  BÁO Đà Nẵng"`` -> ``"thong bao da nang"``."""
+    if not text:
+        return ""
+    decomposed = unicodedata.normalize("NFD", text.translate(_LETTER_MAP))
+    stripped = "".join(char for char in decomposed if unicodedata.category(char) != "Mn")
+    return _SPACES.sub(" ", unicodedata.normalize("NFC", stripped).casefold()).strip()
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 import signal
@@ -13,7 +14,25 @@ def load_server_config(config_path: str = "server_config.ini") -> Dict[str, Any]
     """
     defaults = {
         "host": "0.0.0.0",
-        "port": 12345
+        "port": 12345,
+        "accept_legacy_clients": True,
+        "mode": "threaded",
+        "backlog": 128,
+        "executor_workers": 16,
+        "send_queue_high_watermark_kb": 1024,
+        "send_queue_low_watermark_kb": 256,
+        "send_queue_max_kb": 32768,
+        "slow_consumer_timeout": 30.0,
+        "upload_dir": "uploads",
+        "max_upload_mb": 10,
+        "upload_resume_ttl_minutes": 60,
+        "blob_dir": "blobs",
+        "thumbnail_workers": 2,
+        "ingest_journal": "ingest.journal",
+        "ingest_batch_size": 100,
+        "ingest_flush_ms": 50,
+        "ingest_fsync": True,
+        "log_stats": False
     }
     
     config = configparser.ConfigParser()
@@ -24,7 +43,30 @@ def load_server_config(config_path: str = "server_config.ini") -> Dict[str, Any]
                 server_config = config['Server']
                 return {
                     "host": server_config.get('host', defaults['host']),
-                    "port": int(server_config.get('port', defaults['port']))
+                    "port": int(server_config.get('port', defaults['port'])),
+                    "accept_legacy_clients": server_config.getboolean(
+                        'accept_legacy_clients', defaults['accept_legacy_clients']),
+                    "mode": server_config.get('mode', defaults['mode']).strip().lower(),
+                    "backlog": server_config.getint('backlog', defaults['backlog']),
+                    "executor_workers": server_config.getint('executor_workers', defaults['executor_workers']),
+                    "send_queue_high_watermark_kb": server_config.getint(
+                        'send_queue_high_watermark_kb', defaults['send_queue_high_watermark_kb']),
+                    "send_queue_low_watermark_kb": server_config.getint(
+                        'send_queue_low_watermark_kb', defaults['send_queue_low_watermark_kb']),
+                    "send_queue_max_kb": server_config.getint('send_queue_max_kb', defaults['send_queue_max_kb']),
+                    "slow_consumer_timeout": server_config.getfloat(
+                        'slow_consumer_timeout', defaults['slow_consumer_timeout']),
+                    "upload_dir": server_config.get('upload_dir', defaults['upload_dir']),
+                    "max_upload_mb": server_config.getint('max_upload_mb', defaults['max_upload_mb']),
+                    "upload_resume_ttl_minutes": server_config.getint(
+                        'upload_resume_ttl_minutes', defaults['upload_resume_ttl_minutes']),
+                    "blob_dir": server_config.get('blob_dir', defaults['blob_dir']),
+                    "thumbnail_workers": server_config.getint('thumbnail_workers', defaults['thumbnail_workers']),
+                    "ingest_journal": server_config.get('ingest_journal', defaults['ingest_journal']),
+                    "ingest_batch_size": server_config.getint('ingest_batch_size', defaults['ingest_batch_size']),
+                    "ingest_flush_ms": server_config.getint('ingest_flush_ms', defaults['ingest_flush_ms']),
+                    "ingest_fsync": server_config.getboolean('ingest_fsync', defaults['ingest_fsync']),
+                    "log_stats": server_config.getboolean('log_stats', defaults['log_stats'])
                 }
         except Exception as e:
             print(f"⚠️ Lỗi đọc config file {config_path}: {e}. Sử dụng giá trị mặc định.")
@@ -79,23 +121,75 @@ def main():
         input("\nNhấn Enter để thoát...")
         return 1    
     try:
-        # Import server
-        from server.server import ChatServer
-        
         # Đọc cấu hình từ file
         server_config = load_server_config()
         SERVER_HOST = server_config["host"]
         SERVER_PORT = server_config["port"]
+        SERVER_MODE = server_config["mode"]
+        if SERVER_MODE not in ("threaded", "asyncio"):
+            print(f"⚠️ Chế độ server không hợp lệ '{SERVER_MODE}', dùng 'threaded'.")
+            SERVER_MODE = "threaded"
         
         print("📋 Thông tin Server:")
         print(f"   - Host: {SERVER_HOST}")
         print(f"   - Port: {SERVER_PORT}")
-        print("   - Protocol: TCP Socket")
-        print("   - Database: PostGreSQL")
+        print(f"   - Mode: {SERVER_MODE} (backlog {server_config['backlog']})")
+        print("   - Protocol: TCP Socket (framed v1)")
+        print(f"   - Legacy JSON clients: {'accepted' if server_config['accept_legacy_clients'] else 'rejected'}")
+        print(f"   - Uploads: {server_config['upload_dir']} (tối đa {server_config['max_upload_mb']}MB)")
+        print(f"   - Blob store: {server_config['blob_dir']}")
+        print(f"   - Ghi tin nhắn theo lô: {server_config['ingest_batch_size']} tin / "
+              f"{server_config['ingest_flush_ms']}ms, journal {server_config['ingest_journal']}")
+        from server.database import DB_BACKEND, DB_POOL_OPTIONS, DATABASE_URL, SQLITE_OPTIONS
+        if DB_BACKEND == "sqlite":
+            print(f"   - Database: SQLite WAL {DATABASE_URL[len('sqlite:///'):]} "
+                  f"(busy timeout {SQLITE_OPTIONS['busy_timeout_ms']}ms, synchronous {SQLITE_OPTIONS['synchronous']})")
+        else:
+            print("   - Database: PostGreSQL")
+        print(f"   - DB pool: {DB_POOL_OPTIONS['pool_size']} (+{DB_POOL_OPTIONS['max_overflow']} overflow, "
+              f"timeout {DB_POOL_OPTIONS['pool_timeout']}s, mở sẵn {DB_POOL_OPTIONS['pool_prewarm']})")
         print("   - Features: Authentication, File Upload, Real-time Chat")
         print("=" * 60)        
+        send_queue_options = {
+            "high_watermark": server_config["send_queue_high_watermark_kb"] * 1024,
+            "low_watermark": server_config["send_queue_low_watermark_kb"] * 1024,
+            "max_queued_bytes": server_config["send_queue_max_kb"] * 1024,
+            "stall_timeout": server_config["slow_consumer_timeout"]
+        }
         # Create server
-        server = ChatServer(host=SERVER_HOST, port=SERVER_PORT)        
+        if SERVER_MODE == "asyncio":
+            from server.async_server import AsyncChatServer
+            server = AsyncChatServer(host=SERVER_HOST, port=SERVER_PORT,
+                                     accept_legacy_clients=server_config["accept_legacy_clients"],
+                                     backlog=server_config["backlog"],
+                                     executor_workers=server_config["executor_workers"],
+                                     send_queue_options=send_queue_options,
+                                     upload_dir=server_config["upload_dir"],
+                                     max_upload_size=server_config["max_upload_mb"] * 1024 * 1024,
+                                     upload_resume_ttl=server_config["upload_resume_ttl_minutes"] * 60,
+                                     blob_dir=server_config["blob_dir"],
+                                     thumbnail_workers=server_config["thumbnail_workers"],
+                                     ingest_journal=server_config["ingest_journal"],
+                                     ingest_batch_size=server_config["ingest_batch_size"],
+                                     ingest_flush_ms=server_config["ingest_flush_ms"],
+                                     ingest_fsync=server_config["ingest_fsync"],
+                                     log_stats=server_config["log_stats"])
+        else:
+            from server.server import ChatServer
+            server = ChatServer(host=SERVER_HOST, port=SERVER_PORT,
+                                accept_legacy_clients=server_config["accept_legacy_clients"],
+                                backlog=server_config["backlog"],
+                                send_queue_options=send_queue_options,
+                                upload_dir=server_config["upload_dir"],
+                                max_upload_size=server_config["max_upload_mb"] * 1024 * 1024,
+                                upload_resume_ttl=server_config["upload_resume_ttl_minutes"] * 60,
+                                blob_dir=server_config["blob_dir"],
+                                thumbnail_workers=server_config["thumbnail_workers"],
+                                ingest_journal=server_config["ingest_journal"],
+                                ingest_batch_size=server_config["ingest_batch_size"],
+                                ingest_flush_ms=server_config["ingest_flush_ms"],
+                                ingest_fsync=server_config["ingest_fsync"],
+                                log_stats=server_config["log_stats"])        
         # Handle Ctrl+C gracefully
         def signal_handler(sig, frame):
             print("\n🛑 Nhận tín hiệu dừng server...")
@@ -121,4 +215,6 @@ def main():
         return 1
 
 if __name__ == "__main__":
+    # Cần cho process pool tạo ảnh thu nhỏ khi chạy bản đóng gói PyInstaller
+    multiprocessing.freeze_support()
     sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,214 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from common.protocol import FrameDecoder, ProtocolError
+from .connection import ClientConnection
+from .server import ChatServer
+
+try:
+    import resource
+except ImportError:  # Windows không có module resource
+    resource = None
+
+
+class AsyncClientConnection(ClientConnection):
+    """
+    ClientConnection cho chế độ asyncio.
+
+    Hàng đợi và chính sách backpressure giống chế độ threaded; writer là một
+    coroutine trên event loop, ghi qua StreamWriter và chờ ``drain()``.
+    Các handler trên thread của executor vẫn chỉ gọi ``send()``.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter, address, **options):
+        super().__init__(writer.get_extra_info('socket'), address, **options)
+        self._loop = loop
+        self._writer = writer
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        # Được gọi từ event loop
+        self._task = self._loop.create_task(self._drain())
+
+    def _notify(self):
+        try:
+            self._loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            pass  # Event loop đã đóng
+
+    async def _drain(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while True:
+                with self._lock:
+                    if self.closed:
+                        return
+                    data = self._next_chunk()
+                if data is None:
+                    break
+                try:
+                    self._writer.write(data)
+                    await self._writer.drain()
+                except (ConnectionError, OSError) as e:
+                    print(f"❌ Lỗi khi gửi tin nhắn đến {self.address}: {e}")
+                    self.close()
+                    return
+                self._on_sent(len(data))
+
+    def _close_transport(self):
+        # abort() thay vì close(): close() chờ gửi hết buffer, điều không bao giờ
+        # xảy ra với một client đã ngừng nhận
+        try:
+            self._loop.call_soon_threadsafe(self._writer.transport.abort)
+        except RuntimeError:
+            pass  # Event loop đã đóng
+
+
+class AsyncChatServer(ChatServer):
+    """
+    Server dùng asyncio thay cho một thread cho mỗi kết nối.
+
+    Mỗi kết nối chỉ tốn một coroutine khi rảnh. Các gói tin vẫn được xử lý bởi
+    ``_process_message`` như chế độ threaded, nhưng chạy trên một thread pool
+    giới hạn vì các lời gọi SQLAlchemy là blocking. Gói tin của cùng một kết
+    nối được xử lý tuần tự theo thứ tự nhận.
+    """
+
+    def __init__(self, host='192.168.1.10', port=12345, accept_legacy_clients: bool = True,
+                 backlog: int = 1024, executor_workers: int = 16,
+                 send_queue_options: Optional[Dict[str, float]] = None,
+                 upload_dir: str = "uploads", max_upload_size: int = 10 * 1024 * 1024,
+                 upload_resume_ttl: float = 3600, blob_dir: str = "blobs", thumbnail_workers: int = 2,
+                 db_pool_options: Optional[Dict[str, int]] = None, ingest_journal: str = "ingest.journal",
+                 ingest_batch_size: int = 100, ingest_flush_ms: int = 50, ingest_fsync: bool = True,
+                 log_stats: bool = False):
+        super().__init__(host, port, accept_legacy_clients=accept_legacy_clients, backlog=backlog,
+                         send_queue_options=send_queue_options, upload_dir=upload_dir,
+                         max_upload_size=max_upload_size, upload_resume_ttl=upload_resume_ttl,
+                         blob_dir=blob_dir, thumbnail_workers=thumbnail_workers,
+                         db_pool_options=db_pool_options, ingest_journal=ingest_journal,
+                         ingest_batch_size=ingest_batch_size, ingest_flush_ms=ingest_flush_ms,
+                         ingest_fsync=ingest_fsync, log_stats=log_stats)
+        self.executor_workers = executor_workers
+        pool_capacity = self.db.pool_options["pool_size"] + self.db.pool_options["max_overflow"]
+        if executor_workers > pool_capacity:
+            # Worker thừa sẽ phải chờ kết nối (tối đa pool_timeout giây) thay vì chạy song song
+            print(f"⚠️ executor_workers ({executor_workers}) lớn hơn pool_size + max_overflow "
+                  f"({pool_capacity}) của database")
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def start(self):
+        """Khởi động server asyncio"""
+        try:
+            asyncio.run(self._serve())
+        except Exception as e:
+            print(f"❌ Failed to start server: {e}")
+        finally:
+            self.stop()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_workers,
+                                           thread_name_prefix='chat-db')
+        self._raise_open_file_limit()
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+        self._server = await asyncio.start_server(self._handle_stream, sock=self.socket)
+        self.running = True
+        print("✅ Server started successfully! (asyncio mode)")
+        print(f"🌐 Listening on {self.host}:{self.port} (backlog {self.backlog})")
+        print(f"🧵 DB executor: {self.executor_workers} workers")
+        print("📊 Database ready")
+        print("=" * 50)
+        cleanup_thread = threading.Thread(target=self._cleanup_thread, daemon=True)
+        cleanup_thread.start()
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        """Dừng server"""
+        self._close_listener()
+        super().stop()
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+    def _close_listener(self):
+        """Đóng socket lắng nghe trên event loop trước khi ChatServer.stop() đóng socket."""
+        if not (self.loop and self._server):
+            return
+        try:
+            on_loop_thread = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop_thread = False
+        if on_loop_thread:
+            self._server.close()
+        elif self.loop.is_running():
+            try:
+                self.loop.call_soon_threadsafe(self._server.close)
+                # Chờ event loop thực hiện close() xong
+                asyncio.run_coroutine_threadsafe(asyncio.sleep(0), self.loop).result(timeout=5)
+            except Exception:
+                pass
+
+    async def _handle_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Xử lý một kết nối: đọc frame và chuyển từng gói tin sang executor."""
+        address = writer.get_extra_info('peername')
+        connection = AsyncClientConnection(self.loop, writer, address, **self.send_queue_options)
+        connection.start()
+        decoder = FrameDecoder(allow_legacy=self.accept_legacy_clients)
+        user_id = None
+        print(f"🔗 New connection from {address}")
+        try:
+            while self.running:
+                data = await reader.read(self.RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                frames = decoder.feed(data)
+                connection.legacy = bool(decoder.is_legacy)
+                for frame in frames:
+                    logged_in_user = await self.loop.run_in_executor(
+                        self.executor, self._handle_frame, frame, connection, address)
+                    if logged_in_user:
+                        user_id = logged_in_user
+        except ProtocolError as e:
+            print(f"Lỗi protocol từ client {address}: {e}")
+        except (ConnectionResetError, BrokenPipeError):
+            pass  # Client ngắt kết nối đột ngột
+        except asyncio.CancelledError:
+            pass  # Server đang dừng
+        except Exception as e:
+            if self.running:
+                print(f"Lỗi xử lý client {address}: {e}")
+        finally:
+            if user_id:
+                try:
+                    await self.loop.run_in_executor(self.executor, self._handle_disconnect, user_id, connection)
+                except (RuntimeError, asyncio.CancelledError):
+                    pass  # Executor đã tắt khi server dừng
+                except Exception as e:
+                    print(f"Lỗi khi xử lý ngắt kết nối của user {user_id}: {e}")
+            connection.close()
+            print(f"🔌 Client {address} đã ngắt kết nối")
+
+    @staticmethod
+    def _raise_open_file_limit():
+        """Nâng giới hạn file descriptor lên mức tối đa cho phép (chỉ trên POSIX)."""
+        if resource is None:
+            return
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            target = hard if hard != resource.RLIM_INFINITY else 65536
+            if target > soft:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+                print(f"📂 Open file limit: {soft} -> {target}")
+        except (ValueError, OSError) as e:
+            print(f"⚠️ Không thể nâng giới hạn file descriptor: {e}")
@@ -0,0 +1,71 @@
+"""
+Điền khóa tìm kiếm không dấu (messages.search_key) cho các tin nhắn được ghi
+trước khi có cột này.
+
+Chạy một lần từ thư mục gốc của project (server có thể vẫn đang chạy):
+
+    python -m server.backfill_search_keys [--batch-size 1000] [--pause-ms 0]
+
+Mỗi lô được commit riêng và đi theo khóa chính nên có thể dừng và chạy lại
+bất cứ lúc nào; tin nhắn đã có khóa sẽ được bỏ qua. Tin nhắn mới được server
+tính khóa ngay khi ghi.
+"""
+import argparse
+import sys
+import time
+
+from sqlalchemy import bindparam, update
+
+from common.text import search_key
+from .database import DATABASE_URL, DatabaseManager
+from .models import Message
+
+
+def backfill(manager: DatabaseManager, batch_size: int, pause_ms: int = 0) -> int:
+    db = manager.db
+    statement = update(Message).where(Message.id == bindparam("message_id")).values(
+        search_key=bindparam("key"))
+    filled = 0
+    last_id = 0
+    while True:
+        # Đi theo khóa chính: mỗi lô là một lần quét đoạn index, không lặp lại dòng đã xét
+        rows = db.query(Message.id, Message.content).filter(
+            Message.id > last_id, Message.search_key.is_(None)
+        ).order_by(Message.id).limit(batch_size).all()
+        if not rows:
+            break
+        db.connection().execute(statement, [{"message_id": message_id, "key": search_key(content)}
+                                            for message_id, content in rows])
+        db.commit()
+        last_id = rows[-1].id
+        filled += len(rows)
+        print(f"   🔤 {filled} tin nhắn đã có khóa tìm kiếm (đến message id {last_id})")
+        if pause_ms:
+            # Nhường database cho server khi chạy trên hệ thống đang hoạt động
+            time.sleep(pause_ms / 1000)
+    return filled
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Điền khóa tìm kiếm không dấu cho tin nhắn cũ")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Số tin nhắn mỗi lần commit")
+    parser.add_argument("--pause-ms", type=int, default=0, help="Nghỉ giữa các lô (ms)")
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    args = parser.parse_args(argv)
+
+    print("🔤 Tính khóa tìm kiếm cho tin nhắn cũ...")
+    manager = DatabaseManager(args.database_url, pool_options={"pool_prewarm": 0})
+    try:
+        filled = backfill(manager, args.batch_size, args.pause_ms)
+    except Exception as e:
+        manager.db.rollback()
+        print(f"❌ Lỗi khi tính khóa tìm kiếm: {e}")
+        return 1
+    finally:
+        manager.close()
+    print(f"✅ Hoàn tất: {filled} tin nhắn")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
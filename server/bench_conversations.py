@@ -0,0 +1,121 @@
+"""
+Đo số câu SQL và thời gian của ``DatabaseManager.get_conversations`` khi số
+hội thoại tăng dần.
+
+Dữ liệu mẫu được tạo trong một database SQLite tạm nên không ảnh hưởng đến
+database thật. Chạy từ thư mục gốc của project:
+
+    python -m server.bench_conversations [--sizes 10 40 80 160] [--messages 20] [--repeat 5]
+
+Số câu SQL phải giữ nguyên khi số hội thoại tăng (không còn N+1).
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from .blob_store import BlobStore
+from .database import DatabaseManager
+from .models import User
+
+
+def seed(manager: DatabaseManager, conversations: int, messages_per_conversation: int) -> int:
+    """
+    Tạo một user có ``conversations`` hội thoại: một nửa chat riêng, một nửa
+    chat nhóm (mỗi nhóm 5 thành viên). Trả về ID của user đó.
+    """
+    db = manager.db
+    users = [User(username=f"user{i}", password_hash=User.hash_password("secret"))
+             for i in range(conversations + 1)]
+    db.add_all(users)
+    db.commit()
+    owner = users[0]
+    private_count = conversations // 2
+    groups = []
+    for i in range(conversations - private_count):
+        # Tạo qua DatabaseManager để có dòng user_conversation_state của từng thành viên
+        _, _, group = manager.create_chat_group(
+            f"Nhóm {i}", owner.id, [user.id for user in users[1 + i % conversations:][:4]])
+        groups.append(group)
+
+    rows = []
+    next_id = 1
+    started = datetime.now() - timedelta(days=1)
+    for i in range(messages_per_conversation):
+        timestamp = started + timedelta(seconds=i)
+        for other in users[1:private_count + 1]:
+            # Tin nhắn chẵn do user chính gửi, tin lẻ là tin chưa đọc gửi đến user chính
+            sender, receiver = (owner, other) if i % 2 == 0 else (other, owner)
+            rows.append({"id": next_id, "sender_id": sender.id, "receiver_id": receiver.id, "group_id": None,
+                         "content": f"tin nhắn {i}", "message_type": "text", "timestamp": timestamp,
+                         "is_read": False, "is_edited": False})
+            next_id += 1
+        for group in groups:
+            rows.append({"id": next_id, "sender_id": owner.id, "receiver_id": None, "group_id": group.id,
+                         "content": f"tin nhắn nhóm {i}", "message_type": "text", "timestamp": timestamp,
+                         "is_read": False, "is_edited": False})
+            next_id += 1
+    manager.insert_messages(rows)
+    return owner.id
+
+
+def measure(manager: DatabaseManager, user_id: int, repeat: int):
+    """Trả về (số câu SQL mỗi lần gọi, thời gian trung bình ms, số hội thoại)."""
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(manager.engine, "before_cursor_execute", count_statement)
+    try:
+        total_ms = 0.0
+        for _ in range(repeat):
+            # Mỗi lần gọi như một request mới: session mới, không dùng lại object đã tải
+            manager.remove_session()
+            statements.clear()
+            started = time.perf_counter()
+            conversations = manager.get_conversations(user_id)
+            total_ms += (time.perf_counter() - started) * 1000
+    finally:
+        event.remove(manager.engine, "before_cursor_execute", count_statement)
+        manager.remove_session()
+    return len(statements), total_ms / repeat, len(conversations)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Đo số câu SQL của get_conversations")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 40, 80, 160],
+                        help="Số hội thoại của user cần đo")
+    parser.add_argument("--messages", type=int, default=20, help="Số tin nhắn trong mỗi hội thoại")
+    parser.add_argument("--repeat", type=int, default=5, help="Số lần gọi để lấy thời gian trung bình")
+    args = parser.parse_args(argv)
+
+    print(f"{'hội thoại':>10} {'câu SQL':>8} {'ms/lần':>8}")
+    work_dir = tempfile.mkdtemp(prefix="chatlan-bench-")
+    try:
+        for size in args.sizes:
+            database_path = os.path.join(work_dir, f"bench_{size}.db")
+            manager = DatabaseManager(f"sqlite:///{database_path}", blob_store=BlobStore(os.path.join(work_dir, "blobs")),
+                                      pool_options={"pool_prewarm": 0})
+            try:
+                user_id = seed(manager, size, args.messages)
+                manager.remove_session()
+                queries, elapsed_ms, found = measure(manager, user_id, args.repeat)
+            finally:
+                manager.close()
+            if found != size:
+                print(f"❌ Mong đợi {size} hội thoại, nhận được {found}")
+                return 1
+            print(f"{size:>10} {queries:>8} {elapsed_ms:>8.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
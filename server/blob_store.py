@@ -0,0 +1,128 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from typing import BinaryIO, Iterable, Iterator, List, Optional
+
+_SHA256_HEX = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BlobStore:
+    """
+    Kho file đính kèm/avatar trên đĩa, đánh địa chỉ theo SHA-256 của nội dung.
+
+    Blob ``ab12...`` nằm ở ``<root>/ab/12/ab12...``; chia thư mục hai cấp để
+    mỗi thư mục không chứa quá nhiều file. Mọi blob được ghi vào file tạm rồi
+    ``os.replace()`` nên người đọc không bao giờ thấy blob ghi dở. Hai file có
+    cùng nội dung chỉ được lưu một lần.
+    """
+
+    def __init__(self, root: str = "blobs"):
+        self.root = os.path.abspath(root)
+        # File tạm nằm cùng filesystem với blob để os.replace() là thao tác nguyên tử
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path_for(self, sha256: str) -> str:
+        if not _SHA256_HEX.match(sha256 or ""):
+            raise ValueError(f"Hash blob không hợp lệ: {sha256!r}")
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.path_for(sha256))
+
+    def size(self, sha256: str) -> int:
+        return os.path.getsize(self.path_for(sha256))
+
+    def put_bytes(self, data: bytes) -> str:
+        """Lưu dữ liệu và trả về hash SHA-256 của nó."""
+        sha256 = hashlib.sha256(data).hexdigest()
+        if self.exists(sha256):
+            return sha256
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self._install(tmp_path, sha256)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        return sha256
+
+    def put_file(self, path: str, sha256: Optional[str] = None) -> str:
+        """
+        Chuyển một file có sẵn (ví dụ file upload tạm) vào kho và trả về hash.
+
+        Nếu ``sha256`` đã được kiểm tra trước đó thì file không bị đọc lại.
+        File nguồn luôn được chuyển đi hoặc xóa.
+        """
+        if sha256 is None:
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    hasher.update(block)
+            sha256 = hasher.hexdigest()
+        if self.exists(sha256):
+            self._remove(path)
+            return sha256
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(fd)
+        try:
+            # Chép sang thư mục tạm của kho trước (upload_dir có thể ở filesystem khác)
+            shutil.move(path, tmp_path)
+            self._install(tmp_path, sha256)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        return sha256
+
+    def open(self, sha256: str) -> BinaryIO:
+        return open(self.path_for(sha256), 'rb')
+
+    def read(self, sha256: str) -> bytes:
+        with self.open(sha256) as f:
+            return f.read()
+
+    def iter_chunks(self, sha256: str, offset: int = 0, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """Đọc blob theo từng khối, bắt đầu từ ``offset``."""
+        with self.open(sha256) as f:
+            f.seek(offset)
+            for block in iter(lambda: f.read(chunk_size), b''):
+                yield block
+
+    def thumbnail_path(self, sha256: str, size: int) -> str:
+        """Ảnh thu nhỏ (JPEG, cạnh dài ``size`` px) nằm cạnh blob gốc."""
+        return f"{self.path_for(sha256)}.{int(size)}.jpg"
+
+    def put_thumbnail(self, sha256: str, size: int, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            self._install(tmp_path, sha256, self.thumbnail_path(sha256, size))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+    def thumbnail_sizes(self, sha256: str, sizes: Iterable[int]) -> List[int]:
+        """Các kích thước trong ``sizes`` đã có ảnh thu nhỏ cho blob này."""
+        return [size for size in sizes if os.path.exists(self.thumbnail_path(sha256, size))]
+
+    def read_thumbnail(self, sha256: str, size: int) -> bytes:
+        with open(self.thumbnail_path(sha256, size), 'rb') as f:
+            return f.read()
+
+    def _install(self, tmp_path: str, sha256: str, target: Optional[str] = None):
+        target = target or self.path_for(sha256)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(tmp_path, target)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
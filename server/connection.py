@@ -0,0 +1,177 @@
+import socket
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+# Các loại gói tin có thể bỏ qua khi client nhận chậm (chỉ mang trạng thái tạm thời)
+DROPPABLE_MESSAGE_TYPES = frozenset({"typing_status", "user_status"})
+
+
+def is_droppable(message: dict) -> bool:
+    """
+    Gói tin chỉ mang trạng thái tạm thời. ``user_status`` báo đổi avatar (có
+    ``avatar_hash`` ở ngoài ``user``) thì không: bỏ đi thì client giữ avatar cũ mãi.
+    """
+    if message.get('type') == 'user_status' and 'avatar_hash' in message:
+        return False
+    return message.get('type') in DROPPABLE_MESSAGE_TYPES
+
+
+class ClientConnection:
+    """
+    Một kết nối client với hàng đợi gửi có giới hạn.
+
+    Các thread broadcast chỉ đưa dữ liệu vào hàng đợi rồi trả về ngay; việc
+    ghi xuống socket do writer riêng của kết nối đảm nhận, nên một máy trạm bị
+    treo không làm chậm các client khác.
+
+    Chính sách khi client nhận chậm:
+    - Khi số byte chờ gửi vượt ``high_watermark``, kết nối bị coi là nghẽn và
+      các gói tin tạm thời (typing, presence) bị bỏ qua cho đến khi hàng đợi
+      giảm xuống dưới ``low_watermark``.
+    - Nếu hàng đợi vượt ``max_queued_bytes`` hoặc nghẽn liên tục quá
+      ``stall_timeout`` giây, kết nối bị ngắt.
+    """
+
+    def __init__(self, sock: socket.socket, address, legacy: bool = False,
+                 high_watermark: int = 1024 * 1024, low_watermark: int = 256 * 1024,
+                 max_queued_bytes: int = 32 * 1024 * 1024, stall_timeout: float = 30.0):
+        self.sock = sock
+        self.address = address
+        # Client cũ gửi/nhận JSON trần không có header frame
+        self.legacy = legacy
+        # User đã đăng nhập trên kết nối này (dùng cho các frame nhị phân không mang session)
+        self.user_id: Optional[int] = None
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_queued_bytes = max_queued_bytes
+        self.stall_timeout = stall_timeout
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self.queued_bytes = 0
+        self.congested = False
+        self.congested_since: Optional[float] = None
+        self.closed = False
+        # Bộ đếm
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.peak_queued_bytes = 0
+        self._writer_thread: Optional[threading.Thread] = None
+        self._wakeup = threading.Condition(self._lock)
+
+    def start(self):
+        """Khởi động writer của kết nối."""
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+
+    def getpeername(self):
+        return self.address
+
+    def send(self, data: bytes, droppable: bool = False) -> bool:
+        """
+        Đưa dữ liệu vào hàng đợi gửi.
+
+        Trả về False nếu gói tin bị bỏ qua hoặc kết nối đã/đang bị ngắt.
+        """
+        size = len(data)
+        disconnect_reason = None
+        with self._lock:
+            if self.closed:
+                return False
+            if self.congested and self.congested_since is not None \
+                    and time.monotonic() - self.congested_since > self.stall_timeout:
+                disconnect_reason = f"nghẽn quá {self.stall_timeout:.0f}s"
+            elif droppable and self.congested:
+                self.dropped_frames += 1
+                self.dropped_bytes += size
+                return False
+            elif self.queued_bytes and self.queued_bytes + size > self.max_queued_bytes:
+                # Luôn nhận ít nhất một gói tin khi hàng đợi rỗng, kể cả gói lớn
+                disconnect_reason = f"hàng đợi vượt {self.max_queued_bytes} bytes"
+            else:
+                self._queue.append(data)
+                self.queued_bytes += size
+                self.peak_queued_bytes = max(self.peak_queued_bytes, self.queued_bytes)
+                if not self.congested and self.queued_bytes >= self.high_watermark:
+                    self.congested = True
+                    self.congested_since = time.monotonic()
+                self._notify()
+                return True
+        print(f"🐢 Ngắt client nhận chậm {self.address}: {disconnect_reason}")
+        self.close()
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        """Bộ đếm của hàng đợi gửi."""
+        with self._lock:
+            return {
+                "queued_bytes": self.queued_bytes,
+                "queued_frames": len(self._queue),
+                "peak_queued_bytes": self.peak_queued_bytes,
+                "sent_frames": self.sent_frames,
+                "sent_bytes": self.sent_bytes,
+                "dropped_frames": self.dropped_frames,
+                "dropped_bytes": self.dropped_bytes,
+                "congested": int(self.congested),
+            }
+
+    def close(self):
+        """Đóng kết nối; thread đọc của kết nối sẽ thoát và dọn dẹp."""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._queue.clear()
+            self.queued_bytes = 0
+            self._notify()
+        self._close_transport()
+
+    def _notify(self):
+        # Gọi khi đang giữ self._lock
+        self._wakeup.notify()
+
+    def _next_chunk(self) -> Optional[bytes]:
+        # Gọi khi đang giữ self._lock
+        return self._queue[0] if self._queue else None
+
+    def _on_sent(self, size: int):
+        """Cập nhật bộ đếm sau khi một gói tin đã được ghi xong."""
+        with self._lock:
+            if self._queue:
+                self._queue.popleft()
+            self.queued_bytes = max(0, self.queued_bytes - size)
+            self.sent_frames += 1
+            self.sent_bytes += size
+            if self.congested and self.queued_bytes <= self.low_watermark:
+                self.congested = False
+                self.congested_since = None
+
+    def _writer_loop(self):
+        while True:
+            with self._lock:
+                while not self.closed and not self._queue:
+                    self._wakeup.wait()
+                if self.closed:
+                    return
+                data = self._next_chunk()
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                print(f"❌ Lỗi khi gửi tin nhắn đến {self.address}: {e}")
+                self.close()
+                return
+            self._on_sent(len(data))
+
+    def _close_transport(self):
+        try:
+            # shutdown() đánh thức thread đang chặn ở recv()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
@@ -1,12 +1,25 @@
-from sqlalchemy import create_engine, desc, and_, or_, func
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import create_engine, desc, and_, or_, func, inspect, text, insert, select, update, delete, case, literal, union_all, String
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker, scoped_session, joinedload, Session
 from sqlalchemy.exc import IntegrityError
-from .models import Base, User, Message, Conversation, UserSession, TypingStatus, Group, group_members
+from sqlalchemy.pool import QueuePool
+from common.text import search_key
+from .message_cache import MessageCache, conversation_key
+from .user_directory import DirectoryUser, UserDirectory
+from .migrations import MigrationRunner
+from .search import MessageSearch, decode_cursor, encode_cursor, parse_search_query
+from .models import (Base, User, Message, Conversation, UserSession, TypingStatus, Group, SyncChange, ReadCursor,
+                     UserConversationState, group_members)
+from .blob_store import BlobStore
+from .thumbnails import THUMBNAIL_MIME, ThumbnailService
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any, Tuple
+from typing import List, Optional, Dict, Any, Tuple, Union
 import secrets
-import base64
+import hashlib
+import mimetypes
 import os
+import threading
 import configparser
 
 def load_database_config(config_path: str = "server_config.ini") -> Dict[str, str]:
@@ -15,11 +28,24 @@ def load_database_config(config_path: str = "server_config.ini") -> Dict[str, st
     Fallback về giá trị mặc định nếu file không tồn tại.
     """
     defaults = {
+        "backend": "postgresql",
         "db_user": "chat_user",
         "db_password": "chat_password",
         "db_host": "192.168.1.10",
         "db_port": "5432",
-        "db_name": "chat_lan_db"
+        "db_name": "chat_lan_db",
+        "pool_size": "10",
+        "max_overflow": "20",
+        "pool_timeout": "30",
+        "pool_prewarm": "4",
+        "auto_migrate": "true",
+        "message_cache_size": "50",
+        "message_cache_mb": "64",
+        "user_cache_size": "10000",
+        "sqlite_path": "chat_lan.db",
+        "sqlite_busy_timeout_ms": "5000",
+        "sqlite_synchronous": "normal",
+        "sqlite_cache_mb": "64"
     }
     
     config = configparser.ConfigParser()
@@ -29,11 +55,24 @@ def load_database_config(config_path: str = "server_config.ini") -> Dict[str, st
             if 'Database' in config:
                 db_config = config['Database']
                 return {
+                    "backend": db_config.get('backend', defaults['backend']),
                     "db_user": db_config.get('db_user', defaults['db_user']),
                     "db_password": db_config.get('db_password', defaults['db_password']),
                     "db_host": db_config.get('db_host', defaults['db_host']),
                     "db_port": db_config.get('db_port', defaults['db_port']),
-                    "db_name": db_config.get('db_name', defaults['db_name'])
+                    "db_name": db_config.get('db_name', defaults['db_name']),
+                    "pool_size": db_config.get('pool_size', defaults['pool_size']),
+                    "max_overflow": db_config.get('max_overflow', defaults['max_overflow']),
+                    "pool_timeout": db_config.get('pool_timeout', defaults['pool_timeout']),
+                    "pool_prewarm": db_config.get('pool_prewarm', defaults['pool_prewarm']),
+                    "auto_migrate": db_config.get('auto_migrate', defaults['auto_migrate']),
+                    "message_cache_size": db_config.get('message_cache_size', defaults['message_cache_size']),
+                    "message_cache_mb": db_config.get('message_cache_mb', defaults['message_cache_mb']),
+                    "user_cache_size": db_config.get('user_cache_size', defaults['user_cache_size']),
+                    "sqlite_path": db_config.get('sqlite_path', defaults['sqlite_path']),
+                    "sqlite_busy_timeout_ms": db_config.get('sqlite_busy_timeout_ms', defaults['sqlite_busy_timeout_ms']),
+                    "sqlite_synchronous": db_config.get('sqlite_synchronous', defaults['sqlite_synchronous']),
+                    "sqlite_cache_mb": db_config.get('sqlite_cache_mb', defaults['sqlite_cache_mb'])
                 }
         except Exception as e:
             print(f"⚠️ Lỗi đọc config file {config_path}: {e}. Sử dụng giá trị mặc định.")
@@ -42,19 +81,145 @@ def load_database_config(config_path: str = "server_config.ini") -> Dict[str, st
 
 # Đọc cấu hình database
 _db_config = load_database_config()
+# postgresql: server PostgreSQL; sqlite: file SQLite chế độ WAL, không cần dịch vụ ngoài
+DB_BACKEND = _db_config["backend"].strip().lower()
 DB_USER = _db_config["db_user"]
 DB_PASSWORD = _db_config["db_password"]
 DB_HOST = _db_config["db_host"]
 DB_PORT = _db_config["db_port"]
 DB_NAME = _db_config["db_name"]
+# Connection pool: mỗi request mượn một kết nối và trả lại khi xong
+DB_POOL_OPTIONS = {
+    "pool_size": int(_db_config["pool_size"]),
+    "max_overflow": int(_db_config["max_overflow"]),
+    "pool_timeout": int(_db_config["pool_timeout"]),
+    "pool_prewarm": int(_db_config["pool_prewarm"]),
+}
+# Tự chạy migration schema khi khởi động (tắt để chạy tay: python -m server.migrations)
+DB_AUTO_MIGRATE = _db_config["auto_migrate"].strip().lower() in ("1", "true", "yes", "on")
+# Số tin nhắn mặc định / tối đa của một trang lịch sử chat
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_MAX = 200
+SEARCH_PAGE_SIZE = 20
+# Cache tin nhắn mới nhất của mỗi hội thoại: số tin nhắn mỗi hội thoại (0 để tắt) và dung lượng tối đa
+MESSAGE_CACHE_SIZE = int(_db_config["message_cache_size"])
+MESSAGE_CACHE_BYTES = int(_db_config["message_cache_mb"]) * 1024 * 1024
+# Danh bạ user trong bộ nhớ (tra theo id/username): số user tối đa (0 để tắt)
+USER_CACHE_SIZE = int(_db_config["user_cache_size"])
+# Số hội thoại mỗi câu UNION ALL đếm tin chưa đọc (SQLite giới hạn 500 SELECT mỗi câu)
+UNREAD_COUNT_BATCH = 200
+CONVERSATION_PREVIEW_LENGTH = 200  # user_conversation_state.last_message_preview
+# Gói tin sync (client kết nối lại): vượt các ngưỡng này thì gửi lại từ đầu thay vì phần chênh lệch
+SYNC_MAX_MESSAGES = 200       # tin nhắn còn thiếu của một hội thoại
+SYNC_MAX_CHANGES = 500        # thay đổi (xóa tin nhắn, thành viên nhóm) từ lần sync trước
+SYNC_MAX_CONVERSATIONS = 100  # hội thoại client đang giữ lịch sử
+# Thay đổi cũ hơn số ngày này bị dọn; client vắng lâu hơn nhận ảnh chụp đầy đủ
+SYNC_CHANGE_RETENTION_DAYS = 30
+# Backend SQLite: PRAGMA áp dụng cho mỗi kết nối mới (xem configure_sqlite_connection)
+SQLITE_OPTIONS = {
+    "busy_timeout_ms": int(_db_config["sqlite_busy_timeout_ms"]),
+    "synchronous": _db_config["sqlite_synchronous"].strip().upper(),
+    "cache_mb": int(_db_config["sqlite_cache_mb"]),
+}
+_SQLITE_SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
 
 # Chuỗi kết nối (Connection String) cho PostgreSQL
 # Thêm sslmode=disable để cho phép kết nối không mã hóa (phù hợp cho môi trường LAN nội bộ)
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=disable"
+if DB_BACKEND == "sqlite":
+    DATABASE_URL = f"sqlite:///{os.path.abspath(_db_config['sqlite_path'])}"
+elif DB_BACKEND == "postgresql":
+    DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=disable"
+else:
+    raise ValueError(f"backend không hợp lệ trong server_config.ini: {DB_BACKEND} (postgresql hoặc sqlite)")
+
+
+def configure_sqlite_connection(dbapi_connection, options: Dict[str, Any], in_memory: bool = False):
+    """
+    PRAGMA cho một kết nối SQLite mới.
+
+    - ``journal_mode=WAL``: người đọc không chặn người ghi và ngược lại; chỉ
+      còn một người ghi tại một thời điểm.
+    - ``busy_timeout``: người ghi thứ hai chờ khóa ghi tối đa N ms thay vì lỗi
+      "database is locked" ngay. Transaction chỉ bắt đầu ở câu lệnh ghi đầu
+      tiên (driver sqlite3 mặc định) nên chờ khóa luôn an toàn, không bị lỗi
+      snapshot cũ của WAL.
+    - ``synchronous=NORMAL``: trong chế độ WAL vẫn không hỏng database khi mất
+      điện, chỉ có thể mất các transaction cuối cùng chưa checkpoint.
+    - ``foreign_keys=ON``: kiểm tra khóa ngoại như PostgreSQL.
+    """
+    synchronous = options["synchronous"]
+    if synchronous not in _SQLITE_SYNCHRONOUS_MODES:
+        raise ValueError(f"sqlite_synchronous không hợp lệ: {synchronous} ({', '.join(_SQLITE_SYNCHRONOUS_MODES)})")
+    cursor = dbapi_connection.cursor()
+    try:
+        if not in_memory:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(options['busy_timeout_ms'])}")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        # Giá trị âm: kích thước cache theo KiB thay vì số trang
+        cursor.execute(f"PRAGMA cache_size=-{int(options['cache_mb']) * 1024}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA foreign_keys=ON")
+    finally:
+        cursor.close()
+
+
+def create_database_engine(database_url: str, pool_arguments: Optional[Dict[str, int]] = None,
+                           sqlite_options: Optional[Dict[str, Any]] = None):
+    """
+    Engine SQLAlchemy cho ``database_url``; với SQLite, mỗi kết nối mới được
+    cấu hình bằng :func:`configure_sqlite_connection` (WAL, busy timeout...).
+    """
+    url = make_url(database_url)
+    engine = create_engine(
+        database_url,
+        # Không cần connect_args cho PostgreSQL khi dùng sslmode trong URL
+        echo=False, # Đặt là True nếu muốn xem các câu lệnh SQL được thực thi
+        pool_pre_ping=True,  # Kiểm tra kết nối trước khi sử dụng
+        **(pool_arguments or {})
+    )
+    if url.get_backend_name() == "sqlite":
+        options = dict(SQLITE_OPTIONS, **(sqlite_options or {}))
+        in_memory = url.database in (None, "", ":memory:")
+        if not in_memory:
+            # SQLite tự tạo file nhưng không tạo thư mục chứa nó
+            directory = os.path.dirname(os.path.abspath(url.database))
+            os.makedirs(directory, exist_ok=True)
+
+        @event.listens_for(engine, "connect")
+        def _on_sqlite_connect(dbapi_connection, connection_record):
+            configure_sqlite_connection(dbapi_connection, options, in_memory)
+    return engine
+
+
 class DatabaseManager:
-    def __init__(self, database_url: str = DATABASE_URL):
+    def __init__(self, database_url: str = DATABASE_URL, blob_store: Optional[BlobStore] = None,
+                 thumbnails: Optional[ThumbnailService] = None,
+                 pool_options: Optional[Dict[str, int]] = None, auto_migrate: bool = DB_AUTO_MIGRATE,
+                 sqlite_options: Optional[Dict[str, Any]] = None, message_cache: Optional[MessageCache] = None,
+                 user_directory: Optional[UserDirectory] = None):
         """
         Khởi tạo DatabaseManager với connection string.
+        File đính kèm và avatar được lưu trong ``blob_store`` thay vì trong database;
+        ``thumbnails`` cho biết ảnh thu nhỏ nào đã có để đưa vào metadata.
+
+        ``self.db`` là scoped_session: mỗi thread có Session riêng, mượn kết nối
+        từ pool (``pool_size``/``max_overflow``/``pool_timeout``/``pool_prewarm``
+        trong ``pool_options``). Gọi :meth:`remove_session` khi xong một request
+        để trả kết nối về pool.
+
+        ``database_url`` dạng ``sqlite:///path.db`` dùng SQLite chế độ WAL
+        (``sqlite_options`` ghi đè ``busy_timeout_ms``/``synchronous``/``cache_mb``
+        trong server_config.ini) với cùng API, cho máy chủ chi nhánh nhỏ và
+        benchmark không cần PostgreSQL.
+
+        ``message_cache`` giữ các tin nhắn mới nhất của mỗi hội thoại để mở chat
+        không cần truy vấn database (mặc định theo ``message_cache_size`` /
+        ``message_cache_mb``).
+
+        ``user_directory`` giữ các user đã tra cứu (theo id và username) cùng
+        dict hồ sơ đã tính sẵn; bị làm mới sau mỗi thay đổi trạng thái, avatar
+        hoặc hồ sơ (mặc định theo ``user_cache_size``).
         
         Lưu ý về lỗi pg_hba.conf:
         - Nếu PostgreSQL và ứng dụng chạy trên cùng máy: dùng localhost hoặc 127.0.0.1
@@ -62,17 +227,31 @@ class DatabaseManager:
           Thêm dòng: host    chat_lan_db    chat_user    192.168.1.10/32    md5
         """
         try:
-            # Thay đổi trong hàm create_engine
-            self.engine = create_engine(
-                database_url,
-                # Không cần connect_args cho PostgreSQL khi dùng sslmode trong URL
-                echo=False, # Đặt là True nếu muốn xem các câu lệnh SQL được thực thi
-                pool_pre_ping=True  # Kiểm tra kết nối trước khi sử dụng
-            )
+            options = dict(DB_POOL_OPTIONS, **(pool_options or {}))
+            self.pool_options = options
+            self.engine = create_database_engine(database_url, self._pool_arguments(database_url, options),
+                                                 sqlite_options)
+            self._pool_lock = threading.Lock()
+            self._pool_counters = {"checkouts": 0, "connects": 0, "peak_checked_out": 0}
+            event.listen(self.engine, "connect", self._on_pool_connect)
+            event.listen(self.engine, "checkout", self._on_pool_checkout)
             # Tạo tất cả các bảng nếu chúng chưa tồn tại
+            # Database mới: bảng còn rỗng nên chạy migration ngay cả khi tắt auto_migrate
+            is_new_database = not inspect(self.engine).has_table(Message.__tablename__)
             Base.metadata.create_all(bind=self.engine)        
+            self._upgrade_schema(auto_migrate, is_new_database)
             SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
-            self.db = SessionLocal()
+            # Session riêng cho từng thread: các handler chạy song song không dùng chung transaction
+            self.db = scoped_session(SessionLocal)
+            self.blobs = blob_store or BlobStore()
+            self.message_cache = message_cache or MessageCache(MESSAGE_CACHE_SIZE, MESSAGE_CACHE_BYTES)
+            self.users = user_directory or UserDirectory(USER_CACHE_SIZE)
+            # Mặc định chỉ đọc ảnh thu nhỏ đã có, không tạo mới
+            self.thumbnails = thumbnails or ThumbnailService(self.blobs, max_workers=0)
+            # Còn dữ liệu file/avatar trong các cột LargeBinary cũ chưa chuyển sang BlobStore
+            self.has_legacy_blobs = self._check_legacy_blobs()
+            self.remove_session()
+            self.prewarm_pool(options.get("pool_prewarm", 0))
         except Exception as e:
             error_msg = str(e)
             if "pg_hba.conf" in error_msg:
@@ -90,6 +269,105 @@ class DatabaseManager:
                 print("   - Sau đó restart PostgreSQL service")
                 print("="*60 + "\n")
             raise   
+    @staticmethod
+    def _pool_arguments(database_url: str, options: Dict[str, int]) -> Dict[str, int]:
+        """Tham số pool cho create_engine; SQLite in-memory dùng SingletonThreadPool nên bỏ qua."""
+        url = make_url(database_url)
+        if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+            return {}
+        return {
+            "pool_size": options["pool_size"],
+            "max_overflow": options["max_overflow"],
+            "pool_timeout": options["pool_timeout"],
+        }
+    def _on_pool_connect(self, dbapi_connection, connection_record):
+        with self._pool_lock:
+            self._pool_counters["connects"] += 1
+    def _on_pool_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        pool = self.engine.pool
+        checked_out = pool.checkedout() if isinstance(pool, QueuePool) else 0
+        with self._pool_lock:
+            self._pool_counters["checkouts"] += 1
+            self._pool_counters["peak_checked_out"] = max(self._pool_counters["peak_checked_out"], checked_out)
+    def prewarm_pool(self, count: int):
+        """Mở trước ``count`` kết nối để request đầu tiên không phải chờ bắt tay với database."""
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            return
+        count = min(count, pool.size())
+        connections = []
+        try:
+            for _ in range(count):
+                connections.append(self.engine.connect())
+        except Exception as e:
+            print(f"⚠️ Không mở trước được kết nối database: {e}")
+        finally:
+            for connection in connections:
+                connection.close()
+        if connections:
+            print(f"🔌 Database pool: đã mở sẵn {len(connections)} kết nối")
+    def pool_stats(self) -> Dict[str, int]:
+        """Mức sử dụng connection pool: đang mượn, rảnh, overflow và các bộ đếm tích lũy."""
+        pool = self.engine.pool
+        with self._pool_lock:
+            stats = dict(self._pool_counters)
+        if isinstance(pool, QueuePool):
+            stats.update({
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": max(0, pool.overflow()),
+                "max_overflow": self.pool_options["max_overflow"],
+            })
+        return stats
+    def remove_session(self):
+        """Đóng Session của thread hiện tại (rollback phần chưa commit) và trả kết nối về pool."""
+        self.db.remove()
+    def _upgrade_schema(self, auto_migrate: bool, is_new_database: bool = False):
+        """Áp dụng các migration còn thiếu (create_all() không sửa bảng/index của database cũ)."""
+        self.migrations = MigrationRunner(self.engine)
+        if is_new_database or auto_migrate:
+            self.migrations.upgrade(concurrently=not is_new_database)
+        else:
+            pending = self.migrations.pending()
+            if pending:
+                print(f"⚠️ Còn {len(pending)} migration chưa chạy "
+                      f"(phiên bản {', '.join(str(m.version) for m in pending)}). Chạy: python -m server.migrations")
+        # Chọn cách tìm kiếm theo schema sau migration (tsvector, FTS5 hoặc LIKE)
+        self.search = MessageSearch(self.engine)
+    def _check_legacy_blobs(self) -> bool:
+        try:
+            legacy = self.db.query(Message.id).filter(Message.file_data.isnot(None)).first() is not None \
+                or self.db.query(User.id).filter(User.avatar.isnot(None)).first() is not None
+        except Exception as e:
+            self.db.rollback()
+            print(f"Error checking legacy blobs: {e}")
+            return False
+        if legacy:
+            print("⚠️ Database còn file/avatar lưu dạng LargeBinary. Chạy: python -m server.migrate_blobs")
+        return legacy
+    def read_file_data(self, message: Message) -> Optional[bytes]:
+        """Nội dung file đính kèm của tin nhắn (từ BlobStore, hoặc cột cũ nếu chưa migrate)."""
+        if message.file_hash:
+            try:
+                return self.blobs.read(message.file_hash)
+            except OSError as e:
+                print(f"Error reading blob {message.file_hash}: {e}")
+                return None
+        if self.has_legacy_blobs and message.file_size:
+            return message.file_data
+        return None
+    def read_avatar(self, user: User) -> Optional[bytes]:
+        """Dữ liệu avatar của user (từ BlobStore, hoặc cột cũ nếu chưa migrate)."""
+        if user.avatar_hash:
+            try:
+                return self.blobs.read(user.avatar_hash)
+            except OSError as e:
+                print(f"Error reading blob {user.avatar_hash}: {e}")
+                return None
+        if self.has_legacy_blobs:
+            return user.avatar
+        return None
     def register_user(self, username: str, password: str, display_name: str = None, email: str = None) -> Tuple[bool, str, Optional[User]]:
         """Đăng ký user mới và tự động thêm vào nhóm chung (ID=1)."""
         try:
@@ -119,6 +397,8 @@ class DatabaseManager:
             if company_group:
                 print(f"Đang thêm người dùng '{username}' vào nhóm chung '{company_group.name}'...")
                 user.groups.append(company_group)
+                self.db.flush()
+                self._join_group_state(user.id, company_group.id)
             else:
                 print("Cảnh báo: Không tìm thấy nhóm chung (ID=1) để thêm người dùng mới.")
             # ---------------------------------------------
@@ -151,6 +431,7 @@ class DatabaseManager:
                 expires_at=datetime.now() + timedelta(days=7))
             self.db.add(session)
             self.db.commit()
+            self.users.invalidate(user.id)
             return True, "Đăng nhập thành công", user, session_token
         except Exception as e:
             self.db.rollback()
@@ -171,6 +452,7 @@ class DatabaseManager:
                 if session:
                     session.is_active = False
             self.db.commit()
+            self.users.invalidate(user_id)
         except Exception as e:
             self.db.rollback()
             print(f"Error logging out user: {e}")
@@ -189,12 +471,31 @@ class DatabaseManager:
         except Exception as e:
             print(f"Error verifying session: {e}")
             return None
-    def get_user_by_username(self, username: str) -> Optional[User]:
-        """Lấy user theo username"""
-        return self.db.query(User).filter(User.username == username).first()
-    def get_user_by_id(self, user_id: int) -> Optional[User]:
-        """Lấy user theo ID"""
-        return self.db.query(User).filter(User.id == user_id).first()
+    def get_user_by_username(self, username: str) -> Optional[DirectoryUser]:
+        """Lấy user theo username (từ danh bạ trong bộ nhớ nếu có)"""
+        user = self.users.get_by_username(username)
+        return user if user is not None else self._load_directory_user(User.username == username)
+    def get_user_by_id(self, user_id: int) -> Optional[DirectoryUser]:
+        """Lấy user theo ID (từ danh bạ trong bộ nhớ nếu có)"""
+        user = self.users.get(user_id)
+        return user if user is not None else self._load_directory_user(User.id == user_id)
+    def get_user_profile(self, user_id: int) -> Optional[Dict]:
+        """Dict hồ sơ đã tính sẵn của user (dùng chung, không sửa); None nếu không tồn tại."""
+        user = self.get_user_by_id(user_id)
+        return user.profile if user else None
+    def _load_directory_user(self, condition) -> Optional[DirectoryUser]:
+        """Đọc user từ database và đưa vào danh bạ."""
+        token = self.users.reserve()
+        user = self.db.query(User).filter(condition).first()
+        if user is None:
+            return None
+        entry = DirectoryUser(
+            id=user.id, username=user.username, display_name=user.display_name, email=user.email,
+            status=user.status, status_message=user.status_message, is_online=user.is_online,
+            last_seen=user.last_seen, avatar_hash=user.avatar_hash, created_at=user.created_at,
+            profile=self._user_to_dict(user))
+        self.users.fill(token, entry)
+        return entry
     def update_user_status(self, user_id: int, status: str, status_message: str = None):
         """Cập nhật trạng thái user"""
         try:
@@ -206,6 +507,7 @@ class DatabaseManager:
                     user.status_message = status_message
                 user.last_seen = datetime.now()
                 self.db.commit()
+                self.users.invalidate(user_id)
         except Exception as e:
             self.db.rollback()
             print(f"Error updating user status: {e}")
@@ -232,44 +534,65 @@ class DatabaseManager:
     def save_message(self, sender_id: int, receiver_id: int = None, group_id: int = None, content: str = "", 
                  message_type: str = "text", file_name: str = None, 
                  file_data: bytes = None, reply_to_id: int = None, 
-                 client_message_id: str = None) -> Optional[Message]:
-        """Lưu tin nhắn (phiên bản sửa lỗi logic)."""
+                 client_message_id: str = None, file_hash: str = None,
+                 file_size: int = None, message_id: int = None) -> Optional[Message]:
+        """
+        Lưu tin nhắn (phiên bản sửa lỗi logic).
+        File đính kèm được truyền bằng ``file_data`` (sẽ được ghi vào BlobStore)
+        hoặc ``file_hash``/``file_size`` của một blob đã có sẵn.
+        ``message_id`` là ID đã cấp sẵn (MessageIngestor), None để database tự sinh.
+        """
         try:
+            if file_data:
+                file_hash = self.blobs.put_bytes(file_data)
+                file_size = len(file_data)
             if group_id:
                 message = Message(
                     sender_id=sender_id,
                     group_id=group_id,
                     receiver_id=None, # Đảm bảo receiver_id là NULL
                     content=content,
+                    search_key=search_key(content),
                     message_type=message_type,
                     file_name=file_name,
-                    file_data=file_data,
-                    file_size=len(file_data) if file_data else None,
+                    file_hash=file_hash,
+                    file_size=file_size if file_hash else None,
                     reply_to_id=reply_to_id,
                     client_message_id=client_message_id
                 )
+                message.id = message_id
             elif receiver_id:
                 message = Message(
                     sender_id=sender_id,
                     receiver_id=receiver_id,
                     group_id=None, # Đảm bảo group_id là NULL
                     content=content,
+                    search_key=search_key(content),
                     message_type=message_type,
                     file_name=file_name,
-                    file_data=file_data,
-                    file_size=len(file_data) if file_data else None,
+                    file_hash=file_hash,
+                    file_size=file_size if file_hash else None,
                     reply_to_id=reply_to_id,
                     client_message_id=client_message_id
                 )
+                message.id = message_id
             else:
                 return None
 
             self.db.add(message)
+            self.db.flush()
+            # Cập nhật hội thoại trong cùng transaction với tin nhắn
+            if receiver_id:
+                self._update_conversations({(sender_id, receiver_id): message.id})
+            self._update_conversation_states([{
+                "id": message.id, "sender_id": message.sender_id, "receiver_id": message.receiver_id,
+                "group_id": message.group_id, "content": message.content,
+            }])
+            if message_id is not None:
+                self._advance_message_sequence()
             self.db.commit()
             self.db.refresh(message)
-            
-            if receiver_id:
-                self._update_conversation(sender_id, receiver_id, message.id)
+            self._cache_message(message)
             
             return message
         except Exception as e:
@@ -277,147 +600,507 @@ class DatabaseManager:
             print(f"[DB-SAVE] Lỗi khi lưu tin nhắn: {e}")
             return None
     def get_messages(self, user_id: int, other_user_id: int = None, group_id: int = None,
-                 limit: int = 50, offset: int = 0) -> List[Dict]:
-        """Lấy tin nhắn (sửa lỗi logic truy vấn cho nhóm)."""
-        try:
-            # Buộc SQLAlchemy đọc lại dữ liệu từ DB, tránh lỗi cache session
-            self.db.expire_all()
+                 limit: int = 50) -> List[Dict]:
+        """Lấy ``limit`` tin nhắn mới nhất của hội thoại (xem :meth:`get_message_page`)."""
+        page = self.get_message_page(user_id, other_user_id=other_user_id, group_id=group_id, limit=limit)
+        return page["messages"] if page else []
+    def get_message_page(self, user_id: int, other_user_id: int = None, group_id: int = None,
+                         limit: int = 50, before_id: int = None, after_id: int = None,
+                         around_id: int = None) -> Optional[Dict]:
+        """
+        Phân trang lịch sử theo khóa (hội thoại, id) thay vì offset.
 
-            messages = []
+        - Không có con trỏ: ``limit`` tin nhắn mới nhất.
+        - ``before_id``: các tin nhắn cũ hơn ``before_id``.
+        - ``after_id``: các tin nhắn mới hơn ``after_id``.
+        - ``around_id``: tin nhắn ``around_id`` cùng các tin nhắn trước và sau nó.
+
+        Tin nhắn được trả về theo thứ tự cũ -> mới, kèm ``has_more`` cho hướng
+        đang phân trang (với ``around_id`` có thêm ``has_more_before`` và
+        ``has_more_after``). Mỗi trang chỉ quét một đoạn của index
+        ``(group_id, id)`` hoặc ``(sender_id, receiver_id, id)``, nên trang thứ
+        1000 nhanh như trang đầu. Trang mới nhất (và các trang ``before_id`` còn
+        trong cache) được lấy từ ``message_cache``. Trong chat riêng ``is_read``
+        lấy theo read cursor của người nhận. Trả về None nếu user không có quyền xem.
+        """
+        page = self._get_message_page(user_id, other_user_id, group_id, limit, before_id, after_id, around_id)
+        if page and other_user_id and not group_id:
+            page["messages"] = self._apply_read_state(user_id, other_user_id, page["messages"])
+        return page
+    def _get_message_page(self, user_id: int, other_user_id: int, group_id: int, limit: int,
+                          before_id: Optional[int], after_id: Optional[int], around_id: Optional[int]) -> Optional[Dict]:
+        try:
+            limit = max(1, min(int(limit or MESSAGE_PAGE_SIZE), MESSAGE_PAGE_MAX))
             if group_id:
-                print(f"[DB-GET] Getting messages for GROUP ID: {group_id}")
-                
-                # Lấy đối tượng Group từ DB
-                group = self.db.query(Group).filter(Group.id == group_id).first()
-                if not group:
-                    print(f"[DB-GET] Không tìm thấy nhóm {group_id}")
-                    return []
-
-                # Kiểm tra tư cách thành viên
-                is_member = any(member.id == user_id for member in group.members)
+                # Kiểm tra tư cách thành viên mà không tải toàn bộ danh sách thành viên
+                is_member = self.db.query(group_members.c.user_id).filter(
+                    group_members.c.group_id == group_id, group_members.c.user_id == user_id
+                ).first() is not None
                 if not is_member:
                     print(f"[DB-GET] User {user_id} không phải thành viên nhóm {group_id}.")
-                    return []
-
-                # SỬA LỖI TRUY VẤN: Truy vấn thông qua Message.group_id
-                messages = self.db.query(Message).filter(
-                    Message.group_id == group_id
-                ).order_by(Message.id.desc()).limit(limit).all()
-
+                    return None
+                scopes = [Message.group_id == group_id]
             elif other_user_id:
-                print(f"[DB-GET] Getting messages between USER ID: {user_id} and {other_user_id}")
-                messages = self.db.query(Message).filter(
-                    and_(
-                        Message.group_id.is_(None),
-                        or_(
-                            and_(Message.sender_id == user_id, Message.receiver_id == other_user_id),
-                            and_(Message.sender_id == other_user_id, Message.receiver_id == user_id)
-                        )
-                    )
-                ).order_by(Message.id.desc()).limit(limit).all()
+                # Mỗi chiều gửi là một đoạn index riêng; gộp kết quả trong Python
+                scopes = [
+                    and_(Message.sender_id == user_id, Message.receiver_id == other_user_id,
+                         Message.group_id.is_(None)),
+                    and_(Message.sender_id == other_user_id, Message.receiver_id == user_id,
+                         Message.group_id.is_(None)),
+                ]
+            else:
+                return None
+
+            cache = self.message_cache
+            if around_id is None and after_id is None and cache.enabled and limit <= cache.per_conversation:
+                key = conversation_key(group_id, user_id, other_user_id)
+                cached = cache.page(key, limit, before_id)
+                if cached is not None:
+                    messages, has_more = cached
+                    return {"messages": self._refresh_cached_thumbnails(key, messages), "has_more": has_more}
+                if before_id is None:
+                    return self._fill_message_cache(key, scopes, limit)
 
-            print(f"[DB-GET] Found {len(messages)} messages.")
-            return [self._message_to_dict(msg) for msg in reversed(messages)]
+            if around_id is not None:
+                older_count = limit // 2
+                newer_count = limit - older_count
+                older = self._fetch_message_range(scopes, Message.id < around_id, older_count + 1, newest_first=True)
+                newer = self._fetch_message_range(scopes, Message.id >= around_id, newer_count + 1, newest_first=False)
+                has_more_before = len(older) > older_count
+                has_more_after = len(newer) > newer_count
+                messages = list(reversed(older[:older_count])) + newer[:newer_count]
+                return {
+                    "messages": [self._message_to_dict(msg) for msg in messages],
+                    "has_more": has_more_before or has_more_after,
+                    "has_more_before": has_more_before,
+                    "has_more_after": has_more_after,
+                }
+            if after_id is not None:
+                messages = self._fetch_message_range(scopes, Message.id > after_id, limit + 1, newest_first=False)
+                has_more = len(messages) > limit
+                messages = messages[:limit]
+            else:
+                condition = Message.id < before_id if before_id is not None else None
+                # Lấy thừa một dòng để biết còn trang cũ hơn hay không
+                messages = self._fetch_message_range(scopes, condition, limit + 1, newest_first=True)
+                has_more = len(messages) > limit
+                messages = list(reversed(messages[:limit]))
+            return {"messages": [self._message_to_dict(msg) for msg in messages], "has_more": has_more}
         except Exception as e:
             print(f"[DB-GET] Lỗi khi lấy tin nhắn: {e}")
             import traceback
             traceback.print_exc() # In ra traceback đầy đủ để gỡ lỗi
-            return []
+            return None
+
+    def _fill_message_cache(self, key, scopes: list, limit: int) -> Dict:
+        """Đọc các tin nhắn mới nhất của hội thoại vào cache rồi trả về trang mới nhất từ đó."""
+        cache = self.message_cache
+        token = cache.reserve(key)
+        rows = self._fetch_message_range(scopes, None, cache.per_conversation + 1, newest_first=True)
+        has_older = len(rows) > cache.per_conversation
+        messages = [self._message_to_dict(msg) for msg in reversed(rows[:cache.per_conversation])]
+        cache.fill(key, token, messages, has_older)
+        return {"messages": messages[-limit:], "has_more": len(messages) > limit or has_older}
+
+    def _refresh_cached_thumbnails(self, key, messages: List[Dict]) -> List[Dict]:
+        """Ảnh thu nhỏ được tạo sau khi tin nhắn vào cache: cập nhật lại metadata khi đọc."""
+        result = []
+        for message in messages:
+            attachment = message.get("attachment")
+            thumbnail = attachment.get("thumbnail") if attachment else None
+            if attachment and (thumbnail is None or thumbnail.get("pending")):
+                fresh = self._thumbnail_to_dict(attachment.get("hash"), attachment.get("name"))
+                if fresh != thumbnail:
+                    message = dict(message, attachment=dict(attachment, thumbnail=fresh))
+                    self.message_cache.replace(key, message)
+            result.append(message)
+        return result
+
+    def _cache_message(self, message: Message):
+        """Đưa tin nhắn vừa commit vào cache của hội thoại (nếu hội thoại đang được cache)."""
+        key = conversation_key(message.group_id, message.sender_id, message.receiver_id)
+        try:
+            self.message_cache.add(key, self._message_to_dict(message))
+        except Exception as e:
+            self.message_cache.invalidate(key)
+            print(f"⚠️ Không cập nhật được cache tin nhắn {message.id}: {e}")
+
+    def _fetch_message_range(self, scopes: list, condition, count: int, newest_first: bool) -> List[Message]:
+        """
+        Lấy tối đa ``count`` tin nhắn gần con trỏ nhất trong các ``scopes``.
+
+        Mỗi scope được truy vấn riêng (ORDER BY id + LIMIT trên một đoạn index)
+        rồi gộp lại, tránh OR giữa hai chiều của chat riêng khiến database phải
+        quét và sắp xếp toàn bộ hội thoại.
+        """
+        order = desc(Message.id) if newest_first else Message.id
+        messages = []
+        for scope in scopes:
+            query = self.db.query(Message).options(joinedload(Message.sender), joinedload(Message.receiver))
+            query = query.filter(scope) if condition is None else query.filter(scope, condition)
+            messages.extend(query.order_by(order).limit(count).all())
+        messages.sort(key=lambda msg: msg.id, reverse=newest_first)
+        return messages[:count]
     def get_conversations(self, user_id: int) -> List[Dict]:
-        """Lấy danh sách hội thoại, bao gồm cả chat riêng và chat nhóm."""
+        """
+        Lấy danh sách hội thoại, bao gồm cả chat riêng và chat nhóm.
+        Đọc từ user_conversation_state trong một truy vấn: một đoạn index
+        ``(user_id, pinned, updated_at)`` nối với user/nhóm và tin nhắn cuối
+        theo khóa chính. Hội thoại được ghim đứng đầu, sau đó mới nhất trước.
+        """
         try:
-            # Lấy các cuộc trò chuyện cá nhân
-            private_convs = self.db.query(Conversation).filter(
-                or_(Conversation.user1_id == user_id, Conversation.user2_id == user_id)
-            ).order_by(desc(Conversation.updated_at)).all()
-            
+            member_count = select(func.count()).select_from(group_members).where(
+                group_members.c.group_id == UserConversationState.group_id
+            ).correlate(UserConversationState).scalar_subquery()
+            states = self.db.query(UserConversationState, member_count).options(
+                joinedload(UserConversationState.other_user),
+                joinedload(UserConversationState.group),
+                joinedload(UserConversationState.last_message).joinedload(Message.sender),
+                joinedload(UserConversationState.last_message).joinedload(Message.receiver),
+            ).filter(UserConversationState.user_id == user_id).order_by(
+                desc(UserConversationState.pinned), desc(UserConversationState.updated_at)
+            ).all()
+
             result = []
-            for conv in private_convs:
-                other_user = conv.user2 if conv.user1_id == user_id else conv.user1
-                unread_count = self.get_unread_count(user_id, other_user.id)
-                
-                result.append({
-                    "type": "private", # Thêm loại hội thoại
-                    "conversation_id": conv.id,
-                    "other_user": self._user_to_dict(other_user),
-                    "last_message": self._message_to_dict(conv.last_message) if conv.last_message else None,
-                    "updated_at": conv.updated_at.isoformat(),
-                    "unread_count": unread_count
+            for state, members in states:
+                if state.group_id:
+                    if state.group is None:
+                        continue
+                    summary = {
+                        "type": "group",
+                        "group_id": state.group_id,
+                        "group_name": state.group.name,
+                        "member_count": members,
+                    }
+                else:
+                    if state.other_user is None:
+                        continue
+                    summary = {
+                        "type": "private",
+                        "other_user": self._user_to_dict(state.other_user),
+                    }
+                summary.update({
+                    "last_message": self._message_to_dict(state.last_message) if state.last_message else None,
+                    "last_message_preview": state.last_message_preview,
+                    "unread_count": max(state.unread_count or 0, 0),
+                    "pinned": bool(state.pinned),
+                    "updated_at": state.updated_at.isoformat() if state.updated_at else None,
                 })
-
-            # Lấy các nhóm mà người dùng là thành viên
-            user = self.db.query(User).filter(User.id == user_id).first()
-            if user:
-                for group in user.groups:
-                    # Tìm tin nhắn cuối cùng của nhóm
-                    last_msg = self.db.query(Message).filter(Message.group_id == group.id).order_by(desc(Message.timestamp)).first()
-                    
-                    result.append({
-                        "type": "group", # Thêm loại hội thoại
-                        "group_id": group.id,
-                        "group_name": group.name,
-                        "member_count": len(group.members),
-                        "last_message": self._message_to_dict(last_msg) if last_msg else None,
-                        "updated_at": last_msg.timestamp.isoformat() if last_msg else group.created_at.isoformat()
-                    })
-            
-            # Sắp xếp lại toàn bộ danh sách dựa trên thời gian cập nhật mới nhất
-            result.sort(key=lambda x: x['updated_at'], reverse=True)
-
+                result.append(summary)
             return result
         except Exception as e:
             print(f"Lỗi khi lấy danh sách hội thoại: {e}")
             return []
-    def mark_messages_as_read(self, user_id: int, sender_id: int):
-        """Đánh dấu tin nhắn đã đọc"""
+    def set_conversation_pinned(self, user_id: int, pinned: bool, other_user_id: int = None,
+                                group_id: int = None) -> bool:
+        """Ghim/bỏ ghim hội thoại trong danh sách của user; False nếu user không có hội thoại đó."""
         try:
-            self.db.query(Message).filter(
-                and_(
-                    Message.sender_id == sender_id,
-                    Message.receiver_id == user_id,
-                    Message.is_read == False
-                )
-            ).update({"is_read": True})
+            table = UserConversationState.__table__
+            changed = self.db.execute(update(table).where(
+                table.c.user_id == user_id, table.c.conversation == self.sync_key(group_id, other_user_id)
+            ).values(pinned=bool(pinned))).rowcount
             self.db.commit()
+            return changed > 0
+        except Exception as e:
+            self.db.rollback()
+            print(f"Error pinning conversation: {e}")
+            return False
+    @staticmethod
+    def sync_key(group_id: int = None, other_user_id: int = None) -> str:
+        """Khóa hội thoại trong gói tin sync: ``group:<id>`` hoặc ``user:<id người kia>``."""
+        return f"group:{group_id}" if group_id else f"user:{other_user_id}"
+    def latest_change_id(self) -> int:
+        return self.db.query(func.max(SyncChange.id)).scalar() or 0
+    def get_sync_delta(self, user_id: int, marks: Dict[str, int], change_id: Optional[int] = None,
+                       last_message_id: Optional[int] = None) -> Dict:
+        """
+        Những gì client đã bỏ lỡ từ lần đồng bộ trước (gói tin sync khi kết nối lại).
+
+        ``marks``: {khóa hội thoại (:meth:`sync_key`): id tin nhắn mới nhất client
+        có} của các hội thoại client đang giữ lịch sử; ``change_id``: id thay đổi
+        cuối cùng client đã nhận; ``last_message_id``: id tin nhắn lớn nhất client
+        đã thấy (để chỉ gửi các hội thoại có thay đổi).
+
+        Kết quả gồm ``messages`` ({khóa: trang tin nhắn còn thiếu}; hội thoại thiếu
+        quá SYNC_MAX_MESSAGES tin chỉ nhận trang mới nhất kèm ``reset``),
+        ``deleted``, ``cleared``, ``joined_groups``, ``left_groups``,
+        ``conversations`` (tóm tắt các hội thoại có thay đổi) và ``change_id``
+        mới. Khi client chưa có ``change_id`` hoặc đã bỏ lỡ quá nhiều thay đổi,
+        trả về ``snapshot`` với danh sách hội thoại và user đầy đủ như lúc đăng nhập.
+        """
+        latest = self.latest_change_id()
+        online_user_ids = [row[0] for row in self.db.query(User.id).filter(User.is_online == True).all()]
+        snapshot = change_id is None or change_id > latest or len(marks) > SYNC_MAX_CONVERSATIONS
+        changes = []
+        if not snapshot and change_id < latest:
+            # Thay đổi cần cho client đã bị dọn (luôn còn giữ bản ghi mới nhất)
+            oldest = self.db.query(func.min(SyncChange.id)).scalar()
+            snapshot = oldest is not None and change_id < oldest - 1
+            if not snapshot:
+                user_group_ids = select(group_members.c.group_id).where(group_members.c.user_id == user_id)
+                changes = self.db.query(SyncChange).filter(
+                    SyncChange.id > change_id, SyncChange.id <= latest,
+                    or_(SyncChange.user_id == user_id, SyncChange.other_user_id == user_id,
+                        SyncChange.group_id.in_(user_group_ids))
+                ).order_by(SyncChange.id).limit(SYNC_MAX_CHANGES + 1).all()
+                snapshot = len(changes) > SYNC_MAX_CHANGES
+        if snapshot:
+            return {"snapshot": True, "change_id": latest, "online_user_ids": online_user_ids,
+                    "conversations": self.get_conversations(user_id),
+                    "all_users": self.get_all_users(exclude_user_id=user_id)}
+
+        deleted: Dict[str, List[int]] = {}
+        cleared = []
+        # Trạng thái thành viên cuối cùng của chính user trong mỗi nhóm có thay đổi
+        membership: Dict[int, str] = {}
+        changed_keys = set()
+        for change in changes:
+            if change.group_id:
+                key = self.sync_key(group_id=change.group_id)
+            else:
+                key = self.sync_key(other_user_id=change.other_user_id if change.user_id == user_id else change.user_id)
+            changed_keys.add(key)
+            if change.kind == "message_deleted":
+                deleted.setdefault(key, []).append(change.message_id)
+            elif change.kind == "chat_cleared":
+                deleted.pop(key, None)
+                if key not in cleared:
+                    cleared.append(key)
+            elif change.user_id == user_id:
+                membership[change.group_id] = change.kind
+        joined = [group_id for group_id, kind in membership.items() if kind == "member_added"]
+        left = [group_id for group_id, kind in membership.items() if kind == "member_removed"]
+
+        messages = {}
+        for key, last_id in marks.items():
+            kind, _, target = key.partition(":")
+            target = int(target)
+            if kind == "group":
+                missing = self._missing_messages(user_id, last_id, group_id=target)
+            else:
+                missing = self._missing_messages(user_id, last_id, other_user_id=target)
+            if missing:
+                messages[key] = missing
+
+        since = last_message_id or 0
+        conversations = []
+        for conversation in self.get_conversations(user_id):
+            if conversation["type"] == "group":
+                key = self.sync_key(group_id=conversation["group_id"])
+            else:
+                key = self.sync_key(other_user_id=conversation["other_user"]["id"])
+            last_message = conversation.get("last_message")
+            if last_message_id is None or key in changed_keys or (last_message and last_message["id"] > since):
+                conversations.append(conversation)
+        return {"snapshot": False, "change_id": latest, "online_user_ids": online_user_ids,
+                "messages": messages, "deleted": deleted, "cleared": cleared,
+                "joined_groups": joined, "left_groups": left, "conversations": conversations}
+    def _missing_messages(self, user_id: int, last_id: int, group_id: int = None,
+                          other_user_id: int = None) -> Optional[Dict]:
+        """Tin nhắn mới hơn ``last_id`` của một hội thoại; quá nhiều thì trang mới nhất kèm ``reset``."""
+        if group_id:
+            is_member = self.db.query(group_members.c.user_id).filter(
+                group_members.c.group_id == group_id, group_members.c.user_id == user_id
+            ).first() is not None
+            if not is_member:
+                return None
+            scopes = [Message.group_id == group_id]
+        else:
+            scopes = [
+                and_(Message.sender_id == user_id, Message.receiver_id == other_user_id, Message.group_id.is_(None)),
+                and_(Message.sender_id == other_user_id, Message.receiver_id == user_id, Message.group_id.is_(None)),
+            ]
+        rows = self._fetch_message_range(scopes, Message.id > last_id, SYNC_MAX_MESSAGES + 1, newest_first=False)
+        if not rows:
+            return None
+        if len(rows) > SYNC_MAX_MESSAGES:
+            page = self.get_message_page(user_id, other_user_id=other_user_id, group_id=group_id)
+            return dict(page, reset=True) if page else None
+        messages = [self._message_to_dict(msg) for msg in rows]
+        if other_user_id:
+            messages = self._apply_read_state(user_id, other_user_id, messages)
+        return {"messages": messages, "has_more": False, "reset": False}
+    def prune_sync_changes(self, retention_days: int = SYNC_CHANGE_RETENTION_DAYS) -> int:
+        """Dọn các thay đổi cũ; bản ghi mới nhất luôn được giữ để nhận ra client đã vắng quá lâu."""
+        try:
+            latest = self.latest_change_id()
+            deleted = self.db.query(SyncChange).filter(
+                SyncChange.created_at < datetime.now() - timedelta(days=retention_days),
+                SyncChange.id < latest
+            ).delete(synchronize_session=False)
+            self.db.commit()
+            return deleted
+        except Exception as e:
+            self.db.rollback()
+            print(f"Error pruning sync changes: {e}")
+            return 0
+    def mark_messages_as_read(self, user_id: int, sender_id: int) -> Optional[int]:
+        """Đánh dấu đã đọc toàn bộ chat riêng với ``sender_id`` (xem :meth:`mark_conversation_read`)."""
+        return self.mark_conversation_read(user_id, other_user_id=sender_id)
+    def mark_conversation_read(self, user_id: int, other_user_id: int = None, group_id: int = None,
+                               message_id: int = None) -> Optional[int]:
+        """
+        Đánh dấu đã đọc đến ``message_id`` (mặc định: tin nhắn mới nhất) bằng
+        một lần upsert read cursor thay vì UPDATE từng tin nhắn. Cursor chỉ tiến
+        lên; trả về vị trí đã đọc mới, hoặc None nếu không thay đổi.
+        """
+        try:
+            if group_id:
+                newest = self.db.query(func.max(Message.id)).filter(Message.group_id == group_id).scalar()
+            else:
+                newest = self.db.query(func.max(Message.id)).filter(
+                    Message.sender_id == other_user_id, Message.receiver_id == user_id,
+                    Message.group_id.is_(None)
+                ).scalar()
+            if not newest:
+                return None
+            last_read = newest if message_id is None else min(int(message_id), newest)
+            key = self.sync_key(group_id, other_user_id)
+            advanced = self._advance_read_cursor(user_id, key, last_read)
+            if advanced:
+                # Tin mới hơn cursor (đến trong lúc đọc) vẫn là chưa đọc
+                unread = self.db.query(func.count()).select_from(Message).filter(
+                    self._unread_scope(user_id, key, last_read)).scalar()
+                table = UserConversationState.__table__
+                self.db.execute(update(table).where(
+                    table.c.user_id == user_id, table.c.conversation == key).values(unread_count=unread))
+            self.db.commit()
+            return last_read if advanced else None
         except Exception as e:
             self.db.rollback()
             print(f"Error marking messages as read: {e}")
+            return None
+    def _advance_read_cursor(self, user_id: int, conversation: str, message_id: int) -> bool:
+        """Upsert một dòng read_cursors (không commit); chỉ ghi khi cursor tiến lên."""
+        table = ReadCursor.__table__
+        values = {"user_id": user_id, "conversation": conversation,
+                  "last_read_message_id": message_id, "updated_at": datetime.now()}
+        dialect_insert = self._dialect_insert()
+        if dialect_insert is not None:
+            statement = dialect_insert(table).values(**values)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.conversation],
+                set_={"last_read_message_id": statement.excluded.last_read_message_id,
+                      "updated_at": statement.excluded.updated_at},
+                where=table.c.last_read_message_id < statement.excluded.last_read_message_id)
+            return self.db.execute(statement).rowcount > 0
+        cursor = self.db.get(ReadCursor, (user_id, conversation))
+        if cursor is None:
+            self.db.add(ReadCursor(**values))
+            return True
+        if cursor.last_read_message_id >= message_id:
+            return False
+        cursor.last_read_message_id = message_id
+        cursor.updated_at = values["updated_at"]
+        return True
+    def _dialect_insert(self):
+        """``insert`` có ON CONFLICT của dialect (PostgreSQL, SQLite); None với dialect khác."""
+        dialect = self.engine.dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        elif dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            return None
+        return dialect_insert
+    def get_group_member_ids(self, group_id: int) -> List[int]:
+        return [row[0] for row in self.db.query(group_members.c.user_id).filter(
+            group_members.c.group_id == group_id).all()]
+    def get_read_cursors(self, user_id: int) -> Dict[str, int]:
+        """Vị trí đã đọc của user trong từng hội thoại: {khóa hội thoại: id tin nhắn}."""
+        rows = self.db.query(ReadCursor.conversation, ReadCursor.last_read_message_id).filter(
+            ReadCursor.user_id == user_id).all()
+        return {conversation: last_read for conversation, last_read in rows}
     def get_unread_count(self, user_id: int, sender_id: int = None) -> int:
-        """Lấy số tin nhắn chưa đọc"""
+        """Lấy số tin nhắn chưa đọc (chat riêng với ``sender_id``, hoặc mọi hội thoại)."""
         try:
-            query = self.db.query(Message).filter(
-                and_(
-                    Message.receiver_id == user_id,
-                    Message.is_read == False
-                )
-            )
             if sender_id:
-                query = query.filter(Message.sender_id == sender_id)
-            return query.count()
+                return sum(self.get_unread_counts(user_id, [self.sync_key(other_user_id=sender_id)]).values())
+            return self.db.query(func.coalesce(func.sum(UserConversationState.unread_count), 0)).filter(
+                UserConversationState.user_id == user_id).scalar()
         except Exception as e:
             print(f"Error getting unread count: {e}")
             return 0
+    def get_unread_counts(self, user_id: int, conversations: List[str]) -> Dict[str, int]:
+        """
+        Số tin chưa đọc của các hội thoại (khóa như :meth:`sync_key`): số tin
+        của người khác có id lớn hơn read cursor. Mỗi hội thoại là một lần đếm
+        trên đoạn cuối của index ``(group_id, id)`` hoặc ``(sender_id,
+        receiver_id, id)``, gộp bằng UNION ALL nên chi phí tỉ lệ với số tin
+        chưa đọc chứ không phải toàn bộ lịch sử.
+        """
+        cursors = self.get_read_cursors(user_id) if conversations else {}
+        counts = {}
+        for start in range(0, len(conversations), UNREAD_COUNT_BATCH):
+            selects = []
+            for key in conversations[start:start + UNREAD_COUNT_BATCH]:
+                scope = self._unread_scope(user_id, key, cursors.get(key, 0))
+                selects.append(select(literal(key, String).label("conversation"),
+                                      func.count().label("unread")).select_from(Message).where(scope))
+            statement = selects[0] if len(selects) == 1 else union_all(*selects)
+            counts.update({conversation: unread for conversation, unread in self.db.execute(statement).all()})
+        return counts
+    @staticmethod
+    def _unread_scope(user_id: int, conversation: str, after_id: int):
+        """Tin nhắn chưa đọc của hội thoại ``conversation`` (khóa như :meth:`sync_key`) sau ``after_id``."""
+        kind, _, target = conversation.partition(":")
+        if kind == "group":
+            return and_(Message.group_id == int(target), Message.id > after_id, Message.sender_id != user_id)
+        return and_(Message.sender_id == int(target), Message.receiver_id == user_id,
+                    Message.group_id.is_(None), Message.id > after_id)
+    def _apply_read_state(self, user_id: int, other_user_id: int, messages: List[Dict]) -> List[Dict]:
+        """
+        ``is_read`` của tin nhắn chat riêng theo read cursor của người nhận. Dict
+        trong cache không bị sửa: tin nhắn có trạng thái khác được thay bằng bản sao.
+        """
+        if not messages:
+            return messages
+        rows = self.db.query(ReadCursor.user_id, ReadCursor.last_read_message_id).filter(or_(
+            and_(ReadCursor.user_id == user_id, ReadCursor.conversation == self.sync_key(other_user_id=other_user_id)),
+            and_(ReadCursor.user_id == other_user_id, ReadCursor.conversation == self.sync_key(other_user_id=user_id)),
+        )).all()
+        read_up_to = dict(rows)
+        result = []
+        for message in messages:
+            reader = other_user_id if message["sender"]["id"] == user_id else user_id
+            is_read = message["id"] <= read_up_to.get(reader, 0)
+            result.append(message if message["is_read"] == is_read else dict(message, is_read=is_read))
+        return result
     def search_messages(self, user_id: int, query: str, limit: int = 20) -> List[Dict]:
-        """Tìm kiếm tin nhắn"""
+        """Tìm kiếm tin nhắn (trang đầu của :meth:`search_message_page`)."""
+        return self.search_message_page(user_id, query, limit)["messages"]
+    def search_message_page(self, user_id: int, query: str, limit: int = 20,
+                            cursor: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Tìm tin nhắn user được xem, xếp theo mức độ khớp.
+
+        ``query`` gồm các từ phải xuất hiện, ``"cụm từ"`` và ``tiền_tố*``. Dùng
+        index toàn văn (tsvector trên PostgreSQL, FTS5 trên SQLite) thay vì
+        ``LIKE '%q%'`` quét toàn bảng. ``next_cursor`` của kết quả được truyền
+        lại qua ``cursor`` để lấy trang sau; ValueError nếu cursor không hợp lệ.
+        """
+        limit = max(1, min(int(limit or SEARCH_PAGE_SIZE), MESSAGE_PAGE_MAX))
+        position = decode_cursor(cursor) if cursor else None
+        terms = parse_search_query(query)
+        if not terms:
+            return {"messages": [], "has_more": False, "next_cursor": None}
         try:
-            # Lấy user để kiểm tra các nhóm mà user tham gia
-            user = self.db.query(User).filter(User.id == user_id).first()
-            user_group_ids = [g.id for g in user.groups] if user else []
-            
-            messages = self.db.query(Message).filter(
-                and_(
-                    or_(
-                        Message.sender_id == user_id,
-                        Message.receiver_id == user_id,
-                        Message.group_id.in_(user_group_ids)  # Tin nhắn từ các nhóm user tham gia
-                    ),
-                    Message.content.contains(query)
-                )
-            ).order_by(desc(Message.timestamp)).limit(limit).all()
-            return [self._message_to_dict(msg) for msg in messages]
+            statement, params = self.search.build(user_id, terms, limit + 1, position)
+            rows = self.db.execute(statement, params).all()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            messages = {message.id: message for message in self.db.query(Message).options(
+                joinedload(Message.sender), joinedload(Message.receiver)
+            ).filter(Message.id.in_([row.id for row in rows])).all()} if rows else {}
+            return {
+                "messages": [self._message_to_dict(messages[row.id]) for row in rows if row.id in messages],
+                "has_more": has_more,
+                "next_cursor": encode_cursor(rows[-1].score, rows[-1].id) if has_more else None,
+            }
         except Exception as e:
+            self.db.rollback()
             print(f"Error searching messages: {e}")
-            return []
+            return {"messages": [], "has_more": False, "next_cursor": None}
     def update_typing_status(self, user_id: int, conversation_id: int = None, is_typing: bool = False):
         """Cập nhật trạng thái đang gõ"""
         try:
@@ -464,11 +1147,45 @@ class DatabaseManager:
         try:
             user = self.db.query(User).filter(User.id == user_id).first()
             if user:
-                user.avatar = avatar_data
+                user.avatar_hash = self.blobs.put_bytes(avatar_data) if avatar_data else None
+                user.avatar = None
                 self.db.commit()
+                self.users.invalidate(user_id)
+                self.message_cache.update_user(user_id, {"avatar_hash": user.avatar_hash})
         except Exception as e:
             self.db.rollback()
             print(f"Error updating avatar: {e}")
+    def get_user_avatar(self, user_id: int) -> Tuple[Optional[str], Optional[bytes]]:
+        """Trả về (avatar_hash, dữ liệu avatar) của user; (None, None) nếu không có avatar."""
+        # Cần User của ORM: avatar cũ nằm trong cột LargeBinary (xem read_avatar)
+        user = self.db.query(User).filter(User.id == user_id).first()
+        if not user:
+            return None, None
+        data = self.read_avatar(user)
+        if data is None:
+            return None, None
+        # Avatar cũ chưa migrate chưa có hash trong database
+        return user.avatar_hash or hashlib.sha256(data).hexdigest(), data
+    def get_file_message(self, message_id: int, user_id: int) -> Optional[Message]:
+        """Lấy tin nhắn có file nếu user được phép xem (người gửi, người nhận hoặc thành viên nhóm)."""
+        try:
+            message = self.db.query(Message).filter(
+                and_(Message.id == message_id, or_(Message.file_hash.isnot(None), Message.file_size.isnot(None)))
+            ).first()
+            if not message:
+                return None
+            if message.group_id:
+                group = self.db.query(Group).filter(Group.id == message.group_id).first()
+                if group and any(member.id == user_id for member in group.members):
+                    return message
+                return None
+            if user_id in (message.sender_id, message.receiver_id):
+                return message
+            return None
+        except Exception as e:
+            self.db.rollback()
+            print(f"Error getting file message: {e}")
+            return None
     def delete_message(self, message_id: int, user_id: int) -> bool:
         """Xóa tin nhắn"""
         try:
@@ -480,8 +1197,13 @@ class DatabaseManager:
             ).first()
             
             if message:
+                key = conversation_key(message.group_id, message.sender_id, message.receiver_id)
+                self.db.add(SyncChange(kind="message_deleted", group_id=message.group_id, user_id=message.sender_id,
+                                       other_user_id=message.receiver_id, message_id=message.id))
+                self._remove_from_conversation_states(message)
                 self.db.delete(message)
                 self.db.commit()
+                self.message_cache.remove(key, message_id)
                 return True
             return False
         except Exception as e:
@@ -515,38 +1237,206 @@ class DatabaseManager:
                 )
             )
             deleted_count = messages_to_delete.delete(synchronize_session=False)
+            table = UserConversationState.__table__
+            self.db.execute(update(table).where(self._state_scope(user_id=user_id, other_user_id=other_user_id)).values(
+                last_message_id=None, last_message_preview=None, unread_count=0))
+            self.db.add(SyncChange(kind="chat_cleared", user_id=user_id, other_user_id=other_user_id))
             self.db.commit()
+            self.message_cache.invalidate(conversation_key(user_id=user_id, other_user_id=other_user_id))
             print(f"Đã xóa thành công {deleted_count} tin nhắn giữa user {user_id} và {other_user_id}")
             return True
         except Exception as e:
             self.db.rollback()
             print(f"Lỗi khi xóa cuộc trò chuyện: {e}")
             return False
-    def _update_conversation(self, user1_id: int, user2_id: int, last_message_id: int):
-        """Cập nhật hội thoại"""
-        try:
-            conversation = self.db.query(Conversation).filter(
-                or_(
-                    and_(Conversation.user1_id == user1_id, Conversation.user2_id == user2_id),
-                    and_(Conversation.user1_id == user2_id, Conversation.user2_id == user1_id)
-                )
-            ).first()
+    def _update_conversations(self, latest: Dict[Tuple[int, int], int]):
+        """
+        Cập nhật (hoặc tạo) hội thoại riêng với tin nhắn cuối cùng, không commit.
+        ``latest``: {(user1_id, user2_id): last_message_id}, thứ tự user không quan trọng.
+        """
+        by_pair: Dict[Tuple[int, int], int] = {}
+        for (user1_id, user2_id), message_id in latest.items():
+            pair = (min(user1_id, user2_id), max(user1_id, user2_id))
+            by_pair[pair] = max(message_id, by_pair.get(pair, message_id))
+        if not by_pair:
+            return
+        # Hội thoại cũ có thể lưu user theo thứ tự bất kỳ
+        conditions = []
+        for user1_id, user2_id in by_pair:
+            conditions.append(and_(Conversation.user1_id == user1_id, Conversation.user2_id == user2_id))
+            conditions.append(and_(Conversation.user1_id == user2_id, Conversation.user2_id == user1_id))
+        existing = {}
+        for conversation in self.db.query(Conversation).filter(or_(*conditions)).all():
+            pair = (min(conversation.user1_id, conversation.user2_id),
+                    max(conversation.user1_id, conversation.user2_id))
+            existing.setdefault(pair, conversation)
+        now = datetime.now()
+        for pair, message_id in by_pair.items():
+            conversation = existing.get(pair)
             if conversation:
-                conversation.last_message_id = last_message_id
-                conversation.updated_at = datetime.now()
+                if (conversation.last_message_id or 0) < message_id:
+                    conversation.last_message_id = message_id
+                    conversation.updated_at = now
             else:
-                conversation = Conversation(
-                    user1_id=min(user1_id, user2_id),
-                    user2_id=max(user1_id, user2_id),
-                    last_message_id=last_message_id
-                )
-                self.db.add(conversation)
+                self.db.add(Conversation(user1_id=pair[0], user2_id=pair[1], last_message_id=message_id))
+    def _state_scope(self, group_id: int = None, user_id: int = None, other_user_id: int = None):
+        """Các dòng user_conversation_state của một hội thoại (mọi người tham gia)."""
+        table = UserConversationState.__table__
+        if group_id:
+            return table.c.conversation == self.sync_key(group_id=group_id)
+        return or_(
+            and_(table.c.user_id == user_id, table.c.conversation == self.sync_key(other_user_id=other_user_id)),
+            and_(table.c.user_id == other_user_id, table.c.conversation == self.sync_key(other_user_id=user_id)),
+        )
+    def _update_conversation_states(self, rows: List[Dict[str, Any]]):
+        """
+        Cập nhật user_conversation_state theo các tin nhắn vừa ghi, không commit:
+        tin nhắn cuối và thời gian của mọi người trong hội thoại (chỉ khi tin mới
+        hơn tin cuối đang lưu), số tin chưa đọc của những người không gửi tin đó.
+        Mỗi hội thoại trong lô là một câu lệnh (chat riêng: upsert mỗi người).
+        """
+        table = UserConversationState.__table__
+        conversations: Dict[Tuple, Dict[str, Any]] = {}
+        for row in rows:
+            key = conversation_key(row.get("group_id"), row["sender_id"], row.get("receiver_id"))
+            entry = conversations.setdefault(key, {"last": row, "sent": {}})
+            if row["id"] > entry["last"]["id"]:
+                entry["last"] = row
+            entry["sent"][row["sender_id"]] = entry["sent"].get(row["sender_id"], 0) + 1
+        for key, entry in conversations.items():
+            last = entry["last"]
+            newer = or_(table.c.last_message_id.is_(None), table.c.last_message_id < last["id"])
+            changes = {
+                column: case((newer, value), else_=table.c[column])
+                for column, value in (("last_message_id", last["id"]),
+                                      ("last_message_preview", last["content"][:CONVERSATION_PREVIEW_LENGTH]),
+                                      ("updated_at", last.get("timestamp") or datetime.now()))
+            }
+            if key[0] == "group":
+                # Mọi thành viên nhận thêm cả lô, trừ các tin do chính họ gửi
+                own = case(entry["sent"], value=table.c.user_id, else_=0)
+                total = sum(entry["sent"].values())
+                self.db.execute(update(table).where(self._state_scope(group_id=key[1])).values(
+                    unread_count=table.c.unread_count + total - own, **changes))
+                continue
+            for user_id, other_user_id in {(key[1], key[2]), (key[2], key[1])}:
+                unread = entry["sent"].get(other_user_id, 0)
+                self._upsert_conversation_state(user_id, other_user_id, last, unread,
+                                                dict(changes, unread_count=table.c.unread_count + unread))
+    def _upsert_conversation_state(self, user_id: int, other_user_id: int, last: Dict[str, Any], unread: int,
+                                   changes: Dict[str, Any]):
+        """Tạo dòng user_conversation_state của chat riêng, hoặc áp dụng ``changes`` nếu đã có."""
+        table = UserConversationState.__table__
+        conversation = self.sync_key(other_user_id=other_user_id)
+        values = {"user_id": user_id, "conversation": conversation, "other_user_id": other_user_id,
+                  "last_message_id": last["id"],
+                  "last_message_preview": last["content"][:CONVERSATION_PREVIEW_LENGTH],
+                  "updated_at": last.get("timestamp") or datetime.now(), "unread_count": unread, "pinned": False}
+        dialect_insert = self._dialect_insert()
+        if dialect_insert is not None:
+            self.db.execute(dialect_insert(table).values(**values).on_conflict_do_update(
+                index_elements=[table.c.user_id, table.c.conversation], set_=changes))
+            return
+        updated = self.db.execute(update(table).where(
+            table.c.user_id == user_id, table.c.conversation == conversation).values(**changes)).rowcount
+        if not updated:
+            self.db.execute(insert(table).values(**values))
+    def _remove_from_conversation_states(self, message: Message):
+        """
+        Cập nhật user_conversation_state trước khi xóa ``message``, không commit:
+        người chưa đọc tin (read cursor nhỏ hơn id) bớt một tin chưa đọc, hội
+        thoại có tin cuối là tin này lấy tin liền trước làm tin cuối.
+        """
+        table = UserConversationState.__table__
+        scope = self._state_scope(message.group_id, message.sender_id, message.receiver_id)
+        read_up_to = select(ReadCursor.last_read_message_id).where(
+            ReadCursor.user_id == table.c.user_id, ReadCursor.conversation == table.c.conversation
+        ).scalar_subquery()
+        self.db.execute(update(table).where(
+            scope, table.c.user_id != message.sender_id, table.c.unread_count > 0,
+            func.coalesce(read_up_to, 0) < message.id
+        ).values(unread_count=table.c.unread_count - 1))
+        if message.group_id:
+            scopes = [Message.group_id == message.group_id]
+        else:
+            scopes = [
+                and_(Message.sender_id == message.sender_id, Message.receiver_id == message.receiver_id,
+                     Message.group_id.is_(None)),
+                and_(Message.sender_id == message.receiver_id, Message.receiver_id == message.sender_id,
+                     Message.group_id.is_(None)),
+            ]
+        previous = self._fetch_message_range(scopes, Message.id < message.id, 1, newest_first=True)
+        self.db.execute(update(table).where(scope, table.c.last_message_id == message.id).values(
+            last_message_id=previous[0].id if previous else None,
+            last_message_preview=previous[0].content[:CONVERSATION_PREVIEW_LENGTH] if previous else None))
+    def insert_messages(self, rows: List[Dict[str, Any]]):
+        """
+        Ghi một lô tin nhắn đã có ID (từ MessageIngestor) trong một transaction:
+        một câu INSERT nhiều dòng và cập nhật hội thoại của cả lô. Ném lỗi nếu thất bại.
+        """
+        if not rows:
+            return
+        # Khóa tìm kiếm được tính lúc ghi (journal không lưu để gọn)
+        rows = [dict(row, search_key=search_key(row["content"])) for row in rows]
+        try:
+            self.db.execute(insert(Message), rows)
+            latest = {}
+            for row in rows:
+                if row.get("receiver_id"):
+                    latest[(row["sender_id"], row["receiver_id"])] = row["id"]
+            self._update_conversations(latest)
+            self._update_conversation_states(rows)
+            self._advance_message_sequence()
             self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        self._cache_inserted_messages(rows)
+    def _cache_inserted_messages(self, rows: List[Dict[str, Any]]):
+        """Đưa các tin nhắn vừa ghi theo lô vào cache của các hội thoại đang được cache."""
+        keys = {row["id"]: conversation_key(row.get("group_id"), row["sender_id"], row.get("receiver_id"))
+                for row in rows}
+        cached_ids = [message_id for message_id, key in keys.items() if key in self.message_cache]
+        try:
+            if cached_ids:
+                messages = self.db.query(Message).options(
+                    joinedload(Message.sender), joinedload(Message.receiver)
+                ).filter(Message.id.in_(cached_ids)).all()
+                for message in messages:
+                    self.message_cache.add(keys[message.id], self._message_to_dict(message))
         except Exception as e:
             self.db.rollback()
-            print(f"Error updating conversation: {e}")
-    def _user_to_dict(self, user: User) -> Dict:
+            print(f"⚠️ Không cập nhật được cache tin nhắn: {e}")
+            cached_ids = []
+        # Hội thoại không được cập nhật: bỏ khỏi cache (và hủy các lần đọc đang chờ đưa vào cache)
+        for key in set(keys.values()) - {keys[message_id] for message_id in cached_ids}:
+            self.message_cache.invalidate(key)
+    def _advance_message_sequence(self):
+        """ID được cấp ngoài sequence; đẩy sequence lên để INSERT không kèm ID không bị trùng."""
+        if self.engine.dialect.name == "postgresql":
+            self.db.execute(text(
+                "SELECT setval(pg_get_serial_sequence('messages', 'id'), "
+                "GREATEST((SELECT MAX(id) FROM messages), 1))"))
+    def is_reply_target(self, message_id: int, user_id: int, other_user_id: int = None, group_id: int = None) -> bool:
+        """Tin nhắn ``message_id`` có tồn tại và thuộc cùng hội thoại (chat riêng hoặc nhóm) không."""
+        if group_id:
+            scope = Message.group_id == group_id
+        else:
+            scope = and_(Message.group_id.is_(None),
+                         or_(and_(Message.sender_id == user_id, Message.receiver_id == other_user_id),
+                             and_(Message.sender_id == other_user_id, Message.receiver_id == user_id)))
+        return self.db.query(Message.id).filter(Message.id == message_id, scope).first() is not None
+    def existing_message_ids(self, message_ids: List[int]) -> set:
+        """Các ID trong danh sách đã có trong bảng messages."""
+        if not message_ids:
+            return set()
+        return {row[0] for row in self.db.query(Message.id).filter(Message.id.in_(message_ids)).all()}
+    def max_message_id(self) -> int:
+        return self.db.query(func.max(Message.id)).scalar() or 0
+    def _user_to_dict(self, user: Union[User, DirectoryUser]) -> Dict:
         """Convert User object to dictionary"""
+        if isinstance(user, DirectoryUser):
+            return user.profile
         return {
             "id": user.id,
             "username": user.username,
@@ -556,28 +1446,59 @@ class DatabaseManager:
             "status_message": user.status_message,
             "is_online": user.is_online,
             "last_seen": user.last_seen.isoformat() if user.last_seen else None,
-            "avatar": base64.b64encode(user.avatar).decode() if user.avatar else None,
+            # Chỉ gửi hash; client tải nội dung bằng get_avatar khi chưa có trong cache
+            "avatar_hash": user.avatar_hash,
             "created_at": user.created_at.isoformat()
         }
-    def _message_to_dict(self, message: Message) -> Dict:
-        """Convert Message object to dictionary (đã cập nhật để hỗ trợ group_id)."""
+    def _message_to_dict(self, message: Message, sender: Optional[User] = None,
+                         receiver: Optional[User] = None) -> Dict:
+        """
+        Convert Message object to dictionary (đã cập nhật để hỗ trợ group_id).
+        ``sender``/``receiver`` dùng cho tin nhắn chưa được ghi xuống database.
+        """
         if not message: return None
+        sender = sender or message.sender
+        receiver = receiver or message.receiver
         return {
             "id": message.id,
             "client_message_id": message.client_message_id,
-            "sender": self._user_to_dict(message.sender),
-            "receiver": self._user_to_dict(message.receiver) if message.receiver else None,
+            "sender": self._user_to_dict(sender),
+            "receiver": self._user_to_dict(receiver) if receiver else None,
             "group_id": message.group_id, # <<< THÊM DÒNG NÀY
             "content": message.content,
             "message_type": message.message_type,
             "file_name": message.file_name,
-            "file_data": base64.b64encode(message.file_data).decode() if message.file_data else None,
+            "attachment": self._attachment_to_dict(message),
             "file_size": message.file_size,
             "timestamp": message.timestamp.isoformat(),
             "is_read": message.is_read,
             "is_edited": message.is_edited,
             "reply_to_id": message.reply_to_id
         }
+    def _attachment_to_dict(self, message: Message) -> Optional[Dict]:
+        """Metadata của file đính kèm; nội dung được client lấy riêng bằng get_attachment."""
+        if not (message.file_hash or message.file_size):
+            return None
+        return {
+            "id": message.id,
+            "name": message.file_name,
+            "size": message.file_size,
+            "mime": mimetypes.guess_type(message.file_name or "")[0] or "application/octet-stream",
+            "hash": message.file_hash,
+            "thumbnail": self._thumbnail_to_dict(message.file_hash, message.file_name),
+        }
+    def _thumbnail_to_dict(self, file_hash: Optional[str], file_name: Optional[str]) -> Optional[Dict]:
+        """
+        Ảnh thu nhỏ của file ảnh: các kích thước đã có và ``pending`` nếu đang được tạo.
+        None nếu không có ảnh thu nhỏ (client dùng ảnh gốc).
+        """
+        if not file_hash or not self.thumbnails.is_image(file_name):
+            return None
+        sizes = self.thumbnails.available_sizes(file_hash)
+        pending = self.thumbnails.is_pending(file_hash)
+        if not sizes and not pending:
+            return None
+        return {"mime": THUMBNAIL_MIME, "sizes": sizes, "pending": pending}
     def cleanup_expired_sessions(self):
         """Xóa session hết hạn"""
         try:
@@ -590,7 +1511,8 @@ class DatabaseManager:
             print(f"Error cleaning up sessions: {e}")
     def close(self):
         """Đóng kết nối database"""
-        self.db.close()
+        self.remove_session()
+        self.engine.dispose()
     def create_chat_group(self, name: str, creator_id: int, member_ids: List[int]) -> Tuple[bool, str, Optional[Group]]:
         """Tạo một nhóm chat mới."""
         try:
@@ -615,6 +1537,13 @@ class DatabaseManager:
             new_group.members.extend(members)
             
             self.db.add(new_group)
+            self.db.flush()
+            self.db.add_all([SyncChange(kind="member_added", group_id=new_group.id, user_id=member.id)
+                             for member in members])
+            now = datetime.now()
+            self.db.add_all([UserConversationState(user_id=member.id, conversation=self.sync_key(group_id=new_group.id),
+                                                   group_id=new_group.id, unread_count=0, pinned=False, updated_at=now)
+                             for member in members])
             self.db.commit()
             self.db.refresh(new_group)
             
@@ -643,6 +1572,8 @@ class DatabaseManager:
                 return False, "Người dùng này đã là thành viên của nhóm."
 
             group.members.append(member_to_add)
+            self.db.add(SyncChange(kind="member_added", group_id=group_id, user_id=member_id_to_add))
+            self._join_group_state(member_id_to_add, group_id)
             self.db.commit()
             print(f"User {member_id_to_add} đã được thêm vào nhóm {group_id} bởi {actor_id}.")
             return True, "Thêm thành viên thành công."
@@ -651,6 +1582,19 @@ class DatabaseManager:
             print(f"Lỗi khi thêm thành viên: {e}")
             return False, "Lỗi server khi thêm thành viên."
 
+    def _join_group_state(self, user_id: int, group_id: int):
+        """
+        Read cursor và dòng user_conversation_state của thành viên mới, không
+        commit: lịch sử trước khi vào nhóm không tính là tin chưa đọc.
+        """
+        newest = self.db.query(Message).filter(Message.group_id == group_id).order_by(desc(Message.id)).first()
+        if newest:
+            self._advance_read_cursor(user_id, self.sync_key(group_id=group_id), newest.id)
+        self.db.merge(UserConversationState(
+            user_id=user_id, conversation=self.sync_key(group_id=group_id), group_id=group_id,
+            last_message_id=newest.id if newest else None,
+            last_message_preview=newest.content[:CONVERSATION_PREVIEW_LENGTH] if newest else None,
+            unread_count=0, pinned=False, updated_at=newest.timestamp if newest else datetime.now()))
     def remove_member_from_group(self, group_id: int, actor_id: int, member_id_to_remove: int) -> Tuple[bool, str]:
         """Xóa một thành viên khỏi nhóm."""
         try:
@@ -674,6 +1618,10 @@ class DatabaseManager:
                 return False, "Người dùng này không phải là thành viên của nhóm."
 
             group.members.remove(member_to_remove)
+            self.db.add(SyncChange(kind="member_removed", group_id=group_id, user_id=member_id_to_remove))
+            table = UserConversationState.__table__
+            self.db.execute(delete(table).where(
+                table.c.user_id == member_id_to_remove, table.c.conversation == self.sync_key(group_id=group_id)))
             self.db.commit()
             print(f"User {member_id_to_remove} đã bị xóa khỏi nhóm {group_id} bởi {actor_id}.")
             return True, "Xóa thành viên thành công."
@@ -0,0 +1,168 @@
+import math
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+@dataclass
+class RequestContext:
+    """Thông tin của một gói tin đang được xử lý, truyền cho middleware và handler."""
+    message_type: Optional[str]
+    message: dict
+    connection: Any = None
+    address: Any = None
+    requires_session: bool = True
+    # Được middleware phiên đăng nhập điền vào
+    user_id: Optional[int] = None
+
+
+Handler = Callable[[dict, RequestContext], Optional[dict]]
+Middleware = Callable[[RequestContext, Callable[[RequestContext], Optional[dict]]], Optional[dict]]
+
+
+class HandlerStats:
+    """
+    Bộ đếm của một loại gói tin: số lần gọi, lỗi và độ trễ.
+
+    Percentile được tính trên ``window`` lần gọi gần nhất để phản ánh tình
+    trạng hiện tại thay vì trung bình từ lúc server khởi động.
+    """
+
+    def __init__(self, window: int = 1024):
+        self.count = 0
+        # Handler ném exception
+        self.errors = 0
+        # Handler trả về success=False (session sai, dữ liệu không hợp lệ, ...)
+        self.failures = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, elapsed_ms: float, error: bool = False, failure: bool = False):
+        with self._lock:
+            self.count += 1
+            self.errors += int(error)
+            self.failures += int(failure)
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            self._samples.append(elapsed_ms)
+
+    @staticmethod
+    def _percentile(ordered: List[float], fraction: float) -> float:
+        if not ordered:
+            return 0.0
+        # Nearest-rank
+        index = max(0, math.ceil(fraction * len(ordered)) - 1)
+        return ordered[min(index, len(ordered) - 1)]
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            ordered = sorted(self._samples)
+            count = self.count
+            return {
+                "count": count,
+                "errors": self.errors,
+                "failures": self.failures,
+                "avg_ms": round(self.total_ms / count, 3) if count else 0.0,
+                "p50_ms": round(self._percentile(ordered, 0.50), 3),
+                "p95_ms": round(self._percentile(ordered, 0.95), 3),
+                "p99_ms": round(self._percentile(ordered, 0.99), 3),
+                "max_ms": round(self.max_ms, 3),
+            }
+
+
+class MessageDispatcher:
+    """
+    Bảng ánh xạ loại gói tin -> handler.
+
+    Mỗi handler có dạng ``handler(message, ctx) -> response``. Middleware bọc
+    quanh mọi handler theo thứ tự đăng ký (ví dụ kiểm tra phiên đăng nhập) với
+    dạng ``middleware(ctx, call_next) -> response``. Module ngoài có thể thêm
+    loại gói tin mới bằng :meth:`register` mà không cần sửa ChatServer.
+    """
+
+    UNKNOWN_TYPE = "<unknown>"
+
+    def __init__(self, stats_window: int = 1024):
+        self.stats_window = stats_window
+        self._handlers: Dict[str, Tuple[Handler, bool]] = {}
+        self._middleware: List[Middleware] = []
+        self._stats: Dict[str, HandlerStats] = {}
+        self._lock = threading.Lock()
+
+    def register(self, message_type: str, handler: Handler, requires_session: bool = True,
+                 replace: bool = False):
+        """Đăng ký handler cho ``message_type``; ``replace=True`` để thay handler đã có."""
+        with self._lock:
+            if message_type in self._handlers and not replace:
+                raise ValueError(f"Loại gói tin '{message_type}' đã có handler")
+            self._handlers[message_type] = (handler, requires_session)
+
+    def route(self, message_type: str, requires_session: bool = True):
+        """Decorator tương đương :meth:`register`."""
+        def decorator(handler: Handler) -> Handler:
+            self.register(message_type, handler, requires_session)
+            return handler
+        return decorator
+
+    def unregister(self, message_type: str):
+        with self._lock:
+            self._handlers.pop(message_type, None)
+
+    def use(self, middleware: Middleware):
+        """Thêm middleware; middleware đăng ký trước chạy ngoài cùng."""
+        self._middleware.append(middleware)
+
+    def message_types(self) -> List[str]:
+        return sorted(self._handlers)
+
+    def dispatch(self, message: dict, connection=None, address=None) -> Optional[dict]:
+        message_type = message.get('type')
+        entry = self._handlers.get(message_type)
+        if entry is None:
+            self._stats_for(self.UNKNOWN_TYPE).record(0.0, failure=True)
+            return {"success": False, "error": "Unknown message type"}
+        handler, requires_session = entry
+        ctx = RequestContext(message_type, message, connection, address, requires_session)
+
+        def call_handler(context: RequestContext) -> Optional[dict]:
+            return handler(context.message, context)
+
+        chain = call_handler
+        for middleware in reversed(self._middleware):
+            chain = self._wrap(middleware, chain)
+
+        error = False
+        response = None
+        started = time.perf_counter()
+        try:
+            response = chain(ctx)
+        except Exception as e:
+            error = True
+            print(f"❌ Error processing message type {message_type}: {e}")
+            response = {"success": False, "error": str(e)}
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            failure = isinstance(response, dict) and response.get('success') is False
+            self._stats_for(message_type).record(elapsed_ms, error=error, failure=failure and not error)
+        return response
+
+    @staticmethod
+    def _wrap(middleware: Middleware, call_next: Callable[[RequestContext], Optional[dict]]):
+        return lambda ctx: middleware(ctx, call_next)
+
+    def _stats_for(self, message_type: str) -> HandlerStats:
+        stats = self._stats.get(message_type)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(message_type, HandlerStats(self.stats_window))
+        return stats
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Số lần gọi, lỗi và độ trễ p50/p95/p99 (ms) theo loại gói tin."""
+        with self._lock:
+            items = sorted(self._stats.items())
+        return {message_type: stats.snapshot() for message_type, stats in items}
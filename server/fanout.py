@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from common.protocol import encode_json, pack_frame
+from .connection import ClientConnection, is_droppable
+
+
+class EncodedMessage:
+    """
+    Một gói tin đã được mã hóa đúng một lần.
+
+    Payload JSON (và frame có header, tạo khi cần) là ``bytes`` bất biến nên
+    có thể đưa cùng một buffer vào hàng đợi của mọi người nhận.
+    """
+
+    __slots__ = ('message_type', 'payload', 'droppable', '_framed')
+
+    def __init__(self, message: dict):
+        self.message_type = message.get('type')
+        self.payload = encode_json(message)
+        self.droppable = is_droppable(message)
+        self._framed: Optional[bytes] = None
+
+    @property
+    def framed(self) -> bytes:
+        if self._framed is None:
+            self._framed = pack_frame(self.payload)
+        return self._framed
+
+    def data_for(self, connection: ClientConnection) -> bytes:
+        """Bytes gửi cho một kết nối (JSON trần cho client cũ, frame cho client mới)."""
+        return self.payload if connection.legacy else self.framed
+
+
+@dataclass
+class BroadcastStats:
+    """Số liệu của một lần broadcast."""
+    message_type: Optional[str]
+    recipients: int
+    delivered: int
+    payload_bytes: int
+    encode_ms: float
+    send_ms: float
+
+
+class FanoutEngine:
+    """Broadcast một gói tin đến nhiều kết nối, chỉ mã hóa một lần."""
+
+    def __init__(self, history_size: int = 256):
+        self._lock = threading.Lock()
+        self.recent: deque = deque(maxlen=history_size)
+        # {message_type: {"broadcasts", "recipients", "delivered", "encode_ms", "send_ms"}}
+        self._totals: Dict[str, Dict[str, float]] = {}
+
+    def encode(self, message: dict) -> EncodedMessage:
+        return EncodedMessage(message)
+
+    def broadcast(self, message, connections: Iterable[ClientConnection]) -> BroadcastStats:
+        """
+        Gửi gói tin (dict hoặc EncodedMessage) đến các kết nối.
+
+        Việc gửi chỉ là đưa vào hàng đợi của từng kết nối nên không bị chặn
+        bởi client nhận chậm.
+        """
+        started = time.perf_counter()
+        encoded = message if isinstance(message, EncodedMessage) else self.encode(message)
+        encoded_at = time.perf_counter()
+        recipients = 0
+        delivered = 0
+        for connection in connections:
+            recipients += 1
+            if connection.send(encoded.data_for(connection), droppable=encoded.droppable):
+                delivered += 1
+        finished = time.perf_counter()
+        stats = BroadcastStats(
+            message_type=encoded.message_type,
+            recipients=recipients,
+            delivered=delivered,
+            payload_bytes=len(encoded.payload),
+            encode_ms=(encoded_at - started) * 1000,
+            send_ms=(finished - encoded_at) * 1000,
+        )
+        self._record(stats)
+        return stats
+
+    def _record(self, stats: BroadcastStats):
+        with self._lock:
+            self.recent.append(stats)
+            totals = self._totals.setdefault(stats.message_type or "unknown", {
+                "broadcasts": 0, "recipients": 0, "delivered": 0, "encode_ms": 0.0, "send_ms": 0.0
+            })
+            totals["broadcasts"] += 1
+            totals["recipients"] += stats.recipients
+            totals["delivered"] += stats.delivered
+            totals["encode_ms"] += stats.encode_ms
+            totals["send_ms"] += stats.send_ms
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Tổng hợp theo loại gói tin: số lần broadcast, người nhận, thời gian trung bình."""
+        with self._lock:
+            result = {}
+            for message_type, totals in self._totals.items():
+                count = totals["broadcasts"] or 1
+                result[message_type] = {
+                    "broadcasts": totals["broadcasts"],
+                    "recipients": totals["recipients"],
+                    "delivered": totals["delivered"],
+                    "avg_encode_ms": round(totals["encode_ms"] / count, 3),
+                    "avg_send_ms": round(totals["send_ms"] / count, 3),
+                }
+            return result
+
+    def recent_broadcasts(self) -> List[BroadcastStats]:
+        with self._lock:
+            return list(self.recent)
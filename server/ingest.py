@@ -0,0 +1,383 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError, TimeoutError
+
+from .database import DatabaseManager
+from .models import Message, User
+
+
+class MessageIngestor:
+    """
+    Ghi tin nhắn văn bản theo kiểu write-behind.
+
+    ID được cấp trong bộ nhớ, tin nhắn được ghi vào journal cục bộ rồi trả về
+    ngay để server xác nhận và broadcast; một thread nền ghi xuống database
+    theo lô (mỗi ``batch_size`` tin nhắn hoặc ``flush_interval_ms`` ms) trong
+    một transaction. Journal chỉ chứa tin nhắn chưa được ghi, và được phát lại
+    khi server khởi động nên tin nhắn đã xác nhận không bị mất khi server dừng
+    đột ngột.
+
+    Journal được fsync theo nhóm (group commit): người gửi ghi dòng của mình
+    khi giữ lock rồi chờ ngoài lock; một người gửi fsync một lần cho mọi dòng
+    đã ghi đến lúc đó, những người còn lại chỉ chờ kết quả.
+
+    Mọi tin nhắn (kể cả tin nhắn file ghi trực tiếp qua ``save_message``) phải
+    lấy ID từ :meth:`allocate_id` để không trùng với tin nhắn đang chờ ghi.
+    """
+
+    # Chờ trước khi thử lại khi không ghi được xuống database (mất kết nối, pool
+    # hết kết nối, ...); mỗi lần thất bại liên tiếp chờ gấp đôi, tối đa MAX_RETRY_DELAY
+    RETRY_DELAY = 1.0
+    MAX_RETRY_DELAY = 30.0
+    # Lỗi kết nối: cả lô được thử lại. Lỗi khác (dòng không hợp lệ) được ghi từng dòng
+    # và dòng vẫn lỗi bị loại bỏ, để một tin nhắn hỏng không chặn mọi tin nhắn sau nó
+    CONNECTION_ERRORS = (OperationalError, InterfaceError, DisconnectionError, TimeoutError)
+    # Loại tin nhắn văn bản đi qua hàng đợi (ảnh/file được ghi trực tiếp khi upload xong)
+    MESSAGE_TYPES = frozenset({"text", "emoji"})
+    MAX_CONTENT_LENGTH = 10000
+    # Độ dài cột messages.client_message_id
+    MAX_CLIENT_MESSAGE_ID_LENGTH = 100
+
+    def __init__(self, db: DatabaseManager, journal_path: str = "ingest.journal", batch_size: int = 100,
+                 flush_interval_ms: int = 50, fsync: bool = True, max_journal_bytes: int = 8 * 1024 * 1024):
+        self.db = db
+        self.journal_path = journal_path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0, flush_interval_ms) / 1000.0
+        self.fsync = fsync
+        self.max_journal_bytes = max_journal_bytes
+        # Thứ tự khóa: _sync_lock rồi mới đến _lock
+        self._sync_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._persisted = threading.Condition(self._lock)
+        self._synced = threading.Condition(self._lock)
+        # ID lớn nhất đã được fsync trong journal và có người gửi đang fsync hay không
+        self._synced_id = 0
+        self._syncing = False
+        self._stopping = threading.Event()
+        self._queue: Deque[Dict[str, Any]] = deque()
+        # Lô đang được ghi (đã lấy khỏi hàng đợi nhưng chưa commit)
+        self._in_flight: List[Dict[str, Any]] = []
+        # Lô bỏ dở khi server dừng lúc database lỗi: chỉ còn trong journal, không được cắt bỏ
+        self._unsaved: List[Dict[str, Any]] = []
+        self._next_id = 0
+        self._last_queued_id = 0
+        # ID lớn nhất đã xử lý xong (ghi thành công hoặc bị loại bỏ)
+        self._done_id = 0
+        self._journal = None
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._counters = {"submitted": 0, "persisted": 0, "rejected": 0, "batches": 0, "retries": 0,
+                          "replayed": 0, "max_batch": 0, "last_flush_ms": 0.0, "journal_syncs": 0}
+
+    def start(self):
+        """Phát lại journal của lần chạy trước, khởi tạo bộ cấp ID và thread ghi nền."""
+        directory = os.path.dirname(os.path.abspath(self.journal_path))
+        os.makedirs(directory, exist_ok=True)
+        replay = self._read_journal()
+        try:
+            self._replay(replay)
+            self._next_id = max(self.db.max_message_id(), max((row["id"] for row in replay), default=0))
+        finally:
+            self.db.remove_session()
+        self._done_id = self._last_queued_id = self._synced_id = self._next_id
+        self._unsaved = []
+        # Journal đã được phát lại hết, bắt đầu file mới
+        self._journal = open(self.journal_path, 'wb')
+        self._sync_journal()
+        self._stopping.clear()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="message-ingest", daemon=True)
+        self._thread.start()
+
+    def allocate_id(self) -> int:
+        """Cấp ID cho tin nhắn được ghi trực tiếp (không qua hàng đợi)."""
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    @classmethod
+    def validate(cls, content: Any, message_type: Any = "text", client_message_id: Any = None) -> Optional[str]:
+        """
+        Kiểm tra dữ liệu client gửi trước khi xác nhận tin nhắn; trả về thông báo
+        lỗi hoặc None. Tin nhắn đã xác nhận phải ghi được xuống database.
+        """
+        if content is not None and not isinstance(content, str):
+            return "Invalid message content"
+        if content and len(content) > cls.MAX_CONTENT_LENGTH:
+            return f"Message too long (max {cls.MAX_CONTENT_LENGTH} characters)"
+        if message_type not in cls.MESSAGE_TYPES:
+            return "Invalid message type"
+        if client_message_id is not None and (not isinstance(client_message_id, str)
+                                              or len(client_message_id) > cls.MAX_CLIENT_MESSAGE_ID_LENGTH):
+            return "Invalid client_message_id"
+        return None
+
+    def submit(self, sender: User, receiver: Optional[User] = None, group_id: Optional[int] = None,
+               content: str = "", message_type: str = "text", reply_to_id: Optional[int] = None,
+               client_message_id: Optional[str] = None) -> Dict:
+        """
+        Nhận một tin nhắn văn bản: cấp ID, ghi journal và đưa vào hàng đợi.
+
+        Trả về dict của tin nhắn (giống ``_message_to_dict``) để broadcast ngay;
+        tin nhắn được ghi xuống database sau đó. Ném ValueError nếu :meth:`validate`
+        từ chối tin nhắn.
+        """
+        error = self.validate(content, message_type, client_message_id)
+        if error:
+            raise ValueError(error)
+        row = {
+            "sender_id": sender.id,
+            "receiver_id": receiver.id if receiver else None,
+            "group_id": None if receiver else group_id,
+            "content": content or "",
+            "message_type": message_type,
+            "reply_to_id": reply_to_id,
+            "client_message_id": client_message_id,
+            "timestamp": datetime.now(),
+            "is_read": False,
+            "is_edited": False,
+        }
+        with self._lock:
+            if not self._running:
+                raise RuntimeError("Message ingestor is not running")
+            self._next_id += 1
+            row["id"] = self._next_id
+            # Ghi journal trước khi xác nhận; thứ tự trong journal trùng thứ tự ID
+            self._journal.write(self._encode(row))
+            if not self.fsync:
+                self._journal.flush()
+            self._queue.append(row)
+            self._last_queued_id = row["id"]
+            self._counters["submitted"] += 1
+            if len(self._queue) == 1 or len(self._queue) >= self.batch_size:
+                self._wakeup.notify()
+        if self.fsync:
+            self._wait_journal_synced(row["id"])
+        return self.db._message_to_dict(Message(**row), sender=sender, receiver=receiver)
+
+    def _wait_journal_synced(self, row_id: int):
+        """Chờ đến khi dòng journal ``row_id`` đã được fsync; tự fsync nếu chưa ai làm."""
+        with self._lock:
+            while self._synced_id < row_id:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._synced.wait()
+            else:
+                return
+        target = row_id
+        try:
+            with self._sync_lock:
+                with self._lock:
+                    # Gồm cả các dòng người khác ghi trong lúc chờ fsync trước đó
+                    target = self._last_queued_id
+                    if self._journal is not None:
+                        self._journal.flush()
+                        fileno = self._journal.fileno()
+                    else:
+                        fileno = None
+                if fileno is not None:
+                    os.fsync(fileno)
+        finally:
+            with self._lock:
+                self._syncing = False
+                self._synced_id = max(self._synced_id, target)
+                self._counters["journal_syncs"] += 1
+                self._synced.notify_all()
+
+    def wait_persisted(self, timeout: Optional[float] = 5.0) -> bool:
+        """
+        Chờ đến khi mọi tin nhắn đã nhận trước lời gọi này được ghi xuống database.
+        Dùng trước các truy vấn đọc tin nhắn để người gửi thấy ngay tin của mình.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            target = self._last_queued_id
+            if self._done_id >= target:
+                return True
+            self._wakeup.notify()
+            while self._done_id < target:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._persisted.wait(remaining)
+        return True
+
+    def stop(self, timeout: float = 10.0):
+        """Ghi nốt các tin nhắn đang chờ rồi dừng thread nền."""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._wakeup.notify()
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+        with self._sync_lock, self._lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["queued"] = len(self._queue) + len(self._in_flight) + len(self._unsaved)
+            stats["journal_bytes"] = self._journal.tell() if self._journal else 0
+        stats["avg_batch"] = round(stats["persisted"] / stats["batches"], 1) if stats["batches"] else 0.0
+        return stats
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._running and not self._queue:
+                    self._wakeup.wait()
+                if self._running and len(self._queue) < self.batch_size and self.flush_interval:
+                    # Gom thêm tin nhắn cho lô này; bị đánh thức sớm khi lô đầy
+                    self._wakeup.wait(self.flush_interval)
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._in_flight = batch
+            try:
+                self._flush(batch)
+            except Exception as e:
+                # Lỗi ngoài dự kiến: không để thread ghi dừng hẳn, đưa lô về đầu hàng đợi và thử lại
+                print(f"❌ Lỗi thread ghi tin nhắn ({len(batch)} tin nhắn), thử lại: {e!r}")
+                with self._lock:
+                    self._counters["retries"] += 1
+                    if self._in_flight is batch:
+                        self._queue.extendleft(reversed(batch))
+                        self._in_flight = []
+                self._stopping.wait(self.RETRY_DELAY)
+            finally:
+                self.db.remove_session()
+
+    def _flush(self, batch: List[Dict[str, Any]]):
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                persisted, rejected = self._insert_batch(batch)
+                break
+            except Exception as e:
+                delay = min(self.RETRY_DELAY * 2 ** attempt, self.MAX_RETRY_DELAY)
+                attempt += 1
+                print(f"⚠️ Không ghi được {len(batch)} tin nhắn xuống database, thử lại sau {delay:g}s: {e}")
+                with self._lock:
+                    self._counters["retries"] += 1
+                self.db.remove_session()
+                if self._stopping.wait(delay):
+                    # Server đang dừng: tin nhắn vẫn nằm trong journal, lần khởi động sau sẽ ghi tiếp;
+                    # giữ lại để lô sau ghi được cũng không cắt chúng khỏi journal
+                    with self._lock:
+                        self._unsaved.extend(batch)
+                        if self._in_flight is batch:
+                            self._in_flight = []
+                    return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for row in rejected:
+            print(f"❌ Bỏ tin nhắn {row['id']} của user {row['sender_id']} (không hợp lệ): {str(row['content'])[:80]!r}")
+        with self._sync_lock, self._lock:
+            self._in_flight = []
+            self._done_id = batch[-1]["id"]
+            self._counters["persisted"] += len(persisted)
+            self._counters["rejected"] += len(rejected)
+            self._counters["batches"] += 1
+            self._counters["max_batch"] = max(self._counters["max_batch"], len(batch))
+            self._counters["last_flush_ms"] = round(elapsed_ms, 3)
+            self._persisted.notify_all()
+            self._checkpoint()
+
+    def _insert_batch(self, rows: List[Dict[str, Any]]):
+        """Ghi một lô; trả về (dòng đã ghi, dòng bị loại bỏ). Lỗi kết nối được ném ra."""
+        try:
+            self.db.insert_messages(rows)
+            return rows, []
+        except self.CONNECTION_ERRORS:
+            raise
+        except Exception:
+            # Một dòng không hợp lệ (nhóm đã xóa, reply_to không tồn tại, dữ liệu sai kiểu, ...): ghi từng dòng
+            return self._insert_one_by_one(rows)
+
+    def _insert_one_by_one(self, batch: List[Dict[str, Any]]):
+        """Ghi từng dòng; lỗi kết nối được ném ra để cả lô được thử lại."""
+        persisted, rejected = [], []
+        for row in batch:
+            try:
+                self.db.insert_messages([row])
+                persisted.append(row)
+            except self.CONNECTION_ERRORS:
+                raise
+            except Exception:
+                # Đã được ghi ở lần thử trước (trùng ID) hay thật sự không hợp lệ
+                if self.db.existing_message_ids([row["id"]]):
+                    persisted.append(row)
+                else:
+                    rejected.append(row)
+        return persisted, rejected
+
+    def _checkpoint(self):
+        """Bỏ khỏi journal các tin nhắn đã ghi xuống database (gọi khi đang giữ lock)."""
+        if self._journal is None:
+            return
+        pending = list(self._unsaved) + list(self._in_flight) + list(self._queue)
+        if not pending:
+            self._journal.seek(0)
+            self._journal.truncate()
+            self._sync_journal()
+        elif self._journal.tell() > self.max_journal_bytes:
+            # Tải cao liên tục, journal không lúc nào rỗng: viết lại chỉ với tin nhắn đang chờ
+            tmp_path = self.journal_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for row in pending:
+                    f.write(self._encode(row))
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal.close()
+            os.replace(tmp_path, self.journal_path)
+            self._journal = open(self.journal_path, 'ab')
+
+    def _sync_journal(self):
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    @staticmethod
+    def _encode(row: Dict[str, Any]) -> bytes:
+        record = dict(row, timestamp=row["timestamp"].isoformat())
+        return (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+
+    def _read_journal(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.journal_path):
+            return []
+        rows = []
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                    record["timestamp"] = datetime.fromisoformat(record["timestamp"])
+                except (ValueError, KeyError, UnicodeDecodeError):
+                    # Dòng cuối bị ghi dở khi server dừng đột ngột (chưa được xác nhận)
+                    continue
+                rows.append(record)
+        return rows
+
+    def _replay(self, rows: List[Dict[str, Any]]):
+        if not rows:
+            return
+        existing = self.db.existing_message_ids([row["id"] for row in rows])
+        missing = [row for row in rows if row["id"] not in existing]
+        if missing:
+            persisted, rejected = self._insert_batch(missing)
+            for row in rejected:
+                print(f"❌ Bỏ tin nhắn {row['id']} trong journal (không hợp lệ): {str(row['content'])[:80]!r}")
+            self._counters["replayed"] = len(persisted)
+        print(f"📝 Journal: {len(rows)} tin nhắn, đã ghi bù {len(missing)} tin nhắn chưa có trong database")
@@ -0,0 +1,261 @@
+import json
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+ConversationKey = Tuple
+
+
+def conversation_key(group_id: Optional[int] = None, user_id: Optional[int] = None,
+                     other_user_id: Optional[int] = None) -> ConversationKey:
+    """Khóa của hội thoại: ``("group", id)`` hoặc ``("private", id nhỏ, id lớn)``."""
+    if group_id:
+        return ("group", group_id)
+    return ("private", min(user_id, other_user_id), max(user_id, other_user_id))
+
+
+class _Entry:
+    """Các tin nhắn mới nhất của một hội thoại, sắp theo id tăng dần."""
+    __slots__ = ("ids", "messages", "sizes", "has_older", "bytes")
+
+    def __init__(self, has_older: bool):
+        self.ids: List[int] = []
+        self.messages: List[Dict[str, Any]] = []
+        self.sizes: List[int] = []
+        # Còn tin nhắn cũ hơn tin đầu tiên trong cache (trong database)
+        self.has_older = has_older
+        self.bytes = 0
+
+
+class MessageCache:
+    """
+    Cache trong bộ nhớ ``per_conversation`` tin nhắn mới nhất (đã chuyển sang
+    dict như ``_message_to_dict``) của mỗi hội thoại.
+
+    Trang mới nhất của một hội thoại (và các trang cũ hơn còn nằm trong cache)
+    được trả về mà không cần truy vấn database. DatabaseManager cập nhật cache
+    sau mỗi lần commit tin nhắn mới, xóa tin nhắn và xóa chat; ``is_read`` được
+    tính lại từ read cursor mỗi lần đọc nên đánh dấu đã đọc không đụng tới cache.
+    Khi tổng dung lượng (ước lượng theo độ dài JSON) vượt ``max_bytes``, các hội
+    thoại lâu không được đọc nhất bị bỏ khỏi cache (LRU).
+
+    Tránh lưu kết quả cũ: trước khi đọc database, người đọc lấy một token bằng
+    :meth:`reserve`; mọi thay đổi của hội thoại đó trong lúc đọc làm token mất
+    hiệu lực và :meth:`fill` bỏ qua kết quả.
+
+    Thông tin người gửi (trạng thái online, ...) là ảnh chụp lúc tin nhắn vào
+    cache; client nhận trạng thái mới qua gói tin ``user_status``.
+    """
+
+    def __init__(self, per_conversation: int = 50, max_bytes: int = 64 * 1024 * 1024):
+        self.per_conversation = max(0, per_conversation)
+        self.max_bytes = max(0, max_bytes)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[ConversationKey, _Entry]" = OrderedDict()
+        # Token của các lần đọc database đang chờ đưa vào cache: {key: token}
+        self._fills: Dict[ConversationKey, int] = {}
+        self._next_token = 0
+        self._bytes = 0
+        self._counters = {"hits": 0, "misses": 0, "fills": 0, "stale_fills": 0, "evictions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_conversation > 0 and self.max_bytes > 0
+
+    def __contains__(self, key: ConversationKey) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def page(self, key: ConversationKey, limit: int,
+             before_id: Optional[int] = None) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        """
+        ``limit`` tin nhắn mới nhất (cũ hơn ``before_id`` nếu có) theo thứ tự
+        cũ -> mới, kèm ``has_more``; None nếu cache không đủ để trả lời.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                end = len(entry.ids) if before_id is None else bisect_left(entry.ids, before_id)
+                if end >= limit:
+                    result = (entry.messages[end - limit:end], end > limit or entry.has_older)
+                elif not entry.has_older:
+                    result = (entry.messages[:end], False)
+                else:
+                    result = None
+                if result is not None:
+                    self._entries.move_to_end(key)
+                    self._counters["hits"] += 1
+                    return result
+            self._counters["misses"] += 1
+            return None
+
+    def reserve(self, key: ConversationKey) -> int:
+        """Token cho một lần đọc database sẽ được đưa vào cache bằng :meth:`fill`."""
+        with self._lock:
+            self._next_token += 1
+            self._fills[key] = self._next_token
+            return self._next_token
+
+    def fill(self, key: ConversationKey, token: int, messages: List[Dict[str, Any]], has_older: bool) -> bool:
+        """
+        Lưu các tin nhắn mới nhất của hội thoại (thứ tự cũ -> mới) đọc được sau
+        :meth:`reserve`. Bỏ qua nếu hội thoại đã thay đổi kể từ lúc lấy token.
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            if self._fills.get(key) != token:
+                self._counters["stale_fills"] += 1
+                return False
+            del self._fills[key]
+            self._drop(key)
+            if len(messages) > self.per_conversation:
+                messages = messages[-self.per_conversation:]
+                has_older = True
+            entry = _Entry(has_older)
+            for message in messages:
+                self._append(entry, message)
+            self._entries[key] = entry
+            self._bytes += entry.bytes
+            self._counters["fills"] += 1
+            self._evict()
+            return True
+
+    def add(self, key: ConversationKey, message: Dict[str, Any]):
+        """Thêm (hoặc thay thế) một tin nhắn vừa được commit vào hội thoại đang có trong cache."""
+        with self._lock:
+            self._fills.pop(key, None)
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            before = entry.bytes
+            index = bisect_left(entry.ids, message["id"])
+            if index < len(entry.ids) and entry.ids[index] == message["id"]:
+                self._replace_at(entry, index, message)
+            elif index == 0 and entry.has_older:
+                # Cũ hơn mọi tin trong cache và có thể không liền với chúng
+                pass
+            else:
+                size = self._size(message)
+                entry.ids.insert(index, message["id"])
+                entry.messages.insert(index, message)
+                entry.sizes.insert(index, size)
+                entry.bytes += size
+                while len(entry.ids) > self.per_conversation:
+                    entry.ids.pop(0)
+                    entry.messages.pop(0)
+                    entry.bytes -= entry.sizes.pop(0)
+                    entry.has_older = True
+            self._bytes += entry.bytes - before
+            self._evict()
+
+    def remove(self, key: ConversationKey, message_id: int):
+        """Bỏ một tin nhắn đã bị xóa khỏi hội thoại."""
+        with self._lock:
+            self._fills.pop(key, None)
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            index = bisect_left(entry.ids, message_id)
+            if index < len(entry.ids) and entry.ids[index] == message_id:
+                entry.ids.pop(index)
+                entry.messages.pop(index)
+                size = entry.sizes.pop(index)
+                entry.bytes -= size
+                self._bytes -= size
+
+    def update(self, key: ConversationKey, predicate: Callable[[Dict[str, Any]], bool], changes: Dict[str, Any]):
+        """
+        Áp dụng ``changes`` cho các tin nhắn thỏa ``predicate``. Dict cũ không
+        bị sửa (có thể đang được gửi cho client khác) mà được thay bằng bản sao.
+        """
+        with self._lock:
+            self._fills.pop(key, None)
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            before = entry.bytes
+            for index, message in enumerate(entry.messages):
+                if predicate(message):
+                    self._replace_at(entry, index, dict(message, **changes))
+            self._bytes += entry.bytes - before
+
+    def replace(self, key: ConversationKey, message: Dict[str, Any]):
+        """Thay bản lưu của một tin nhắn đã có trong cache (không đổi nội dung trong database)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            index = bisect_left(entry.ids, message["id"])
+            if index < len(entry.ids) and entry.ids[index] == message["id"]:
+                before = entry.bytes
+                self._replace_at(entry, index, message)
+                self._bytes += entry.bytes - before
+
+    def update_user(self, user_id: int, changes: Dict[str, Any]):
+        """Cập nhật thông tin người gửi/nhận (ví dụ ``avatar_hash``) trong mọi tin nhắn đã cache."""
+        with self._lock:
+            for entry in self._entries.values():
+                before = entry.bytes
+                for index, message in enumerate(entry.messages):
+                    updated = {}
+                    for role in ("sender", "receiver"):
+                        user = message.get(role)
+                        if user and user.get("id") == user_id:
+                            updated[role] = dict(user, **changes)
+                    if updated:
+                        self._replace_at(entry, index, dict(message, **updated))
+                self._bytes += entry.bytes - before
+
+    def invalidate(self, key: ConversationKey):
+        """Bỏ hội thoại khỏi cache; lần đọc sau sẽ lấy lại từ database."""
+        with self._lock:
+            self._fills.pop(key, None)
+            self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._fills.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["conversations"] = len(self._entries)
+            stats["messages"] = sum(len(entry.ids) for entry in self._entries.values())
+            stats["bytes"] = self._bytes
+            stats["max_bytes"] = self.max_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+    def _append(self, entry: _Entry, message: Dict[str, Any]):
+        size = self._size(message)
+        entry.ids.append(message["id"])
+        entry.messages.append(message)
+        entry.sizes.append(size)
+        entry.bytes += size
+
+    def _replace_at(self, entry: _Entry, index: int, message: Dict[str, Any]):
+        size = self._size(message)
+        entry.messages[index] = message
+        entry.bytes += size - entry.sizes[index]
+        entry.sizes[index] = size
+
+    def _drop(self, key: ConversationKey):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.bytes
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.bytes
+            self._counters["evictions"] += 1
+
+    @staticmethod
+    def _size(message: Dict[str, Any]) -> int:
+        # Ước lượng: độ dài JSON gần với dung lượng thực của dict (cùng hệ số cho mọi tin nhắn)
+        return len(json.dumps(message, ensure_ascii=False, default=str))
@@ -0,0 +1,89 @@
+"""
+Chuyển file đính kèm (messages.file_data) và avatar (users.avatar) từ các cột
+LargeBinary trong database sang BlobStore.
+
+Chạy một lần từ thư mục gốc của project:
+
+    python -m server.migrate_blobs [--blob-dir blobs] [--batch-size 100]
+
+Mỗi lô được commit riêng nên có thể dừng và chạy lại bất cứ lúc nào; các bản
+ghi đã chuyển (cột LargeBinary đã là NULL) sẽ được bỏ qua. Sau khi chạy xong,
+dùng ``VACUUM FULL messages, users`` để PostgreSQL trả lại dung lượng đĩa.
+"""
+import argparse
+import sys
+
+from sqlalchemy.orm import undefer
+
+from .blob_store import BlobStore
+from .database import DATABASE_URL, DatabaseManager
+from .models import Message, User
+
+
+def migrate_messages(manager: DatabaseManager, batch_size: int) -> int:
+    db = manager.db
+    migrated = 0
+    while True:
+        messages = db.query(Message).options(undefer(Message.file_data)).filter(
+            Message.file_data.isnot(None)
+        ).order_by(Message.id).limit(batch_size).all()
+        if not messages:
+            break
+        for message in messages:
+            message.file_hash = manager.blobs.put_bytes(message.file_data)
+            message.file_size = len(message.file_data)
+            message.file_data = None
+        last_id = messages[-1].id
+        db.commit()
+        # Giải phóng dữ liệu của lô vừa xong khỏi session
+        db.expunge_all()
+        migrated += len(messages)
+        print(f"   📎 {migrated} file đã chuyển (đến message id {last_id})")
+    return migrated
+
+
+def migrate_avatars(manager: DatabaseManager, batch_size: int) -> int:
+    db = manager.db
+    migrated = 0
+    while True:
+        users = db.query(User).options(undefer(User.avatar)).filter(
+            User.avatar.isnot(None)
+        ).order_by(User.id).limit(batch_size).all()
+        if not users:
+            break
+        for user in users:
+            user.avatar_hash = manager.blobs.put_bytes(user.avatar)
+            user.avatar = None
+        db.commit()
+        db.expunge_all()
+        migrated += len(users)
+        print(f"   🖼️ {migrated} avatar đã chuyển")
+    return migrated
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Chuyển file/avatar từ database sang blob store")
+    parser.add_argument("--blob-dir", default="blobs", help="Thư mục blob store (giống blob_dir trong server_config.ini)")
+    parser.add_argument("--batch-size", type=int, default=100, help="Số bản ghi mỗi lần commit")
+    parser.add_argument("--database-url", default=DATABASE_URL)
+    args = parser.parse_args(argv)
+
+    print(f"🚚 Chuyển blob sang {args.blob_dir}...")
+    manager = DatabaseManager(args.database_url, blob_store=BlobStore(args.blob_dir))
+    try:
+        files = migrate_messages(manager, args.batch_size)
+        avatars = migrate_avatars(manager, args.batch_size)
+    except Exception as e:
+        manager.db.rollback()
+        print(f"❌ Lỗi khi chuyển blob: {e}")
+        return 1
+    finally:
+        manager.close()
+    print(f"✅ Hoàn tất: {files} file, {avatars} avatar")
+    if files or avatars:
+        print("💡 Chạy 'VACUUM FULL messages, users' để thu hồi dung lượng database")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,429 @@
+"""
+Chạy các migration schema còn thiếu và so sánh kế hoạch truy vấn (EXPLAIN)
+của các truy vấn nóng trong ``database.py`` trước và sau khi chạy.
+
+Server tự chạy migration khi khởi động (``auto_migrate`` trong
+server_config.ini). Với database lớn đang hoạt động có thể tắt tùy chọn đó
+và chạy tay từ thư mục gốc của project:
+
+    python -m server.migrations [--status] [--explain] [--no-concurrently] [--database-url URL]
+
+Trên PostgreSQL index được tạo bằng ``CREATE INDEX CONCURRENTLY`` nên không
+khóa ghi bảng ``messages`` trong lúc tạo; riêng migration 7 (thêm cột
+``search_vector``) ghi lại toàn bộ bảng ``messages`` và khóa bảng trong lúc
+chạy. Các phiên bản đã chạy được lưu trong bảng ``schema_migrations``; chạy
+lại lệnh chỉ áp dụng phần còn thiếu.
+"""
+import argparse
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table, inspect, insert,
+                        select, text)
+from sqlalchemy.engine import Connection, Engine
+
+_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations", _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+    Column("duration_ms", Integer, nullable=False),
+)
+
+
+@dataclass
+class Migration:
+    """
+    Một phiên bản schema.
+
+    ``upgrade`` chạy trong một transaction; ``indexes`` là các index
+    ``(tên, bảng, cột)`` hoặc ``(tên, bảng, cột, kiểu index)`` được tạo sau
+    đó, không nằm trong transaction để PostgreSQL có thể tạo CONCURRENTLY;
+    ``drop_indexes`` là tên các index không còn dùng, được xóa cùng cách đó.
+    Migration chỉ dành cho một loại database thì đặt ``dialect``; database
+    khác ghi nhận phiên bản mà không chạy gì. Migration phải chạy lại được:
+    database mới (bảng/index đã có từ ``create_all``) cũng chạy toàn bộ migration.
+    """
+    version: int
+    description: str
+    upgrade: Optional[Callable[[Connection], None]] = None
+    indexes: Sequence[Tuple[str, ...]] = ()
+    drop_indexes: Sequence[str] = ()
+    dialect: Optional[str] = None
+
+
+def _add_blob_columns(conn: Connection):
+    """Cột tham chiếu BlobStore cho bảng tạo trước khi có BlobStore."""
+    new_columns = {
+        "messages": [("file_hash", "VARCHAR(64)")],
+        "users": [("avatar_hash", "VARCHAR(64)")],
+    }
+    inspector = inspect(conn)
+    for table, columns in new_columns.items():
+        existing = {column["name"] for column in inspector.get_columns(table)}
+        for name, ddl_type in columns:
+            if name not in existing:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl_type}"))
+                print(f"🛠️ Đã thêm cột {table}.{name}")
+
+
+def _create_fts5_index(conn: Connection):
+    """Bảng FTS5 dùng nội dung của ``messages`` (không lưu bản sao), đồng bộ bằng trigger."""
+    if inspect(conn).has_table("messages_fts"):
+        return
+    try:
+        conn.execute(text("CREATE VIRTUAL TABLE messages_fts USING fts5("
+                          "content, content='messages', content_rowid='id', tokenize='unicode61')"))
+    except Exception as e:
+        # SQLite build không có FTS5: tìm kiếm quay về LIKE
+        print(f"⚠️ SQLite không hỗ trợ FTS5, tìm kiếm tin nhắn dùng LIKE: {e}")
+        return
+    conn.execute(text("CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+                      "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"))
+    conn.execute(text("CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+                      "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END"))
+    conn.execute(text("CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+                      "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+                      "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"))
+    # Đánh index cho các tin nhắn đã có
+    conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+
+def _add_search_key(conn: Connection):
+    """Cột nội dung bỏ dấu; tin nhắn cũ được điền bởi ``python -m server.backfill_search_keys``."""
+    columns = {column["name"] for column in inspect(conn).get_columns("messages")}
+    if "search_key" in columns:
+        return
+    conn.execute(text("ALTER TABLE messages ADD COLUMN search_key TEXT"))
+    print("🛠️ Đã thêm cột messages.search_key")
+    if conn.execute(text("SELECT 1 FROM messages LIMIT 1")).first():
+        print("⚠️ Tin nhắn cũ chưa có khóa tìm kiếm không dấu. Chạy: python -m server.backfill_search_keys")
+
+
+def _search_vector_from_search_key(conn: Connection):
+    """
+    Cột ``search_vector`` (tsvector sinh tự động, PostgreSQL 12+) từ ``search_key``;
+    tin nhắn chưa backfill dùng ``content``. Thêm cột ghi lại toàn bộ bảng ``messages``
+    một lần và khóa bảng trong lúc chạy.
+    """
+    expression = conn.execute(text(
+        "SELECT pg_get_expr(d.adbin, d.adrelid) FROM pg_attrdef d "
+        "JOIN pg_attribute a ON a.attrelid = d.adrelid AND a.attnum = d.adnum "
+        "WHERE a.attrelid = 'messages'::regclass AND a.attname = 'search_vector'")).scalar()
+    if expression and "search_key" in expression:
+        return
+    # Cột theo content từ bản cũ của migration 4: biểu thức của cột sinh tự động
+    # không sửa được nên xóa (kèm index GIN) rồi thêm lại
+    conn.execute(text("ALTER TABLE messages DROP COLUMN IF EXISTS search_vector"))
+    conn.execute(text("ALTER TABLE messages ADD COLUMN search_vector tsvector GENERATED ALWAYS AS "
+                      "(to_tsvector('simple', coalesce(search_key, content, ''))) STORED"))
+    print("🛠️ Đã thêm cột messages.search_vector (sinh từ search_key)")
+
+
+def _fts5_on_search_key(conn: Connection):
+    """Đánh index FTS5 trên ``search_key`` thay cho ``content``."""
+    if not inspect(conn).has_table("messages_fts"):
+        return
+    columns = {row[1] for row in conn.execute(text("PRAGMA table_info(messages_fts)"))}
+    if "search_key" in columns:
+        return
+    for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+    conn.execute(text("DROP TABLE messages_fts"))
+    conn.execute(text("CREATE VIRTUAL TABLE messages_fts USING fts5("
+                      "search_key, content='messages', content_rowid='id', tokenize='unicode61')"))
+    conn.execute(text("CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN "
+                      "INSERT INTO messages_fts(rowid, search_key) VALUES (new.id, new.search_key); END"))
+    conn.execute(text("CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN "
+                      "INSERT INTO messages_fts(messages_fts, rowid, search_key) "
+                      "VALUES ('delete', old.id, old.search_key); END"))
+    # Backfill chỉ cập nhật search_key
+    conn.execute(text("CREATE TRIGGER messages_fts_update AFTER UPDATE OF search_key ON messages BEGIN "
+                      "INSERT INTO messages_fts(messages_fts, rowid, search_key) "
+                      "VALUES ('delete', old.id, old.search_key); "
+                      "INSERT INTO messages_fts(rowid, search_key) VALUES (new.id, new.search_key); END"))
+    conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+
+def _backfill_read_cursors(conn: Connection):
+    """
+    Read cursor từ trạng thái cũ: chat riêng đọc đến tin ``is_read`` mới nhất,
+    nhóm (trước đây không có trạng thái đọc) coi như đã đọc hết.
+    """
+    if (conn.execute(text("SELECT 1 FROM read_cursors LIMIT 1")).first()
+            or not conn.execute(text("SELECT 1 FROM messages LIMIT 1")).first()):
+        return
+    conn.execute(text(
+        "INSERT INTO read_cursors (user_id, conversation, last_read_message_id, updated_at) "
+        "SELECT receiver_id, 'user:' || CAST(sender_id AS VARCHAR(20)), max(id), CURRENT_TIMESTAMP "
+        "FROM messages WHERE group_id IS NULL AND receiver_id IS NOT NULL AND is_read = :read "
+        "GROUP BY receiver_id, sender_id"), {"read": True})
+    conn.execute(text(
+        "INSERT INTO read_cursors (user_id, conversation, last_read_message_id, updated_at) "
+        "SELECT gm.user_id, 'group:' || CAST(gm.group_id AS VARCHAR(20)), max(m.id), CURRENT_TIMESTAMP "
+        "FROM group_members gm JOIN messages m ON m.group_id = gm.group_id "
+        "GROUP BY gm.user_id, gm.group_id"))
+    print("🛠️ Đã tạo read cursor từ messages.is_read")
+
+
+def _backfill_conversation_states(conn: Connection):
+    """
+    Tóm tắt hội thoại từ dữ liệu hiện có: hai dòng cho mỗi hội thoại riêng,
+    một dòng cho mỗi thành viên nhóm; số tin chưa đọc tính theo read cursor.
+    """
+    if conn.execute(text("SELECT 1 FROM user_conversation_state LIMIT 1")).first():
+        return
+    private = conn.execute(text(
+        "INSERT INTO user_conversation_state (user_id, conversation, group_id, other_user_id, last_message_id, "
+        "last_message_preview, unread_count, pinned, updated_at) "
+        "SELECT p.user_id, 'user:' || CAST(p.other_id AS VARCHAR(20)), NULL, p.other_id, m.id, "
+        "substr(m.content, 1, 200), "
+        "(SELECT count(*) FROM messages u WHERE u.sender_id = p.other_id AND u.receiver_id = p.user_id "
+        "AND u.group_id IS NULL AND u.id > COALESCE((SELECT rc.last_read_message_id FROM read_cursors rc "
+        "WHERE rc.user_id = p.user_id AND rc.conversation = 'user:' || CAST(p.other_id AS VARCHAR(20))), 0)), "
+        ":pinned, p.updated_at "
+        "FROM (SELECT user_id, other_id, max(last_message_id) AS last_message_id, max(updated_at) AS updated_at "
+        "FROM (SELECT user1_id AS user_id, user2_id AS other_id, last_message_id, updated_at FROM conversations "
+        "UNION ALL SELECT user2_id, user1_id, last_message_id, updated_at FROM conversations) pairs "
+        "GROUP BY user_id, other_id) p "
+        "LEFT JOIN messages m ON m.id = p.last_message_id"), {"pinned": False}).rowcount
+    groups = conn.execute(text(
+        "INSERT INTO user_conversation_state (user_id, conversation, group_id, other_user_id, last_message_id, "
+        "last_message_preview, unread_count, pinned, updated_at) "
+        "SELECT gm.user_id, 'group:' || CAST(gm.group_id AS VARCHAR(20)), gm.group_id, NULL, m.id, "
+        "substr(m.content, 1, 200), "
+        "(SELECT count(*) FROM messages u WHERE u.group_id = gm.group_id AND u.sender_id <> gm.user_id "
+        "AND u.id > COALESCE((SELECT rc.last_read_message_id FROM read_cursors rc "
+        "WHERE rc.user_id = gm.user_id AND rc.conversation = 'group:' || CAST(gm.group_id AS VARCHAR(20))), 0)), "
+        ":pinned, COALESCE(m.timestamp, g.created_at) "
+        "FROM group_members gm JOIN groups g ON g.id = gm.group_id "
+        "LEFT JOIN messages m ON m.id = (SELECT max(id) FROM messages WHERE group_id = gm.group_id)"),
+        {"pinned": False}).rowcount
+    if private or groups:
+        print(f"🛠️ Đã tạo {private + groups} dòng user_conversation_state")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Cột file_hash/avatar_hash cho BlobStore", upgrade=_add_blob_columns,
+              indexes=[("ix_messages_file_hash", "messages", "file_hash")]),
+    Migration(2, "Index phân trang lịch sử chat theo (hội thoại, id)",
+              indexes=[("ix_messages_group_id_id", "messages", "group_id, id"),
+                       ("ix_messages_sender_receiver_id", "messages", "sender_id, receiver_id, id")]),
+    # ix_messages_receiver_is_read (receiver_id, is_read) không còn được tạo: xem migration 11
+    Migration(3, "Index tin chưa đọc và tra cứu hội thoại riêng",
+              indexes=[("ix_conversations_user1_user2", "conversations", "user1_id, user2_id"),
+                       ("ix_conversations_user2_id", "conversations", "user2_id")]),
+    # Cột search_vector chỉ được thêm ở migration 7 (đã có search_key), để nâng cấp
+    # chỉ ghi lại bảng messages một lần thay vì thêm theo content rồi thêm lại
+    Migration(4, "Tìm kiếm toàn văn: cột tsvector và index GIN", dialect="postgresql"),
+    Migration(5, "Tìm kiếm toàn văn: bảng FTS5", upgrade=_create_fts5_index, dialect="sqlite"),
+    Migration(6, "Khóa tìm kiếm không dấu messages.search_key", upgrade=_add_search_key),
+    Migration(7, "Tìm kiếm toàn văn theo search_key (tsvector)", upgrade=_search_vector_from_search_key,
+              indexes=[("ix_messages_search_vector", "messages", "search_vector", "gin")],
+              dialect="postgresql"),
+    Migration(8, "Tìm kiếm toàn văn theo search_key (FTS5)", upgrade=_fts5_on_search_key, dialect="sqlite"),
+    Migration(9, "Read cursor theo hội thoại thay cho messages.is_read", upgrade=_backfill_read_cursors),
+    Migration(10, "Bảng tóm tắt hội thoại user_conversation_state", upgrade=_backfill_conversation_states,
+              indexes=[("ix_user_conversation_state_list", "user_conversation_state", "user_id, pinned, updated_at"),
+                       ("ix_user_conversation_state_conversation", "user_conversation_state", "conversation")]),
+    Migration(11, "Bỏ index messages (receiver_id, is_read), đã thay bằng read cursor",
+              drop_indexes=["ix_messages_receiver_is_read"]),
+]
+
+# Các truy vấn nóng trong DatabaseManager (dạng SQL tương đương) để so sánh EXPLAIN
+HOT_QUERIES: Dict[str, str] = {
+    "get_message_page (nhóm)":
+        "SELECT * FROM messages WHERE group_id = :group_id AND id < :before_id "
+        "ORDER BY id DESC LIMIT 51",
+    "get_message_page (chat riêng)":
+        "SELECT * FROM messages WHERE sender_id = :user_id AND receiver_id = :other_id "
+        "AND group_id IS NULL AND id < :before_id ORDER BY id DESC LIMIT 51",
+    "get_unread_counts (chat riêng)":
+        "SELECT count(*) FROM messages WHERE sender_id = :other_id AND receiver_id = :user_id "
+        "AND group_id IS NULL AND id > :after_id",
+    "get_unread_counts (nhóm)":
+        "SELECT count(*) FROM messages WHERE group_id = :group_id AND id > :after_id "
+        "AND sender_id <> :user_id",
+    "mark_conversation_read":
+        "SELECT last_read_message_id FROM read_cursors WHERE user_id = :user_id AND conversation = :conversation",
+    "_update_conversations":
+        "SELECT * FROM conversations WHERE (user1_id = :user_id AND user2_id = :other_id) "
+        "OR (user1_id = :other_id AND user2_id = :user_id)",
+    "get_conversations":
+        "SELECT * FROM user_conversation_state WHERE user_id = :user_id "
+        "ORDER BY pinned DESC, updated_at DESC",
+    "_update_conversation_states (nhóm)":
+        "SELECT * FROM user_conversation_state WHERE conversation = :group_conversation",
+}
+
+
+class MigrationRunner:
+    """Áp dụng các :data:`MIGRATIONS` chưa chạy và ghi phiên bản vào ``schema_migrations``."""
+
+    def __init__(self, engine: Engine, migrations: Sequence[Migration] = MIGRATIONS):
+        self.engine = engine
+        self.migrations = sorted(migrations, key=lambda migration: migration.version)
+        self.is_postgresql = engine.dialect.name == "postgresql"
+
+    def applied_versions(self) -> Dict[int, datetime]:
+        _metadata.create_all(bind=self.engine, tables=[schema_migrations])
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(schema_migrations.c.version, schema_migrations.c.applied_at)).all()
+        return {version: applied_at for version, applied_at in rows}
+
+    def pending(self) -> List[Migration]:
+        applied = self.applied_versions()
+        return [migration for migration in self.migrations if migration.version not in applied]
+
+    def upgrade(self, concurrently: bool = True) -> List[Migration]:
+        """Chạy các migration còn thiếu theo thứ tự phiên bản; trả về danh sách đã chạy."""
+        applied = []
+        for migration in self.pending():
+            started = time.perf_counter()
+            skipped = migration.dialect is not None and migration.dialect != self.engine.dialect.name
+            if not skipped:
+                print(f"🛠️ Migration {migration.version}: {migration.description}")
+                if migration.upgrade:
+                    with self.engine.begin() as conn:
+                        migration.upgrade(conn)
+                for name, table, columns, *method in migration.indexes:
+                    self._create_index(name, table, columns, concurrently, method[0] if method else None)
+                for name in migration.drop_indexes:
+                    self._drop_index(name, concurrently)
+            duration_ms = int((time.perf_counter() - started) * 1000)
+            with self.engine.begin() as conn:
+                conn.execute(insert(schema_migrations).values(
+                    version=migration.version, description=migration.description,
+                    applied_at=datetime.now(), duration_ms=duration_ms))
+            if not skipped:
+                print(f"   ✅ Xong sau {duration_ms} ms")
+            applied.append(migration)
+        return applied
+
+    def _create_index(self, name: str, table: str, columns: str, concurrently: bool,
+                      method: Optional[str] = None):
+        target = f"{table} USING {method} ({columns})" if method else f"{table} ({columns})"
+        if not (self.is_postgresql and concurrently):
+            with self.engine.begin() as conn:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {target}"))
+            return
+        # CREATE INDEX CONCURRENTLY không chạy được trong transaction
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            valid = conn.execute(text(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name"), {"name": name}).scalar()
+            if valid is False:
+                # Lần tạo trước bị ngắt giữa chừng để lại index INVALID; IF NOT EXISTS sẽ bỏ qua nó
+                print(f"   ⚠️ Index {name} không hợp lệ (lần tạo trước bị ngắt), tạo lại")
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {target}"))
+
+    def _drop_index(self, name: str, concurrently: bool):
+        if not (self.is_postgresql and concurrently):
+            with self.engine.begin() as conn:
+                conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+            return
+        # DROP INDEX CONCURRENTLY không khóa ghi bảng nhưng không chạy được trong transaction
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    def explain_hot_queries(self) -> Dict[str, List[str]]:
+        """Kế hoạch thực thi của từng truy vấn trong :data:`HOT_QUERIES` (không chạy truy vấn)."""
+        prefix = "EXPLAIN" if self.is_postgresql else "EXPLAIN QUERY PLAN"
+        plans = {}
+        with self.engine.connect() as conn:
+            parameters = self._sample_parameters(conn)
+            for name, sql in HOT_QUERIES.items():
+                try:
+                    rows = conn.execute(text(f"{prefix} {sql}"), parameters).all()
+                    # PostgreSQL trả về một cột văn bản; SQLite có chi tiết ở cột cuối
+                    plans[name] = [str(row[-1]) for row in rows]
+                except Exception as e:
+                    conn.rollback()
+                    # Lỗi gốc của driver, không kèm câu SQL (ví dụ bảng chưa có trên database mới)
+                    plans[name] = [f"(lỗi: {getattr(e, 'orig', e)})"]
+            conn.rollback()
+        return plans
+
+    @staticmethod
+    def _sample_parameters(conn: Connection) -> Dict[str, object]:
+        """Giá trị thật trong database để planner ước lượng giống lúc chạy (mặc định nếu chưa có bảng)."""
+        def sample(sql: str, default):
+            try:
+                return conn.execute(text(sql)).scalars().all() or default
+            except Exception:
+                conn.rollback()
+                return default
+
+        user_ids = list(sample("SELECT id FROM users ORDER BY id LIMIT 2", [])) + [1, 2]
+        group_id = sample("SELECT min(id) FROM groups", [None])[0]
+        max_message_id = sample("SELECT max(id) FROM messages", [None])[0]
+        return {
+            "user_id": user_ids[0],
+            "other_id": user_ids[1],
+            "group_id": group_id or 1,
+            "before_id": (max_message_id or 0) + 1,
+            "after_id": max((max_message_id or 0) - 50, 0),
+            "conversation": f"user:{user_ids[1]}",
+            "group_conversation": f"group:{group_id or 1}",
+            "unread": False,
+            "read": True,
+        }
+
+
+def print_plans(before: Dict[str, List[str]], after: Optional[Dict[str, List[str]]] = None):
+    for name, plan in before.items():
+        print(f"\n🔎 {name}")
+        if after is None:
+            for line in plan:
+                print(f"   {line}")
+            continue
+        print("   Trước:")
+        for line in plan:
+            print(f"      {line}")
+        print("   Sau:")
+        for line in after.get(name, []):
+            print(f"      {line}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Chạy migration schema của ChatLan")
+    parser.add_argument("--status", action="store_true", help="Chỉ liệt kê migration đã chạy/còn thiếu")
+    parser.add_argument("--explain", action="store_true",
+                        help="In kế hoạch thực thi của các truy vấn nóng trước và sau migration")
+    parser.add_argument("--no-concurrently", action="store_true",
+                        help="Tạo index trong transaction thường (nhanh hơn khi không có ai đang dùng database)")
+    parser.add_argument("--database-url", default=None, help="Mặc định: database trong server_config.ini")
+    args = parser.parse_args(argv)
+
+    from .database import DATABASE_URL, create_database_engine
+    from .models import Base
+
+    engine = create_database_engine(args.database_url or DATABASE_URL)
+    try:
+        runner = MigrationRunner(engine)
+        if args.status:
+            applied = runner.applied_versions()
+            for migration in runner.migrations:
+                when = applied.get(migration.version)
+                state = f"✅ {when:%Y-%m-%d %H:%M}" if when else "⏳ chưa chạy"
+                print(f"{migration.version:>4}  {state:<20} {migration.description}")
+            return 0
+        # Kế hoạch "trước" lấy trước cả create_all: bảng mới tạo đã có sẵn index của model
+        before = runner.explain_hot_queries() if args.explain else None
+        Base.metadata.create_all(bind=engine)
+        applied = runner.upgrade(concurrently=not args.no_concurrently)
+        print(f"\n📦 Đã chạy {len(applied)} migration" if applied else "\n📦 Schema đã ở phiên bản mới nhất")
+        if before is not None:
+            print_plans(before, runner.explain_hot_queries())
+    finally:
+        engine.dispose()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
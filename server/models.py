@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, LargeBinary, ForeignKey, Table
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, LargeBinary, ForeignKey, Table, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship, backref # Đảm bảo có backref
+from sqlalchemy.orm import relationship, backref, deferred # Đảm bảo có backref
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import hashlib
@@ -20,7 +20,9 @@ class User(Base):
     password_hash = Column(String(64), nullable=False)  # SHA-256 hash
     display_name = Column(String(100), nullable=True)
     email = Column(String(100), nullable=True)
-    avatar = Column(LargeBinary, nullable=True)
+    # Dữ liệu avatar cũ; avatar mới nằm trong BlobStore, tham chiếu qua avatar_hash
+    avatar = deferred(Column(LargeBinary, nullable=True))
+    avatar_hash = Column(String(64), nullable=True)
     status = Column(String(20), default="offline")  # online, away, busy, offline
     status_message = Column(String(200), nullable=True)
     is_online = Column(Boolean, default=False)
@@ -76,9 +78,13 @@ class Message(Base):
     receiver_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # None for group messages
     group_id = Column(Integer, ForeignKey("groups.id"), nullable=True)
     content = Column(Text, nullable=False)
+    # Nội dung bỏ dấu, chữ thường (common.text.search_key) để tìm kiếm không dấu
+    search_key = Column(Text, nullable=True)
     message_type = Column(String(20), default="text")  # text, image, file, emoji
     file_name = Column(String(255), nullable=True)
-    file_data = Column(LargeBinary, nullable=True)
+    # Dữ liệu file cũ; file mới nằm trong BlobStore, tham chiếu qua file_hash (SHA-256)
+    file_data = deferred(Column(LargeBinary, nullable=True))
+    file_hash = Column(String(64), nullable=True, index=True)
     file_size = Column(Integer, nullable=True)
     timestamp = Column(DateTime, default=func.now())
 
@@ -90,6 +96,12 @@ class Message(Base):
     receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
     group = relationship("Group", back_populates="messages")
     reply_to = relationship("Message", remote_side=[id])
+    # Phân trang lịch sử theo (hội thoại, id): mỗi trang là một lần quét đoạn index.
+    # Database cũ được thêm các index này qua server/migrations.py
+    __table_args__ = (
+        Index("ix_messages_group_id_id", "group_id", "id"),
+        Index("ix_messages_sender_receiver_id", "sender_id", "receiver_id", "id"),
+    )
 class Conversation(Base):
     __tablename__ = "conversations"   
     id = Column(Integer, primary_key=True, index=True)
@@ -101,6 +113,69 @@ class Conversation(Base):
     user1 = relationship("User", foreign_keys=[user1_id])
     user2 = relationship("User", foreign_keys=[user2_id])
     last_message = relationship("Message", foreign_keys=[last_message_id])
+    __table_args__ = (
+        Index("ix_conversations_user1_user2", "user1_id", "user2_id"),
+        Index("ix_conversations_user2_id", "user2_id"),
+    )
+class SyncChange(Base):
+    """
+    Thay đổi không suy ra được từ id tin nhắn (xóa tin nhắn, xóa chat, thêm/xóa
+    thành viên nhóm). Client kết nối lại gửi id thay đổi cuối cùng đã biết và
+    chỉ nhận các thay đổi sau đó (gói tin sync). Không có khóa ngoại: bản ghi
+    phải còn sau khi tin nhắn/nhóm bị xóa.
+    """
+    __tablename__ = "sync_changes"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(20), nullable=False)  # message_deleted, chat_cleared, member_added, member_removed
+    group_id = Column(Integer, nullable=True)
+    # Chat riêng: hai người của hội thoại; thay đổi thành viên: user_id là thành viên đó
+    user_id = Column(Integer, nullable=True)
+    other_user_id = Column(Integer, nullable=True)
+    message_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=func.now(), index=True)
+class ReadCursor(Base):
+    """
+    Vị trí đã đọc của user trong một hội thoại: mọi tin nhắn có id không lớn
+    hơn ``last_read_message_id`` được coi là đã đọc. Đánh dấu đã đọc chỉ ghi
+    một dòng (upsert), số tin chưa đọc là số tin của người khác có id lớn hơn
+    (đếm trên một đoạn index).
+    """
+    __tablename__ = "read_cursors"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    # "group:<id>" hoặc "user:<id người kia>", như khóa hội thoại của gói tin sync
+    conversation = Column(String(40), primary_key=True)
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=func.now())
+class UserConversationState(Base):
+    """
+    Tóm tắt một hội thoại trong danh sách hội thoại của user: tin nhắn cuối,
+    thời gian cập nhật, số tin chưa đọc và ghim. Được cập nhật trong cùng
+    transaction với ghi/xóa tin nhắn, xóa chat, đánh dấu đã đọc và thay đổi
+    thành viên nhóm, nên danh sách hội thoại chỉ là một lần quét đoạn index
+    ``(user_id, pinned, updated_at)``. ``last_message_id`` không có khóa
+    ngoại: tin nhắn bị xóa thì dòng này được tính lại, không tự đặt NULL.
+    """
+    __tablename__ = "user_conversation_state"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    # "group:<id>" hoặc "user:<id người kia>", như read_cursors
+    conversation = Column(String(40), primary_key=True)
+    group_id = Column(Integer, ForeignKey("groups.id"), nullable=True)
+    other_user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    last_message_id = Column(Integer, nullable=True)
+    last_message_preview = Column(String(200), nullable=True)
+    unread_count = Column(Integer, nullable=False, default=0)
+    pinned = Column(Boolean, nullable=False, default=False)
+    updated_at = Column(DateTime, default=func.now())
+    # Relationships
+    other_user = relationship("User", foreign_keys=[other_user_id])
+    group = relationship("Group")
+    last_message = relationship("Message", primaryjoin="foreign(UserConversationState.last_message_id) == Message.id",
+                                viewonly=True)
+    __table_args__ = (
+        Index("ix_user_conversation_state_list", "user_id", "pinned", "updated_at"),
+        # Cập nhật mọi thành viên của một nhóm khi có tin nhắn mới
+        Index("ix_user_conversation_state_conversation", "conversation"),
+    )
 class UserSession(Base):
     __tablename__ = "user_sessions"    
     id = Column(Integer, primary_key=True, index=True)
@@ -0,0 +1,142 @@
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from common.text import search_key
+
+# Từ khóa: chữ/số Unicode (tiếng Việt có dấu vẫn là một từ)
+_WORD = re.compile(r"\w+", re.UNICODE)
+# "cụm từ" | từ (có thể kết thúc bằng * để tìm theo tiền tố)
+_TERM = re.compile(r'"([^"]*)"?|(\S+)')
+
+# Chỉ tin nhắn user được xem: gửi/nhận trong chat riêng hoặc thuộc nhóm user tham gia
+_VISIBLE_TO_USER = ("(m.sender_id = :user_id OR m.receiver_id = :user_id OR m.group_id IN "
+                    "(SELECT group_id FROM group_members WHERE user_id = :user_id))")
+
+
+@dataclass
+class SearchTerm:
+    """Một phần của câu tìm kiếm: một từ (``words`` có 1 phần tử) hoặc một cụm từ."""
+    words: List[str]
+    prefix: bool = False
+
+
+def parse_search_query(query: str) -> List[SearchTerm]:
+    """
+    Tách câu tìm kiếm thành các từ/cụm từ, tất cả đều phải xuất hiện.
+
+    ``"thông báo"`` là cụm từ (các từ liền nhau theo thứ tự), ``họp*`` tìm
+    theo tiền tố. Từ được chuẩn hóa như ``messages.search_key`` (bỏ dấu, chữ
+    thường) nên "thong bao" khớp "Thông báo". Dấu câu bị bỏ qua nên không thể
+    chèn cú pháp của database.
+    """
+    terms = []
+    for phrase, word in _TERM.findall(query or ""):
+        if phrase:
+            words = _WORD.findall(search_key(phrase))
+            if words:
+                terms.append(SearchTerm(words))
+        else:
+            words = _WORD.findall(search_key(word))
+            if not words:
+                continue
+            # "e-mail" -> hai từ liền nhau, như cách database tách từ
+            terms.append(SearchTerm(words, prefix=word.endswith("*")))
+    return terms
+
+
+def encode_cursor(score: float, message_id: int) -> str:
+    return f"{score!r}:{message_id}"
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """Ngược lại với :func:`encode_cursor`; ném ValueError nếu cursor không hợp lệ."""
+    score, message_id = str(cursor).rsplit(":", 1)
+    return float(score), int(message_id)
+
+
+class MessageSearch:
+    """
+    Truy vấn tìm kiếm toàn văn trên bảng ``messages``, theo backend của database.
+
+    Đều đánh index trên ``search_key`` (nội dung bỏ dấu) thay vì ``content``.
+
+    - PostgreSQL: cột ``search_vector`` (tsvector sinh tự động) có index GIN,
+      xếp hạng bằng ``ts_rank_cd``.
+    - SQLite: bảng ảo FTS5 ``messages_fts`` đồng bộ bằng trigger, xếp hạng bằng ``bm25``.
+    - Chưa chạy migration tương ứng: quay về ``LIKE`` theo từng từ, mới nhất trước.
+
+    Kết quả được sắp theo (điểm giảm dần, id giảm dần); cursor của trang sau là
+    cặp (điểm, id) của kết quả cuối cùng nên không dùng OFFSET.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.backend = self.detect_backend(engine)
+
+    @staticmethod
+    def detect_backend(engine: Engine) -> str:
+        inspector = inspect(engine)
+        if engine.dialect.name == "postgresql":
+            columns = {column["name"] for column in inspector.get_columns("messages")}
+            return "tsvector" if "search_vector" in columns else "like"
+        if engine.dialect.name == "sqlite" and inspector.has_table("messages_fts"):
+            return "fts5"
+        return "like"
+
+    def build(self, user_id: int, terms: List[SearchTerm], limit: int,
+              cursor: Optional[Tuple[float, int]] = None) -> Tuple[Any, Dict[str, Any]]:
+        """
+        Câu SQL trả về ``(id, score)`` của tối đa ``limit`` tin nhắn khớp
+        ``terms`` mà ``user_id`` được xem, cùng tham số của nó.
+        """
+        params: Dict[str, Any] = {"user_id": user_id, "limit": limit}
+        if self.backend == "tsvector":
+            params["query"] = self._tsquery(terms)
+            # ts_rank_cd trả về real: đổi sang float8 để điểm trong cursor so sánh bằng được chính xác
+            matched = ("SELECT m.id AS id, ts_rank_cd(m.search_vector, q)::float8 AS score "
+                       "FROM messages m, to_tsquery('simple', :query) q "
+                       f"WHERE m.search_vector @@ q AND {_VISIBLE_TO_USER}")
+        elif self.backend == "fts5":
+            params["query"] = self._fts5_query(terms)
+            # bm25: càng nhỏ càng khớp; đổi dấu để mọi backend cùng sắp giảm dần
+            matched = ("SELECT m.id AS id, -bm25(messages_fts) AS score "
+                       "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                       f"WHERE messages_fts MATCH :query AND {_VISIBLE_TO_USER}")
+        else:
+            conditions = []
+            for index, term in enumerate(terms):
+                pattern = " ".join(term.words).replace("_", "\\_")
+                params[f"term{index}"] = f"%{pattern}%"
+                conditions.append(f"coalesce(m.search_key, lower(m.content)) LIKE :term{index} ESCAPE '\\'")
+            matched = (f"SELECT m.id AS id, 0.0 AS score FROM messages m "
+                       f"WHERE {' AND '.join(conditions)} AND {_VISIBLE_TO_USER}")
+        sql = f"SELECT id, score FROM ({matched}) matched"
+        if cursor is not None:
+            params["cursor_score"], params["cursor_id"] = cursor
+            sql += (" WHERE score < :cursor_score OR (score = :cursor_score AND id < :cursor_id)")
+        sql += " ORDER BY score DESC, id DESC LIMIT :limit"
+        return text(sql), params
+
+    @staticmethod
+    def _tsquery(terms: List[SearchTerm]) -> str:
+        parts = []
+        for term in terms:
+            lexemes = list(term.words)
+            if term.prefix:
+                lexemes[-1] += ":*"
+            # Cụm từ: các từ liền nhau theo thứ tự
+            parts.append(" <-> ".join(lexemes) if len(lexemes) > 1 else lexemes[0])
+        return " & ".join(parts)
+
+    @staticmethod
+    def _fts5_query(terms: List[SearchTerm]) -> str:
+        parts = []
+        for term in terms:
+            # Từ chỉ gồm chữ/số nên đặt trong "..." là an toàn
+            phrase = '"' + " ".join(term.words) + '"'
+            parts.append(phrase + " *" if term.prefix else phrase)
+        return " AND ".join(parts)
@@ -1,29 +1,77 @@
 import socket
 import threading
-import json
 import base64
+import hashlib
 import time 
 from datetime import datetime
 from typing import Dict, List, Optional
 from .database import DatabaseManager, Group,User
-from .database import Message
+from .database import Message, MESSAGE_PAGE_SIZE, SEARCH_PAGE_SIZE, CONVERSATION_PREVIEW_LENGTH
 from sqlalchemy import desc
+from common.protocol import (Frame, FrameDecoder, ProtocolError, decode_chunk, decode_json, encode_chunk,
+                             DEFAULT_CHUNK_SIZE)
+from .connection import ClientConnection
+from .fanout import BroadcastStats, EncodedMessage, FanoutEngine
+from .uploads import UploadError, UploadManager
+from .blob_store import BlobStore
+from .dispatch import MessageDispatcher, RequestContext
+from .ingest import MessageIngestor
+from .thumbnails import ThumbnailService
 import os
 
 class ChatServer:
-    def __init__(self, host='192.168.1.10', port=12345):
+    RECV_BUFFER_SIZE = 64 * 1024
+    # Gói tin đọc/sửa tin nhắn: chờ tin nhắn đang ghi nền xuống database trước khi xử lý
+    MESSAGE_READ_TYPES = frozenset({'get_messages', 'get_conversations', 'search_messages',
+                                    'mark_read', 'delete_message', 'clear_chat', 'sync',
+                                    'pin_conversation'})
+
+    def __init__(self, host='192.168.1.10', port=12345, accept_legacy_clients: bool = True,
+                 backlog: int = 128, send_queue_options: Optional[Dict[str, float]] = None,
+                 upload_dir: str = "uploads", max_upload_size: int = 10 * 1024 * 1024,
+                 upload_resume_ttl: float = 3600, blob_dir: str = "blobs", thumbnail_workers: int = 2,
+                 db_pool_options: Optional[Dict[str, int]] = None, ingest_journal: str = "ingest.journal",
+                 ingest_batch_size: int = 100, ingest_flush_ms: int = 50, ingest_fsync: bool = True,
+                 log_stats: bool = False):
         self.host = host
         self.port = port
+        self.backlog = backlog
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)        
-        # Database
-        self.db = DatabaseManager()       
-        # Client connections: {user_id: client_socket}
-        self.clients: Dict[int, socket.socket] = {}      
+        # File đính kèm và avatar, đánh địa chỉ theo SHA-256
+        self.blobs = BlobStore(blob_dir)
+        # Ảnh thu nhỏ của file ảnh/avatar, tạo trong process pool riêng
+        self.thumbnails = ThumbnailService(self.blobs, max_workers=thumbnail_workers)
+        # Database: Session riêng cho mỗi request, kết nối mượn từ pool
+        self.db = DatabaseManager(blob_store=self.blobs, thumbnails=self.thumbnails,
+                                  pool_options=db_pool_options)
+        # Tin nhắn văn bản: xác nhận ngay, ghi xuống database theo lô; journal giữ tin chưa ghi
+        self.ingestor = MessageIngestor(self.db, ingest_journal, batch_size=ingest_batch_size,
+                                        flush_interval_ms=ingest_flush_ms, fsync=ingest_fsync)
+        self.ingestor.start()
+        # Client connections: {user_id: ClientConnection}
+        self.clients: Dict[int, ClientConnection] = {}      
+        # Tham số hàng đợi gửi của mỗi kết nối (watermark, giới hạn, timeout)
+        self.send_queue_options = send_queue_options or {}
         # User sessions: {session_token: user_id}
         self.sessions: Dict[str, int] = {}        
         # Typing status: {user_id: {conversation_id: timestamp}}
         self.typing_status: Dict[int, Dict[int, float]] = {}       
+        # Chấp nhận client cũ gửi JSON trần trong giai đoạn chuyển đổi protocol
+        self.accept_legacy_clients = accept_legacy_clients
+        # In thống kê (fan-out, handler, pool, cache, ingest) ở mỗi lượt cleanup
+        self.log_stats = log_stats
+        # Broadcast: mã hóa gói tin một lần cho mọi người nhận
+        self.fanout = FanoutEngine()
+        # Upload file theo chunk, ghi thẳng xuống thư mục tạm; upload dở dang được
+        # giữ lại upload_resume_ttl giây để client tiếp tục sau khi kết nối lại
+        self.uploads = UploadManager(upload_dir, max_file_size=max_upload_size, resume_ttl=upload_resume_ttl)
+        # Bảng handler theo loại gói tin, kèm middleware kiểm tra session và thống kê độ trễ
+        self.dispatcher = MessageDispatcher()
+        self.dispatcher.use(self._db_session_middleware)
+        self.dispatcher.use(self._session_middleware)
+        self.dispatcher.use(self._ingest_barrier_middleware)
+        self._register_handlers()
         self.running = False       
         print(f"🚀 Chat Server initializing on {host}:{port}")   
         self._initialize_company_group()
@@ -59,11 +107,13 @@ class ChatServer:
         except Exception as e:
             print(f"❌ Error initializing company-wide group: {e}")
             self.db.db.rollback()
+        finally:
+            self.db.remove_session()
     def start(self):
         """Khởi động server"""
         try:
             self.socket.bind((self.host, self.port))
-            self.socket.listen(10)
+            self.socket.listen(self.backlog)
             self.running = True           
             print(f"✅ Server started successfully!")
             print(f"🌐 Listening on {self.host}:{self.port}")
@@ -94,11 +144,8 @@ class ChatServer:
         print("\n👋 Shutting down server...")
         self.running = False       
         # Close all client connections
-        for user_id, client_socket in self.clients.copy().items():
-            try:
-                client_socket.close()
-            except:
-                pass        
+        for user_id, connection in self.clients.copy().items():
+            connection.close()
         self.clients.clear()
         self.sessions.clear()       
         # Close server socket
@@ -106,74 +153,40 @@ class ChatServer:
             self.socket.close()
         except:
             pass       
+        self.thumbnails.shutdown()
+        # Ghi nốt tin nhắn đang chờ trước khi đóng database
+        self.ingestor.stop()
         # Close database
         self.db.close()
         print("✅ Server stopped successfully")   
+    def _create_connection(self, client_socket: socket.socket, address) -> ClientConnection:
+        """Tạo kết nối với hàng đợi gửi riêng và khởi động writer của nó."""
+        connection = ClientConnection(client_socket, address, **self.send_queue_options)
+        connection.start()
+        return connection
     def _handle_client(self, client_socket: socket.socket, address):
-        """Xử lý client connection với bộ đệm JSON an toàn."""
+        """Xử lý client connection, giải mã frame từ bộ đệm nhận."""
         user_id = None
-        buffer = "" # Bộ đệm cho mỗi client
+        connection = self._create_connection(client_socket, address)
+        decoder = FrameDecoder(allow_legacy=self.accept_legacy_clients)
+        recv_buffer = bytearray(self.RECV_BUFFER_SIZE)
+        recv_view = memoryview(recv_buffer)
         try:
             while self.running:
                 try:
-                    # Nhận dữ liệu và nối vào buffer
-                    data = client_socket.recv(4096).decode('utf-8')
-                    if not data:
+                    received = client_socket.recv_into(recv_buffer)
+                    if not received:
                         # Client đã ngắt kết nối
                         break
-                    buffer += data
-                    # Xử lý tất cả các gói JSON hoàn chỉnh có trong buffer
-                    while True:
-                        # Tìm vị trí bắt đầu và kết thúc của một đối tượng JSON
-                        # Giả định mỗi gói tin là một dictionary, bắt đầu bằng '{' và kết thúc bằng '}'
-                        try:
-                            start_index = buffer.find('{')
-                            if start_index == -1:
-                                # Không có JSON object nào, có thể là dữ liệu rác
-                                buffer = ""
-                                break
-                            # Tìm dấu ngoặc đóng tương ứng, xử lý trường hợp có dấu ngoặc trong chuỗi
-                            brace_count = 0
-                            end_index = -1
-                            in_string = False
-                            for i in range(start_index, len(buffer)):
-                                char = buffer[i]
-                                if char == '"' and (i == 0 or buffer[i-1] != '\\'):
-                                    in_string = not in_string
-                                elif not in_string:
-                                    if char == '{':
-                                        brace_count += 1
-                                    elif char == '}':
-                                        brace_count -= 1                   
-                                if brace_count == 0 and i >= start_index:
-                                    end_index = i
-                                    break                           
-                            if end_index != -1:
-                                # Đã tìm thấy một gói JSON hoàn chỉnh
-                                json_str = buffer[start_index : end_index + 1]
-                                message = json.loads(json_str)                              
-                                # Xóa gói JSON đã xử lý khỏi buffer
-                                buffer = buffer[end_index + 1:]                                
-                                # Xử lý message
-                                response = self._process_message(message, client_socket, address)                                
-                                # Cập nhật user_id nếu đăng nhập thành công
-                                if message.get('type') == 'login' and response.get('success'):
-                                    user_id = response.get('user_id')
-                                    self.clients[user_id] = client_socket                               
-                                # Gửi phản hồi nếu có
-                                if response:
-                                    self._send_message(client_socket, response)
-                            else:
-                                # Chưa có gói JSON hoàn chỉnh, đợi thêm dữ liệu
-                                break                               
-                        except json.JSONDecodeError:
-                            # Lỗi này có thể xảy ra nếu gói tin chưa đầy đủ, đợi thêm dữ liệu
-                            print(f"JSONDecodeError - Buffer có thể chưa hoàn chỉnh. Buffer: {buffer}")
-                            break # Thoát vòng lặp while True và đợi recv() tiếp
-                        except Exception as e:
-                            print(f"Lỗi xử lý buffer của client {address}: {e}")
-                            buffer = "" # Xóa buffer để tránh lặp lỗi
-                            break
+                    frames = decoder.feed(recv_view[:received])
+                    connection.legacy = bool(decoder.is_legacy)
+                    for frame in frames:
+                        logged_in_user = self._handle_frame(frame, connection, address)
+                        if logged_in_user:
+                            user_id = logged_in_user
+                except ProtocolError as e:
+                    print(f"Lỗi protocol từ client {address}: {e}")
+                    break
                 except ConnectionResetError:
                     break # Client ngắt kết nối đột ngột
                 except Exception as e:
@@ -185,69 +198,118 @@ class ChatServer:
         finally:
             # Dọn dẹp khi client ngắt kết nối
             if user_id:
-                self._handle_disconnect(user_id)            
-            try:
-                client_socket.close()
-            except:
-                pass           
+                self._handle_disconnect(user_id, connection)            
+            connection.close()
             print(f"🔌 Client {address} đã ngắt kết nối")    
-    def _process_message(self, message: dict, client_socket: socket.socket, address) -> dict:
-        """Xử lý tin nhắn từ client"""
-        message_type = message.get('type')        
+    def _handle_frame(self, frame: Frame, connection: ClientConnection, address) -> Optional[int]:
+        """Xử lý một frame: chunk nhị phân của upload hoặc gói tin JSON."""
+        if frame.is_binary:
+            self._handle_upload_chunk(frame, connection)
+            return None
         try:
-            if message_type == 'register':
-                return self._handle_register(message)            
-            elif message_type == 'login':
-                return self._handle_login(message, address)            
-            elif message_type == 'logout':
-                return self._handle_logout(message)            
-            elif message_type == 'send_message':
-                return self._handle_send_message(message)           
-            elif message_type == 'send_private_message':
-                return self._handle_send_private_message(message)         
-            elif message_type == 'upload_file':
-                return self._handle_upload_file(message)          
-            elif message_type == 'get_contacts':
-                return self._handle_get_contacts(message)        
-            elif message_type == 'get_conversations':
-                return self._handle_get_conversations(message)        
-            elif message_type == 'get_messages':
-                return self._handle_get_messages(message)       
-            elif message_type == 'mark_read':
-                return self._handle_mark_read(message)            
-            elif message_type == 'typing_start':
-                return self._handle_typing_start(message)            
-            elif message_type == 'typing_stop':
-                return self._handle_typing_stop(message)            
-            elif message_type == 'update_status':
-                return self._handle_update_status(message)            
-            elif message_type == 'search_messages':
-                return self._handle_search_messages(message)           
-            elif message_type == 'delete_message':
-                return self._handle_delete_message(message)    
-            elif message_type == 'create_group':
-                return self._handle_create_group(message)    
-            elif message_type == 'get_group_members':
-                return self._handle_get_group_members(message)
-            elif message_type == 'add_group_member':
-                return self._handle_add_group_member(message)
-            elif message_type == 'remove_group_member':
-                return self._handle_remove_group_member(message)       
-            elif message_type == 'clear_chat':
-                return self._handle_clear_chat(message)            
-            elif message_type == 'upload_avatar':
-                return self._handle_upload_avatar(message)
-            else:
-                return {"success": False, "error": "Unknown message type"}     
-        except Exception as e:
-            print(f"❌ Error processing message type {message_type}: {e}")
-            return {"success": False, "error": str(e)}
-    def _handle_create_group(self, message: dict) -> dict:
-        """Xử lý yêu cầu tạo nhóm mới."""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
+            message = decode_json(frame.payload)
+        except ValueError as e:
+            print(f"Gói tin JSON không hợp lệ từ {address}: {e}")
+            return None
+        return self._handle_request(message, connection, address)
+    def _handle_request(self, message: dict, connection: ClientConnection, address) -> Optional[int]:
+        """
+        Xử lý một gói tin và gửi phản hồi. Trả về user_id nếu gói tin gắn kết nối
+        với user: đăng nhập, hoặc sync thành công của client kết nối lại với session cũ.
+        """
+        response = self._process_message(message, connection, address)
+        user_id = None
+        # Cập nhật user_id nếu đăng nhập thành công
+        if message.get('type') == 'login' and response and response.get('success'):
+            user_id = response.get('user_id')
+            connection.user_id = user_id
+            self.clients[user_id] = connection
+        elif message.get('type') == 'sync' and response and response.get('success'):
+            user_id = response.get('user_id')
+            reattached = self.clients.get(user_id) is not connection
+            connection.user_id = user_id
+            self.clients[user_id] = connection
+            if reattached:
+                self.db.update_user_status(user_id, "online")
+                self._broadcast_user_status(user_id, "online")
+        # Gửi phản hồi nếu có
+        if response:
+            self._send_message(connection, response)
+        return user_id
+    def _register_handlers(self):
+        """Đăng ký handler cho các loại gói tin có sẵn. Module ngoài dùng register_handler."""
+        # Không cần đăng nhập (logout tự kiểm tra session_token của nó)
+        for message_type, handler in (
+                ('register', self._handle_register),
+                ('login', self._handle_login),
+                ('logout', self._handle_logout),
+        ):
+            self.dispatcher.register(message_type, handler, requires_session=False)
+        for message_type, handler in (
+                ('send_message', self._handle_send_message),
+                ('send_private_message', self._handle_send_private_message),
+                ('upload_file', self._handle_upload_file),
+                ('begin_upload', self._handle_begin_upload),
+                ('commit_upload', self._handle_commit_upload),
+                ('cancel_upload', self._handle_cancel_upload),
+                ('resume_upload', self._handle_resume_upload),
+                ('download_file', self._handle_download_file),
+                ('get_attachment', self._handle_get_attachment),
+                ('get_contacts', self._handle_get_contacts),
+                ('get_conversations', self._handle_get_conversations),
+                ('get_messages', self._handle_get_messages),
+                ('sync', self._handle_sync),
+                ('mark_read', self._handle_mark_read),
+                ('typing_start', self._handle_typing_start),
+                ('typing_stop', self._handle_typing_stop),
+                ('update_status', self._handle_update_status),
+                ('search_messages', self._handle_search_messages),
+                ('delete_message', self._handle_delete_message),
+                ('create_group', self._handle_create_group),
+                ('get_group_members', self._handle_get_group_members),
+                ('add_group_member', self._handle_add_group_member),
+                ('remove_group_member', self._handle_remove_group_member),
+                ('clear_chat', self._handle_clear_chat),
+                ('pin_conversation', self._handle_pin_conversation),
+                ('upload_avatar', self._handle_upload_avatar),
+                ('get_avatar', self._handle_get_avatar),
+        ):
+            self.dispatcher.register(message_type, handler)
+    def register_handler(self, message_type: str, handler, requires_session: bool = True,
+                         replace: bool = False):
+        """
+        Thêm loại gói tin mới (hoặc thay handler có sẵn với ``replace=True``).
+
+        ``handler(message, ctx)`` nhận RequestContext có ``user_id`` đã được
+        kiểm tra, ``connection`` và ``address``; trả về dict phản hồi hoặc None.
+        """
+        self.dispatcher.register(message_type, handler, requires_session, replace)
+    def _db_session_middleware(self, ctx: RequestContext, call_next) -> Optional[dict]:
+        """Mỗi request là một unit of work: Session được đóng và kết nối trả về pool khi xong."""
+        try:
+            return call_next(ctx)
+        finally:
+            self.db.remove_session()
+    def _session_middleware(self, ctx: RequestContext, call_next) -> Optional[dict]:
+        """Tra session_token một lần cho mọi handler thay vì lặp lại trong từng _handle_*."""
+        ctx.user_id = self.sessions.get(ctx.message.get('session_token'))
+        if ctx.requires_session and not ctx.user_id:
             return {"success": False, "error": "Invalid session"}
+        return call_next(ctx)
+    def _ingest_barrier_middleware(self, ctx: RequestContext, call_next) -> Optional[dict]:
+        """Người gửi phải thấy tin nhắn vừa gửi trong kết quả đọc ngay sau đó."""
+        if ctx.message_type in self.MESSAGE_READ_TYPES and not self.ingestor.wait_persisted():
+            print(f"⚠️ {ctx.message_type}: tin nhắn mới chưa kịp ghi xuống database")
+        return call_next(ctx)
+    def _process_message(self, message: dict, connection: ClientConnection, address) -> dict:
+        """Xử lý tin nhắn từ client qua bảng handler (đo độ trễ/lỗi theo loại gói tin)."""
+        return self.dispatcher.dispatch(message, connection, address)
+    def get_handler_stats(self) -> Dict[str, Dict[str, float]]:
+        """Số lần gọi, lỗi và độ trễ p50/p95/p99 của từng loại gói tin."""
+        return self.dispatcher.stats()
+    def _handle_create_group(self, message: dict, ctx: RequestContext) -> dict:
+        """Xử lý yêu cầu tạo nhóm mới."""
+        user_id = ctx.user_id
 
         group_name = message.get('group_name')
         member_ids = message.get('member_ids', [])
@@ -287,10 +349,9 @@ class ChatServer:
             "conversation": conversation_data
         }
 
-        for member in group.members:
-            # Gửi thông báo đến tất cả thành viên (bao gồm cả người tạo)
-            self._send_message_to_user(member.id, notification)
-    def _handle_register(self, message: dict) -> dict:
+        # Gửi thông báo đến tất cả thành viên (bao gồm cả người tạo)
+        self._broadcast_to_users([member.id for member in group.members], notification)
+    def _handle_register(self, message: dict, ctx: RequestContext) -> dict:
         """Xử lý đăng ký"""
         username = message.get('username', '').strip()
         password = message.get('password', '')
@@ -306,12 +367,9 @@ class ChatServer:
                 "user": self.db._user_to_dict(user)}
         else:
             return {"success": False, "error": error_msg}
-    def _handle_add_group_member(self, message: dict) -> dict:
+    def _handle_add_group_member(self, message: dict, ctx: RequestContext) -> dict:
         """Xử lý yêu cầu thêm thành viên."""
-        session_token = message.get('session_token')
-        actor_id = self.sessions.get(session_token)
-        if not actor_id:
-            return {"success": False, "error": "Invalid session"}
+        actor_id = ctx.user_id
 
         group_id = message.get('group_id')
         member_id_to_add = message.get('member_id')
@@ -324,12 +382,9 @@ class ChatServer:
         
         return {"type": "add_member_response", "success": success, "message": msg}
 
-    def _handle_remove_group_member(self, message: dict) -> dict:
+    def _handle_remove_group_member(self, message: dict, ctx: RequestContext) -> dict:
         """Xử lý yêu cầu xóa thành viên."""
-        session_token = message.get('session_token')
-        actor_id = self.sessions.get(session_token)
-        if not actor_id:
-            return {"success": False, "error": "Invalid session"}
+        actor_id = ctx.user_id
 
         group_id = message.get('group_id')
         member_id_to_remove = message.get('member_id')
@@ -346,13 +401,8 @@ class ChatServer:
             self._broadcast_group_update(group_id)
 
         return {"type": "remove_member_response", "success": success, "message": msg}
-    def _handle_get_group_members(self, message: dict) -> dict:
+    def _handle_get_group_members(self, message: dict, ctx: RequestContext) -> dict:
         """Xử lý yêu cầu lấy danh sách thành viên nhóm."""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
-
         group_id = message.get('group_id')
         group = self.db.db.query(Group).filter(Group.id == group_id).first()
 
@@ -380,16 +430,14 @@ class ChatServer:
             "creator_id": group.creator_id,
             "members": [self.db._user_to_dict(member) for member in group.members]
         }
-        
-        for member in group.members:
-            self._send_message_to_user(member.id, update_packet)
-    def _handle_login(self, message: dict, address) -> dict:
+        self._broadcast_to_users([member.id for member in group.members], update_packet)
+    def _handle_login(self, message: dict, ctx: RequestContext) -> dict:
         """Xử lý đăng nhập (ĐÃ SỬA LỖI LOGIC TRẢ VỀ HỘI THOẠI)."""
         username = message.get('username', '').strip()
         password = message.get('password', '')        
         
         success, error_msg, user, session_token = self.db.login_user(
-            username, password, address[0])       
+            username, password, ctx.address[0] if ctx.address else None)       
         
         if success:
             self.sessions[session_token] = user.id          
@@ -414,14 +462,16 @@ class ChatServer:
                 "session_token": session_token,
                 "user_id": user.id,
                 "all_users": all_users,
-                "conversations": conversations # Trả về danh sách hội thoại đã lấy được
+                "conversations": conversations, # Trả về danh sách hội thoại đã lấy được
+                # Mốc thay đổi để client chỉ xin phần chênh lệch khi kết nối lại (sync)
+                "change_id": self.db.latest_change_id()
             }
         else:
             return {"success": False, "error": error_msg}
-    def _handle_logout(self, message: dict) -> dict:
+    def _handle_logout(self, message: dict, ctx: RequestContext) -> dict:
         """Xử lý đăng xuất"""
         session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
+        user_id = ctx.user_id
         if user_id:
             self.db.logout_user(user_id, session_token)
             # Remove from sessions and clients
@@ -433,11 +483,8 @@ class ChatServer:
             self._broadcast_user_status(user_id, "offline")
             return {"success": True, "message": "Đăng xuất thành công"}
         return {"success": False, "error": "Invalid session"}
-    def _handle_send_message(self, message: dict) -> dict:
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+    def _handle_send_message(self, message: dict, ctx: RequestContext) -> dict:
+        user_id = ctx.user_id
         
         group_id = message.get('group_id')
         content = message.get('content', '')
@@ -445,56 +492,86 @@ class ChatServer:
 
         if not group_id:
             return {"success": False, "error": "Group ID is required"}
+        error = self.ingestor.validate(content, 'text', client_msg_id)
+        if error:
+            return {"success": False, "error": error}
 
-        # Sửa lỗi logic: không truyền is_group_message nữa
-        msg = self.db.save_message(
-            sender_id=user_id,
-            group_id=group_id,
-            content=content,
-            message_type='text',
-            client_message_id=client_msg_id
-        )
-        
-        if msg:
-            self._broadcast_message_to_group(msg)
-            return {"success": True, "message": "Message processed"}
-        return {"success": False, "error": "Failed to send message"}
-    def _broadcast_message_to_group(self, message: 'Message'):
-        """Broadcast tin nhắn đến TẤT CẢ thành viên của một nhóm cụ thể."""
-        if not message.group_id:
+        # Kiểm tra trước khi xác nhận vì tin nhắn chỉ được ghi xuống database sau đó
+        group = self.db.db.query(Group).filter(Group.id == group_id).first()
+        sender = self.db.get_user_by_id(user_id)
+        if not group or not sender:
+            return {"success": False, "error": "Group not found"}
+
+        msg = self.ingestor.submit(sender, group_id=group.id, content=content, message_type='text',
+                                   client_message_id=client_msg_id)
+        self._broadcast_message_to_group(msg, group)
+        return {"success": True, "message": "Message processed", "message_id": msg["id"]}
+    def _broadcast_message_to_group(self, message: dict, group: Optional[Group] = None):
+        """Broadcast tin nhắn (dict của _message_to_dict) đến TẤT CẢ thành viên của nhóm."""
+        if not message.get("group_id"):
             return
 
         # Sử dụng session của DB để lấy thông tin group và members
-        group = self.db.db.query(Group).filter(Group.id == message.group_id).first()
+        if group is None:
+            group = self.db.db.query(Group).filter(Group.id == message["group_id"]).first()
         if not group:
-            print(f"Lỗi broadcast: Không tìm thấy nhóm với ID {message.group_id}")
+            print(f"Lỗi broadcast: Không tìm thấy nhóm với ID {message['group_id']}")
             return
 
         message_data = {
             "type": "new_message",
-            "message": self.db._message_to_dict(message)
+            "message": message
         }
-        
-        print(f"Broadcasting message id {message.id} to group {group.id} ('{group.name}')")
-        
-        # Lấy danh sách ID thành viên từ đối tượng group
+        # Chỉ thành viên đang online mới nhận được tin nhắn
         member_ids = [member.id for member in group.members]
-        print(f"Group members to notify: {member_ids}")
-        
-        for member_id in member_ids:
-            # Gửi tin nhắn đến thành viên nếu họ đang online
-            # self.clients là một dictionary {user_id: client_socket}
-            if member_id in self.clients:
-                print(f"  -> Sending to online user {member_id}")
-                self._send_message_to_user(member_id, message_data)
-            else:
-                print(f"  -> User {member_id} is offline.")
-    def _handle_send_private_message(self, message: dict) -> dict:
+        stats = self._broadcast_to_users(member_ids, message_data)
+        self._broadcast_conversation_update(message, member_ids)
+        print(f"Broadcast message id {message['id']} to group {group.id} ('{group.name}'): "
+              f"{stats.delivered}/{stats.recipients} online members, {stats.payload_bytes} bytes, "
+              f"encode {stats.encode_ms:.2f}ms, send {stats.send_ms:.2f}ms")
+    def _broadcast_conversation_update(self, message: dict, member_ids: Optional[List[int]] = None):
+        """
+        Gửi conversation_updated ngay sau new_message để client cập nhật danh sách
+        hội thoại tại chỗ (tin nhắn cuối, thứ tự, số tin chưa đọc) thay vì gọi lại
+        get_conversations. Người gửi nhận ``unread_delta`` 0, người khác nhận 1;
+        mỗi phiên bản được mã hóa một lần cho mọi người nhận.
+        """
+        sender_id = message["sender"]["id"]
+        update = {
+            "type": "conversation_updated",
+            "last_message_id": message["id"],
+            "last_message_preview": (message.get("content") or "")[:CONVERSATION_PREVIEW_LENGTH],
+            "message_type": message.get("message_type"),
+            "sender_id": sender_id,
+            # Khóa sắp xếp: danh sách hội thoại theo updated_at giảm dần
+            "updated_at": message["timestamp"],
+        }
+        if message.get("group_id"):
+            group_id = message["group_id"]
+            target = {"conversation": self.db.sync_key(group_id=group_id), "group_id": group_id}
+            self._broadcast_to_users([uid for uid in member_ids or [] if uid != sender_id],
+                                     dict(update, unread_delta=1, **target))
+            self._broadcast_to_users([sender_id], dict(update, unread_delta=0, **target))
+            return
+        receiver_id = (message.get("receiver") or {}).get("id")
+        if not receiver_id:
+            return
+        if receiver_id != sender_id:
+            self._broadcast_to_users([receiver_id], dict(
+                update, conversation=self.db.sync_key(other_user_id=sender_id), other_user_id=sender_id,
+                unread_delta=1))
+        self._broadcast_to_users([sender_id], dict(
+            update, conversation=self.db.sync_key(other_user_id=receiver_id), other_user_id=receiver_id,
+            unread_delta=0))
+    def _is_reply_target(self, message_id: int, user_id: int, other_user_id: int = None, group_id: int = None) -> bool:
+        """Tin nhắn được trả lời có trong cùng hội thoại; chờ các tin nhắn đang ghi nền nếu chưa thấy."""
+        if self.db.is_reply_target(message_id, user_id, other_user_id, group_id):
+            return True
+        # Có thể là tin nhắn vừa gửi, còn nằm trong hàng đợi của MessageIngestor
+        return self.ingestor.wait_persisted() and self.db.is_reply_target(message_id, user_id, other_user_id, group_id)
+    def _handle_send_private_message(self, message: dict, ctx: RequestContext) -> dict:
         """Xử lý gửi tin nhắn riêng"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)       
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}   
+        user_id = ctx.user_id
         
         receiver_username = message.get('receiver')
         content = message.get('content', '')
@@ -502,47 +579,45 @@ class ChatServer:
         reply_to_id = message.get('reply_to_id')
         client_msg_id = message.get('client_message_id')
         
+        # Kiểm tra trước khi xác nhận: tin nhắn đã xác nhận phải ghi được xuống database
+        error = self.ingestor.validate(content, message_type, client_msg_id)
+        if error:
+            return {"success": False, "error": error}
         receiver = self.db.get_user_by_username(receiver_username)
         if not receiver:
             return {"success": False, "error": "Receiver not found"}
-            
-        # SỬA LỜI GỌI HÀM Ở ĐÂY:
-        # Loại bỏ is_group=False và đảm bảo không truyền group_id
-        msg = self.db.save_message(
-            sender_id=user_id,
-            receiver_id=receiver.id,
-            content=content,
-            message_type=message_type,
-            reply_to_id=reply_to_id,
-            client_message_id=client_msg_id
-        )
-        
-        if msg:
-            new_message_packet = {
-                "type": "new_message",
-                "message": self.db._message_to_dict(msg)
-            }
-            
-            # Gửi tin nhắn đến người nhận nếu họ đang online
-            self._send_message_to_user(receiver.id, new_message_packet)
-            
-            # Gửi lại xác nhận cho chính người gửi
-            # (Điều này quan trọng để client có thể cập nhật trạng thái tin nhắn)
-            self._send_message_to_user(user_id, new_message_packet)
+        sender = self.db.get_user_by_id(user_id)
+        if not sender:
+            return {"success": False, "error": "Failed to send message"}
+        if not isinstance(reply_to_id, int):
+            reply_to_id = None
+        elif not self._is_reply_target(reply_to_id, user_id, other_user_id=receiver.id):
+            # Kiểm tra trước khi xác nhận: dòng có reply_to_id sai sẽ bị database từ chối khi ghi theo lô
+            return {"success": False, "error": "Reply target not found"}
 
-            # Trả về một phản hồi đơn giản, vì client đã nhận được tin nhắn đầy đủ ở trên
-            return {
-                "success": True,
-                "message": "Message processed",
-                "client_message_id": client_msg_id
-            }
-            
-        return {"success": False, "error": "Failed to send message"}
-    def _handle_upload_file(self, message: dict) -> dict:
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+        # Xác nhận và gửi ngay; MessageIngestor ghi xuống database theo lô
+        msg = self.ingestor.submit(sender, receiver=receiver, content=content, message_type=message_type,
+                                   reply_to_id=reply_to_id, client_message_id=client_msg_id)
+        new_message_packet = {
+            "type": "new_message",
+            "message": msg
+        }
+
+        # Gửi tin nhắn đến người nhận nếu họ đang online, và gửi lại xác nhận
+        # cho chính người gửi (để client cập nhật trạng thái tin nhắn)
+        self._broadcast_to_users([receiver.id, user_id], new_message_packet)
+        self._broadcast_conversation_update(msg)
+
+        # Trả về một phản hồi đơn giản, vì client đã nhận được tin nhắn đầy đủ ở trên
+        return {
+            "success": True,
+            "message": "Message processed",
+            "message_id": msg["id"],
+            "client_message_id": client_msg_id
+        }
+    def _handle_upload_file(self, message: dict, ctx: RequestContext) -> dict:
+        """Upload file base64 trong một gói tin (client cũ). Client mới dùng begin_upload."""
+        user_id = ctx.user_id
         
         file_name = message.get('file_name')
         file_data_b64 = message.get('file_data')
@@ -551,55 +626,306 @@ class ChatServer:
 
         try:
             file_data = base64.b64decode(file_data_b64)
-            if len(file_data) > 10 * 1024 * 1024:
-                return {"success": False, "error": "File quá lớn (tối đa 10MB)"}
+            if len(file_data) > self.uploads.max_file_size:
+                return {"success": False, "error": f"File quá lớn (tối đa {self.uploads.max_file_size // (1024 * 1024)}MB)"}
 
-            file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
-            message_type = "image" if file_ext in ['jpg', 'jpeg', 'png', 'gif', 'bmp'] else "file"
-            
             receiver_id = None
             if receiver_username:
                 receiver = self.db.get_user_by_username(receiver_username)
                 if receiver: receiver_id = receiver.id
 
-            msg = self.db.save_message(
-                sender_id=user_id,
-                receiver_id=receiver_id,
-                group_id=group_id,
-                content=f"📎 {file_name}",
-                message_type=message_type,
-                file_name=file_name,
-                file_data=file_data
-            )
-
+            msg = self._save_file_message(user_id, file_name, receiver_id, group_id, file_data=file_data)
             if msg:
-                if group_id:
-                    self._broadcast_message_to_group(msg)
-                elif receiver_id:
-                    new_message_packet = {"type": "new_message", "message": self.db._message_to_dict(msg)}
-                    self._send_message_to_user(receiver_id, new_message_packet)
-                    self._send_message_to_user(user_id, new_message_packet)
-                
                 return {"success": True, "message": "File uploaded successfully", "message_id": msg.id}
         except Exception as e:
             return {"success": False, "error": f"Upload failed: {str(e)}"}
         
         return {"success": False, "error": "Failed to upload file"}
+    def _save_file_message(self, user_id: int, file_name: str, receiver_id: Optional[int],
+                           group_id: Optional[int], file_data: bytes = None,
+                           file_hash: str = None, file_size: int = None) -> Optional[Message]:
+        """Lưu tin nhắn file/ảnh (dữ liệu hoặc blob đã có) và gửi đến người nhận hoặc nhóm."""
+        file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
+        message_type = "image" if file_ext in ['jpg', 'jpeg', 'png', 'gif', 'bmp'] else "file"
+
+        msg = self.db.save_message(
+            sender_id=user_id,
+            receiver_id=receiver_id,
+            group_id=group_id,
+            content=f"📎 {file_name}",
+            message_type=message_type,
+            file_name=file_name,
+            file_data=file_data,
+            file_hash=file_hash,
+            file_size=file_size,
+            message_id=self.ingestor.allocate_id()
+        )
+
+        if msg:
+            # Bắt đầu tạo ảnh thu nhỏ trước khi broadcast để metadata báo "pending"
+            thumbnails_pending = (message_type == "image" and msg.file_hash is not None
+                                  and self.thumbnails.submit(msg.file_hash))
+            if group_id:
+                self._broadcast_message_to_group(self.db._message_to_dict(msg))
+            elif receiver_id:
+                message_dict = self.db._message_to_dict(msg)
+                self._broadcast_to_users([receiver_id, user_id], {"type": "new_message", "message": message_dict})
+                self._broadcast_conversation_update(message_dict)
+            if thumbnails_pending:
+                self._notify_thumbnails_ready(msg, user_id, receiver_id, group_id)
+        return msg
+    def _notify_thumbnails_ready(self, msg: Message, user_id: int, receiver_id: Optional[int],
+                                 group_id: Optional[int]):
+        """Gửi attachment_updated (metadata có ảnh thu nhỏ) khi process pool xử lý xong."""
+        attachment = self.db._attachment_to_dict(msg)
+        if group_id:
+            group = self.db.db.query(Group).filter(Group.id == group_id).first()
+            recipients = [member.id for member in group.members] if group else []
+        else:
+            recipients = [receiver_id, user_id]
+
+        def on_done(sizes):
+            updated = dict(attachment)
+            updated["thumbnail"] = self.db._thumbnail_to_dict(attachment["hash"], attachment["name"])
+            self._broadcast_to_users(recipients, {
+                "type": "attachment_updated",
+                "message_id": attachment["id"],
+                "attachment": updated,
+            })
+        self.thumbnails.when_done(attachment["hash"], on_done)
+    def _handle_begin_upload(self, message: dict, ctx: RequestContext) -> dict:
+        """
+        Bắt đầu upload theo chunk. Kích thước được kiểm tra ngay tại đây,
+        trước khi client gửi byte dữ liệu nào.
+        """
+        user_id = ctx.user_id
+        client_upload_id = message.get('client_upload_id')
+
+        receiver_id = None
+        receiver_username = message.get('receiver')
+        if receiver_username:
+            receiver = self.db.get_user_by_username(receiver_username)
+            if not receiver:
+                return {"type": "upload_error", "success": False, "client_upload_id": client_upload_id,
+                        "error": "Người nhận không tồn tại"}
+            receiver_id = receiver.id
+
+        try:
+            upload = self.uploads.begin(
+                user_id,
+                file_name=message.get('file_name'),
+                file_size=message.get('file_size'),
+                sha256=message.get('sha256'),
+                receiver_id=receiver_id,
+                group_id=message.get('group_id'),
+            )
+        except UploadError as e:
+            return {"type": "upload_error", "success": False, "client_upload_id": client_upload_id,
+                    "error": str(e)}
+
+        print(f"📤 Upload {upload.upload_id} bắt đầu: {upload.file_name} ({upload.file_size} bytes) từ user {user_id}")
+        return {
+            "type": "upload_ready",
+            "success": True,
+            "upload_id": upload.upload_id,
+            "client_upload_id": client_upload_id,
+            "chunk_size": DEFAULT_CHUNK_SIZE,
+        }
+    def _handle_upload_chunk(self, frame: Frame, connection: ClientConnection):
+        """Ghi một chunk nhị phân xuống file tạm của upload. Chỉ phản hồi khi có lỗi."""
+        upload_id = None
+        try:
+            upload_id, offset, data = decode_chunk(frame.payload)
+            if not connection.user_id:
+                raise UploadError("Chưa đăng nhập")
+            self.uploads.write_chunk(upload_id, connection.user_id, offset, data)
+        except (UploadError, ProtocolError) as e:
+            if upload_id:
+                self.uploads.abort(upload_id, connection.user_id)
+            self._send_message(connection, {
+                "type": "upload_error", "success": False, "upload_id": upload_id, "error": str(e)
+            })
+    def _handle_commit_upload(self, message: dict, ctx: RequestContext) -> dict:
+        """Kiểm tra kích thước, hash rồi lưu file thành tin nhắn."""
+        user_id = ctx.user_id
+        upload_id = message.get('upload_id')
+
+        try:
+            upload = self.uploads.commit(upload_id, user_id)
+        except UploadError as e:
+            return {"type": "upload_error", "success": False, "upload_id": upload_id, "error": str(e)}
+
+        try:
+            # File tạm đã được kiểm tra hash nên được chuyển thẳng vào BlobStore, không đọc lại
+            file_hash = self.blobs.put_file(upload.path, upload.sha256)
+            msg = self._save_file_message(user_id, upload.file_name, upload.receiver_id, upload.group_id,
+                                          file_hash=file_hash, file_size=upload.file_size)
+        finally:
+            upload.discard()
+
+        if not msg:
+            return {"type": "upload_error", "success": False, "upload_id": upload_id,
+                    "error": "Failed to upload file"}
+        print(f"✅ Upload {upload_id} hoàn tất: message {msg.id}")
+        return {
+            "type": "upload_complete",
+            "success": True,
+            "upload_id": upload_id,
+            "message_id": msg.id,
+        }
+    def _handle_resume_upload(self, message: dict, ctx: RequestContext) -> dict:
+        """Tiếp tục một upload dở dang sau khi client kết nối lại; trả về offset đã nhận."""
+        user_id = ctx.user_id
+        connection = ctx.connection
+        upload_id = message.get('upload_id')
+        client_upload_id = message.get('client_upload_id')
+        try:
+            upload = self.uploads.resume(upload_id, user_id)
+        except UploadError as e:
+            return {"type": "upload_error", "success": False, "upload_id": upload_id,
+                    "client_upload_id": client_upload_id, "error": str(e)}
+        # Kết nối mới sau reconnect chưa gắn với user; chunk nhị phân cần biết user
+        connection.user_id = connection.user_id or user_id
+        print(f"🔁 Upload {upload_id} tiếp tục từ offset {upload.received}/{upload.file_size}")
+        return {
+            "type": "upload_ready",
+            "success": True,
+            "upload_id": upload_id,
+            "client_upload_id": client_upload_id,
+            "chunk_size": DEFAULT_CHUNK_SIZE,
+            "offset": upload.received,
+        }
+    def _handle_download_file(self, message: dict, ctx: RequestContext) -> dict:
+        """
+        Gửi nội dung file của một tin nhắn theo chunk nhị phân, bắt đầu từ
+        ``offset`` để client tải tiếp phần còn thiếu sau khi mất kết nối.
+
+        Mỗi yêu cầu chỉ gửi một cửa sổ cỡ low watermark của hàng đợi gửi rồi trả
+        ``download_window`` kèm ``next_offset``; client nhận hết cửa sổ mới xin
+        tiếp, nên file lớn không dồn cả vào hàng đợi (và không bị coi là client chậm).
+        """
+        user_id = ctx.user_id
+        connection = ctx.connection
+        download_id = message.get('download_id')
+        message_id = message.get('message_id')
+        offset = message.get('offset') or 0
+
+        msg = self.db.get_file_message(message_id, user_id)
+        if not msg:
+            return {"type": "download_error", "success": False, "download_id": download_id,
+                    "message_id": message_id, "error": "File không tồn tại"}
+        file_data = None
+        try:
+            if msg.file_hash:
+                file_size = self.blobs.size(msg.file_hash)
+            else:
+                # Tin nhắn cũ chưa được chuyển sang BlobStore
+                file_data = self.db.read_file_data(msg) or b''
+                file_size = len(file_data)
+        except OSError as e:
+            return {"type": "download_error", "success": False, "download_id": download_id,
+                    "message_id": message_id, "error": f"Không đọc được file: {e}"}
+        if not isinstance(offset, int) or offset < 0 or offset > file_size:
+            return {"type": "download_error", "success": False, "download_id": download_id,
+                    "message_id": message_id, "error": "Offset không hợp lệ"}
+
+        end = min(file_size, offset + max(DEFAULT_CHUNK_SIZE, connection.low_watermark))
+        if msg.file_hash:
+            blocks = self.blobs.iter_chunks(msg.file_hash, offset, DEFAULT_CHUNK_SIZE)
+        else:
+            blocks = (file_data[start:start + DEFAULT_CHUNK_SIZE]
+                      for start in range(offset, end, DEFAULT_CHUNK_SIZE))
+        try:
+            start = offset
+            for block in blocks:
+                block = block[:end - start]
+                if not connection.send(encode_chunk(download_id, start, block)):
+                    return None  # Kết nối đã đóng; client sẽ tải tiếp từ offset đã nhận
+                start += len(block)
+                if start >= end:
+                    break
+        except (ProtocolError, OSError) as e:
+            return {"type": "download_error", "success": False, "download_id": download_id,
+                    "message_id": message_id, "error": str(e)}
+        finally:
+            blocks.close()
+
+        if end < file_size:
+            return {
+                "type": "download_window",
+                "success": True,
+                "download_id": download_id,
+                "message_id": message_id,
+                "next_offset": end,
+            }
+        return {
+            "type": "download_complete",
+            "success": True,
+            "download_id": download_id,
+            "message_id": message_id,
+            "file_name": msg.file_name,
+            "file_size": file_size,
+            "sha256": msg.file_hash or hashlib.sha256(file_data).hexdigest(),
+        }
+    def _handle_get_attachment(self, message: dict, ctx: RequestContext) -> dict:
+        """Trả về nội dung file đính kèm của một tin nhắn (tin nhắn chỉ mang metadata)."""
+        user_id = ctx.user_id
+        message_id = message.get('message_id')
+        msg = self.db.get_file_message(message_id, user_id)
+        # Client chỉ cần ảnh xem trước thì gửi kèm size (px); trả về ảnh thu nhỏ gần nhất
+        thumbnail_size, file_data = self._read_thumbnail(msg.file_hash if msg else None, message.get('size'))
+        if file_data is None and msg:
+            file_data = self.db.read_file_data(msg)
+        if file_data is None:
+            return {"type": "attachment", "success": False, "message_id": message_id,
+                    "error": "File không tồn tại"}
+        return {
+            "type": "attachment",
+            "success": True,
+            "message_id": message_id,
+            "attachment": self.db._attachment_to_dict(msg),
+            "size": thumbnail_size,
+            "data": base64.b64encode(file_data).decode('utf-8'),
+        }
+    def _read_thumbnail(self, sha256: Optional[str], wanted_size) -> tuple:
+        """(kích thước, dữ liệu) của ảnh thu nhỏ phù hợp nhất; (None, None) nếu không có."""
+        if not sha256 or not wanted_size:
+            return None, None
+        try:
+            size = self.thumbnails.best_size(sha256, int(wanted_size))
+            if size:
+                return size, self.blobs.read_thumbnail(sha256, size)
+        except (ValueError, OSError) as e:
+            print(f"Error reading thumbnail {sha256}: {e}")
+        return None, None
+    def _handle_cancel_upload(self, message: dict, ctx: RequestContext) -> dict:
+        """Hủy một upload dở dang."""
+        user_id = ctx.user_id
+        self.uploads.abort(message.get('upload_id'), user_id)
+        return {"type": "upload_cancelled", "success": True, "upload_id": message.get('upload_id')}
     def _send_message_to_user(self, user_id: int, message_data: dict):
         """Gửi một gói tin đến một user cụ thể nếu họ online."""
-        if user_id in self.clients:
-            try:
-                self._send_message(self.clients[user_id], message_data)
-            except Exception as e:
-                print(f"Lỗi khi gửi tin đến user {user_id}: {e}")
-                self._handle_disconnect(user_id)
+        connection = self.clients.get(user_id)
+        if connection:
+            self._send_message(connection, message_data)
+    def _broadcast_to_users(self, user_ids, message_data) -> BroadcastStats:
+        """Gửi cùng một gói tin (mã hóa một lần) đến các user đang online trong danh sách."""
+        connections = []
+        seen = set()
+        for uid in user_ids:
+            connection = self.clients.get(uid)
+            if connection and uid not in seen:
+                seen.add(uid)
+                connections.append(connection)
+        return self.fanout.broadcast(message_data, connections)
+    def _broadcast_to_all(self, message_data, exclude_user_id: int = None) -> BroadcastStats:
+        """Gửi cùng một gói tin đến tất cả user đang online (trừ exclude_user_id)."""
+        connections = [connection for uid, connection in self.clients.copy().items() if uid != exclude_user_id]
+        return self.fanout.broadcast(message_data, connections)
 
-    def _handle_get_contacts(self, message: dict) -> dict:
+    def _handle_get_contacts(self, message: dict, ctx: RequestContext) -> dict:
         """Lấy danh sách liên hệ"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+        user_id = ctx.user_id
         online_users = self.db.get_online_users()
         all_users = self.db.get_all_users(exclude_user_id=user_id)
         return {
@@ -607,66 +933,125 @@ class ChatServer:
             "success": True,
             "online_users": online_users,
             "all_users": all_users}
-    def _handle_get_conversations(self, message: dict) -> dict:
+    def _handle_get_conversations(self, message: dict, ctx: RequestContext) -> dict:
         """Lấy danh sách hội thoại"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+        user_id = ctx.user_id
         conversations = self.db.get_conversations(user_id)
         return {
             "type": "get_conversations", # THÊM DÒNG NÀY
             "success": True,
             "conversations": conversations}
-    def _handle_get_messages(self, message: dict) -> dict:
-        """Lấy tin nhắn (ĐÃ SỬA LỖI LOGIC)."""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+    def _handle_sync(self, message: dict, ctx: RequestContext) -> dict:
+        """
+        Client kết nối lại (session cũ): gửi các tin nhắn, tin bị xóa, thay đổi
+        nhóm và hội thoại bị bỏ lỡ so với các mốc client gửi lên, thay vì tải lại
+        toàn bộ danh sách hội thoại và lịch sử.
 
-        # --- LOGIC SỬA LỖI NẰM Ở ĐÂY ---
+        ``conversations``: {"group:<id>" | "user:<id>": id tin nhắn mới nhất client có},
+        ``change_id``: mốc thay đổi nhận được lần trước, ``last_message_id``:
+        id tin nhắn lớn nhất client đã thấy.
+        """
+        marks = message.get('conversations') or {}
+        try:
+            if not isinstance(marks, dict):
+                raise ValueError("conversations")
+            parsed = {}
+            for key, last_id in marks.items():
+                kind, _, target = str(key).partition(':')
+                if kind not in ('group', 'user'):
+                    raise ValueError(key)
+                parsed[f"{kind}:{int(target)}"] = int(last_id)
+            change_id = message.get('change_id')
+            change_id = int(change_id) if change_id is not None else None
+            last_message_id = message.get('last_message_id')
+            last_message_id = int(last_message_id) if last_message_id is not None else None
+        except (TypeError, ValueError):
+            return {"type": "sync", "success": False, "error": "Invalid sync marks"}
+        delta = self.db.get_sync_delta(ctx.user_id, parsed, change_id, last_message_id)
+        return dict(delta, type="sync", success=True, user_id=ctx.user_id)
+    def _handle_get_messages(self, message: dict, ctx: RequestContext) -> dict:
+        """
+        Lấy một trang lịch sử chat theo con trỏ ``before_id`` / ``after_id`` /
+        ``around_id`` (không có con trỏ: trang mới nhất).
+        """
+        user_id = ctx.user_id
         other_username = message.get('other_user')
         group_id = message.get('group_id') # Lấy group_id từ message của client
-        limit = message.get('limit', 50)
-        offset = message.get('offset', 0)
+        cursors = {}
+        try:
+            limit = int(message.get('limit') or MESSAGE_PAGE_SIZE)
+            for key in ('before_id', 'after_id', 'around_id'):
+                if message.get(key) is not None:
+                    cursors[key] = int(message[key])
+        except (TypeError, ValueError):
+            return {"type": "get_messages", "success": False, "error": "Invalid pagination cursor"}
+        if len(cursors) > 1:
+            return {"type": "get_messages", "success": False,
+                    "error": "Only one of before_id, after_id, around_id is allowed"}
 
-        messages = []
-        
+        page = None
         if group_id:
             # Ưu tiên xử lý tin nhắn nhóm nếu có group_id
-            print(f"Server handling get_messages for GROUP ID: {group_id}")
-            messages = self.db.get_messages(user_id=user_id, group_id=group_id, limit=limit, offset=offset)
+            page = self.db.get_message_page(user_id=user_id, group_id=group_id, limit=limit, **cursors)
         elif other_username:
-            # Xử lý tin nhắn riêng tư nếu không có group_id
-            print(f"Server handling get_messages for PRIVATE chat with: {other_username}")
             other_user = self.db.get_user_by_username(other_username)
             if other_user:
-                messages = self.db.get_messages(user_id=user_id, other_user_id=other_user.id, limit=limit, offset=offset)
-        
-        return {
+                page = self.db.get_message_page(user_id=user_id, other_user_id=other_user.id, limit=limit, **cursors)
+
+        response = {
             "type": "get_messages",
             "success": True,
-            "messages": messages
+            "group_id": group_id,
+            "other_user": other_username,
+            "messages": [],
+            "has_more": False,
         }
-    def _handle_mark_read(self, message: dict) -> dict:
-        """Đánh dấu tin nhắn đã đọc"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+        response.update(cursors)
+        if page:
+            response.update(page)
+        return response
+    def _handle_mark_read(self, message: dict, ctx: RequestContext) -> dict:
+        """
+        Đánh dấu đã đọc chat riêng (``sender``) hoặc nhóm (``group_id``) đến
+        ``message_id`` (mặc định: tin nhắn mới nhất). Khi vị trí đã đọc tiến lên,
+        những người còn lại của hội thoại nhận gói tin ``read_receipt`` gọn
+        (người đọc và id tin nhắn đã đọc đến) thay vì danh sách tin nhắn.
+        """
+        user_id = ctx.user_id
+        try:
+            group_id = int(message['group_id']) if message.get('group_id') is not None else None
+            message_id = int(message['message_id']) if message.get('message_id') is not None else None
+        except (TypeError, ValueError):
+            return {"success": False, "error": "Invalid message_id"}
+        if group_id:
+            member_ids = self.db.get_group_member_ids(group_id)
+            if user_id not in member_ids:
+                return {"success": False, "error": "Not a group member"}
+            last_read = self.db.mark_conversation_read(user_id, group_id=group_id, message_id=message_id)
+            if last_read:
+                self._broadcast_to_users([member_id for member_id in member_ids if member_id != user_id], {
+                    "type": "read_receipt",
+                    "group_id": group_id,
+                    "reader_id": user_id,
+                    "last_read_message_id": last_read
+                })
+            return {"success": True, "message": "Messages marked as read"}
         sender_username = message.get('sender')
         sender = self.db.get_user_by_username(sender_username)
         if sender:
-            self.db.mark_messages_as_read(user_id, sender.id)
+            last_read = self.db.mark_conversation_read(user_id, other_user_id=sender.id, message_id=message_id)
+            if last_read and sender.id in self.clients:
+                self._send_message(self.clients[sender.id], {
+                    "type": "read_receipt",
+                    "other_user_id": user_id,
+                    "reader_id": user_id,
+                    "last_read_message_id": last_read
+                })
             return {"success": True, "message": "Messages marked as read"}
         return {"success": False, "error": "Sender not found"}
-    def _handle_typing_start(self, message: dict) -> dict:
+    def _handle_typing_start(self, message: dict, ctx: RequestContext) -> dict:
         """Xử lý bắt đầu gõ"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+        user_id = ctx.user_id
         other_username = message.get('other_user')
         is_group = message.get('is_group', False)
         # Update typing status
@@ -677,29 +1062,24 @@ class ChatServer:
         # Notify other users
         if is_group:
             # Broadcast typing status to all online users
-            for uid, client_socket in self.clients.items():
-                if uid != user_id:
-                    self._send_message(client_socket, {
-                        "type": "typing_status",
-                        "user": self.db._user_to_dict(self.db.get_user_by_id(user_id)),
-                        "is_typing": True,
-                        "is_group": True})
+            self._broadcast_to_all({
+                "type": "typing_status",
+                "user": self.db.get_user_profile(user_id),
+                "is_typing": True,
+                "is_group": True}, exclude_user_id=user_id)
         else:
             # Send to specific user
             other_user = self.db.get_user_by_username(other_username)
             if other_user and other_user.id in self.clients:
                 self._send_message(self.clients[other_user.id], {
                     "type": "typing_status",
-                    "user": self.db._user_to_dict(self.db.get_user_by_id(user_id)),
+                    "user": self.db.get_user_profile(user_id),
                     "is_typing": True,
                     "is_group": False}) 
         return {"success": True}
-    def _handle_typing_stop(self, message: dict) -> dict:
+    def _handle_typing_stop(self, message: dict, ctx: RequestContext) -> dict:
         """Xử lý dừng gõ"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)       
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}       
+        user_id = ctx.user_id
         other_username = message.get('other_user')
         is_group = message.get('is_group', False)        
         # Remove typing status
@@ -710,66 +1090,63 @@ class ChatServer:
         # Notify other users
         if is_group:
             # Broadcast typing status to all online users
-            for uid, client_socket in self.clients.items():
-                if uid != user_id:
-                    self._send_message(client_socket, {"type": "typing_status",
-                        "user": self.db._user_to_dict(self.db.get_user_by_id(user_id)),
-                        "is_typing": False,
-                        "is_group": True})
+            self._broadcast_to_all({
+                "type": "typing_status",
+                "user": self.db.get_user_profile(user_id),
+                "is_typing": False,
+                "is_group": True}, exclude_user_id=user_id)
         else:
             # Send to specific user
             other_user = self.db.get_user_by_username(other_username)
             if other_user and other_user.id in self.clients:
                 self._send_message(self.clients[other_user.id], {
                     "type": "typing_status",
-                    "user": self.db._user_to_dict(self.db.get_user_by_id(user_id)),
+                    "user": self.db.get_user_profile(user_id),
                     "is_typing": False,
                     "is_group": False})
         return {"success": True}
-    def _handle_update_status(self, message: dict) -> dict:
+    def _handle_update_status(self, message: dict, ctx: RequestContext) -> dict:
         """Cập nhật trạng thái user"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+        user_id = ctx.user_id
         status = message.get('status', 'online')
         status_message = message.get('status_message')
         self.db.update_user_status(user_id, status, status_message)
         # Broadcast status change
         self._broadcast_user_status(user_id, status)
         return {"success": True, "message": "Status updated"}
-    def _handle_search_messages(self, message: dict) -> dict:
-        """Tìm kiếm tin nhắn và trả về với type 'search_results'."""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+    def _handle_search_messages(self, message: dict, ctx: RequestContext) -> dict:
+        """
+        Tìm kiếm tin nhắn và trả về với type 'search_results'.
+        Gửi lại ``next_cursor`` trong ``cursor`` để lấy trang kết quả tiếp theo.
+        """
+        user_id = ctx.user_id
         query = message.get('query', '')
-        limit = message.get('limit', 20)
-        messages = self.db.search_messages(user_id, query, limit)
-        return {
+        cursor = message.get('cursor')
+        try:
+            limit = int(message.get('limit') or SEARCH_PAGE_SIZE)
+            page = self.db.search_message_page(user_id, query, limit, cursor)
+        except (TypeError, ValueError):
+            return {"type": "search_results", "success": False, "error": "Invalid search cursor"}
+        response = {
+            "type": "search_results",
             "success": True,
-            "messages": messages,
-            "query": query # Trả lại cả query để hiển thị trên dialog
+            "query": query, # Trả lại cả query để hiển thị trên dialog
+            "cursor": cursor,
         }
-    def _handle_delete_message(self, message: dict) -> dict:
+        response.update(page)
+        return response
+    def _handle_delete_message(self, message: dict, ctx: RequestContext) -> dict:
         """Xóa tin nhắn"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+        user_id = ctx.user_id
         message_id = message.get('message_id')
         if self.db.delete_message(message_id, user_id):
             # Notify other users about message deletion
             self._broadcast_message_deleted(message_id, user_id)
             return {"success": True, "message": "Message deleted"}
         return {"success": False, "error": "Failed to delete message"}
-    def _handle_clear_chat(self, message: dict) -> dict:
+    def _handle_clear_chat(self, message: dict, ctx: RequestContext) -> dict:
         """Xóa toàn bộ chat"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}
+        user_id = ctx.user_id
         other_username = message.get('other_user')
         other_user = self.db.get_user_by_username(other_username)
         if other_user:
@@ -785,12 +1162,25 @@ class ChatServer:
             else:
                 return {"success": False, "error": "Lỗi khi xóa dữ liệu trên server"}
         return {"success": False, "error": "User not found"}
-    def _handle_upload_avatar(self, message: dict) -> dict:
+    def _handle_pin_conversation(self, message: dict, ctx: RequestContext) -> dict:
+        """Ghim/bỏ ghim hội thoại (chat riêng với ``other_user`` hoặc nhóm ``group_id``)"""
+        pinned = bool(message.get('pinned', True))
+        group_id = message.get('group_id')
+        if group_id:
+            if not isinstance(group_id, int):
+                return {"success": False, "error": "Invalid group_id"}
+            target = {"group_id": group_id}
+        else:
+            other_user = self.db.get_user_by_username(message.get('other_user'))
+            if not other_user:
+                return {"success": False, "error": "User not found"}
+            target = {"other_user_id": other_user.id}
+        if not self.db.set_conversation_pinned(ctx.user_id, pinned, **target):
+            return {"success": False, "error": "Conversation not found"}
+        return dict(target, type="conversation_pinned", success=True, pinned=pinned)
+    def _handle_upload_avatar(self, message: dict, ctx: RequestContext) -> dict:
         """Upload avatar"""
-        session_token = message.get('session_token')
-        user_id = self.sessions.get(session_token)  
-        if not user_id:
-            return {"success": False, "error": "Invalid session"}    
+        user_id = ctx.user_id
         avatar_data_b64 = message.get('avatar_data')     
         try:
             avatar_data = base64.b64decode(avatar_data_b64)           
@@ -798,23 +1188,69 @@ class ChatServer:
             if len(avatar_data) > 1024 * 1024:
                 return {"success": False, "error": "Avatar too large (max 1MB)"}           
             self.db.update_user_avatar(user_id, avatar_data)            
+            user = self.db.get_user_by_id(user_id)
+            if user and user.avatar_hash:
+                self.thumbnails.submit(user.avatar_hash)
             # Broadcast avatar update
-            self._broadcast_user_status(user_id, None)  # Will include new avatar          
-            return {"success": True, "message": "Avatar updated"}           
+            self._broadcast_user_status(user_id, None, avatar_changed=True)  # Will include new avatar_hash          
+            return {"success": True, "message": "Avatar updated",
+                    "avatar_hash": user.avatar_hash if user else None}           
         except Exception as e:
             return {"success": False, "error": f"Upload failed: {str(e)}"}    
-    def _handle_disconnect(self, user_id: int):
+    def _handle_get_avatar(self, message: dict, ctx: RequestContext) -> dict:
+        """
+        Trả về avatar của một user.
+
+        Client gửi kèm ``avatar_hash`` đang có trong cache; nếu trùng với hash
+        hiện tại thì chỉ trả về ``not_modified`` mà không gửi lại dữ liệu.
+        """
+        target_id = message.get('user_id')
+        known_hash = message.get('avatar_hash')
+        user = self.db.get_user_by_id(target_id)
+        if user and known_hash and user.avatar_hash == known_hash:
+            return {"type": "avatar", "success": True, "user_id": target_id,
+                    "avatar_hash": known_hash, "not_modified": True}
+        thumbnail_size, avatar_data = self._read_thumbnail(user.avatar_hash if user else None,
+                                                           message.get('size'))
+        if avatar_data is not None:
+            avatar_hash = user.avatar_hash
+        else:
+            avatar_hash, avatar_data = self.db.get_user_avatar(target_id)
+        if avatar_data is None:
+            return {"type": "avatar", "success": False, "user_id": target_id,
+                    "error": "Avatar không tồn tại"}
+        if known_hash == avatar_hash:
+            return {"type": "avatar", "success": True, "user_id": target_id,
+                    "avatar_hash": avatar_hash, "not_modified": True}
+        return {
+            "type": "avatar",
+            "success": True,
+            "user_id": target_id,
+            "avatar_hash": avatar_hash,
+            "not_modified": False,
+            "size": thumbnail_size,
+            "data": base64.b64encode(avatar_data).decode('utf-8'),
+        }
+    def _handle_disconnect(self, user_id: int, connection: ClientConnection = None):
         """Xử lý khi user disconnect"""
-        # Set user offline
-        self.db.update_user_status(user_id, "offline")        
-        # Remove from clients
-        if user_id in self.clients:
-            del self.clients[user_id]        
-        # Remove from typing status
-        if user_id in self.typing_status:
-            del self.typing_status[user_id]        
-        # Broadcast offline status
-        self._broadcast_user_status(user_id, "offline")
+        try:
+            if connection is not None and self.clients.get(user_id) not in (None, connection):
+                # User đã kết nối lại bằng kết nối khác (sync) trước khi kết nối cũ đóng hẳn
+                return
+            # Set user offline
+            self.db.update_user_status(user_id, "offline")        
+            # Remove from clients
+            if user_id in self.clients:
+                del self.clients[user_id]        
+            # Remove from typing status
+            if user_id in self.typing_status:
+                del self.typing_status[user_id]        
+            # Giữ upload dở dang trên đĩa để client tiếp tục sau khi kết nối lại
+            self.uploads.suspend_user(user_id)
+            # Broadcast offline status
+            self._broadcast_user_status(user_id, "offline")
+        finally:
+            self.db.remove_session()
     def _broadcast_message(self, message, exclude_user_id: int = None):
         """Broadcast tin nhắn đến các client phù hợp."""
         # Chỉ broadcast tin nhắn nhóm (group_id không NULL)
@@ -825,30 +1261,20 @@ class ChatServer:
             "message": self.db._message_to_dict(message)
         }        
         print(f"Broadcasting group message id {message.id} from user {message.sender_id}")
-        for user_id, client_socket in self.clients.copy().items():
-            if user_id != exclude_user_id:
-                try:
-                    self._send_message(client_socket, message_data)
-                except Exception as e:
-                    print(f"Error broadcasting to user {user_id}, removing. Error: {e}")
-                    self._handle_disconnect(user_id) # Xử lý disconnect nếu không gửi được    
-    def _broadcast_user_status(self, user_id: int, status: str = None):
+        self._broadcast_to_all(message_data, exclude_user_id=exclude_user_id)
+    def _broadcast_user_status(self, user_id: int, status: str = None, avatar_changed: bool = False):
         """Broadcast trạng thái user"""
-        user = self.db.get_user_by_id(user_id)
-        if not user:
+        profile = self.db.get_user_profile(user_id)
+        if not profile:
             return       
         status_data = {
             "type": "user_status",
-            "user": self.db._user_to_dict(user)
+            "user": profile
         }       
-        for uid, client_socket in self.clients.copy().items():
-            if uid != user_id:
-                try:
-                    self._send_message(client_socket, status_data)
-                except:
-                    # Remove disconnected client
-                    if uid in self.clients:
-                        del self.clients[uid]    
+        if avatar_changed:
+            # Không được bỏ qua với client nhận chậm như gói tin presence (xem is_droppable)
+            status_data["avatar_hash"] = profile.get("avatar_hash")
+        self._broadcast_to_all(status_data, exclude_user_id=user_id)
     def _broadcast_message_deleted(self, message_id: int, user_id: int):
         """Broadcast tin nhắn bị xóa"""
         delete_data = {
@@ -856,34 +1282,49 @@ class ChatServer:
             "message_id": message_id,
             "deleted_by": user_id
         }       
-        for uid, client_socket in self.clients.copy().items():
-            try:
-                self._send_message(client_socket, delete_data)
-            except:
-                # Remove disconnected client
-                if uid in self.clients:
-                    del self.clients[uid]   
-    def _send_message(self, client_socket: socket.socket, message: dict):
-        """Gửi tin nhắn đến client và in ra để gỡ lỗi."""
-        try:
-            # In ra gói tin đầy đủ trước khi gửi
-            print(f"DEBUG SERVER SEND -> TO {client_socket.getpeername()}: {json.dumps(message)}")
-            
-            data = json.dumps(message, ensure_ascii=False).encode('utf-8')
-            client_socket.send(data)
-        except Exception as e:
-            print(f"❌ Lỗi khi gửi tin nhắn: {e}")
-            raise
-    def _send_error(self, client_socket: socket.socket, error_message: str):
+        self._broadcast_to_all(delete_data)
+    def _send_message(self, connection: ClientConnection, message: dict) -> bool:
+        """Mã hóa gói tin và đưa vào hàng đợi gửi của kết nối."""
+        encoded = message if isinstance(message, EncodedMessage) else EncodedMessage(message)
+        return connection.send(encoded.data_for(connection), droppable=encoded.droppable)
+    def get_outbound_stats(self) -> Dict[str, int]:
+        """Tổng hợp bộ đếm hàng đợi gửi của các client đang online."""
+        totals: Dict[str, int] = {"connections": 0}
+        for connection in list(self.clients.values()):
+            totals["connections"] += 1
+            for key, value in connection.stats().items():
+                if key == "peak_queued_bytes":
+                    totals[key] = max(totals.get(key, 0), value)
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+    def _send_error(self, connection: ClientConnection, error_message: str):
         """Gửi thông báo lỗi đến client"""
         error_data = {"success": False, "error": error_message}
-        self._send_message(client_socket, error_data)    
+        self._send_message(connection, error_data)    
     def _cleanup_thread(self):
         """Thread cleanup định kỳ"""
         while self.running:
             try:
                 # Cleanup expired sessions
                 self.db.cleanup_expired_sessions()                
+                pruned = self.db.prune_sync_changes()
+                if pruned:
+                    print(f"🧹 Đã dọn {pruned} thay đổi cũ của sync")
+                self.db.remove_session()
+                # Hủy upload dở dang đã quá thời gian chờ tiếp tục
+                for upload_id in self.uploads.cleanup_expired():
+                    print(f"🗑️ Upload {upload_id} hết hạn")
+                outbound = self.get_outbound_stats()
+                if outbound.get("dropped_frames") or outbound.get("congested"):
+                    print(f"📤 Outbound queues: {outbound}")
+                if self.log_stats:
+                    print(f"📡 Fan-out stats: {self.fanout.stats()}")
+                    print(f"⏱️ Handler stats: {self.get_handler_stats()}")
+                    print(f"🗄️ Database pool: {self.db.pool_stats()}")
+                    print(f"💬 Message cache: {self.db.message_cache.stats()}")
+                    print(f"👥 User directory: {self.db.users.stats()}")
+                    print(f"📝 Ingest stats: {self.ingestor.stats()}")
                 # Cleanup old typing status
                 current_time = time.time()
                 for user_id in list(self.typing_status.keys()):
@@ -0,0 +1,176 @@
+import io
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Sequence
+
+from .blob_store import BlobStore
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow là tùy chọn; không có thì client dùng ảnh gốc
+    Image = None
+
+THUMBNAIL_SIZES = (64, 256, 1024)
+THUMBNAIL_MIME = "image/jpeg"
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp')
+# Ảnh lớn hơn (tính theo số pixel) không được giải mã: ảnh giải nén cỡ vài GB làm process con hết bộ nhớ
+MAX_IMAGE_PIXELS = 50_000_000
+
+
+def render_thumbnails(source_path: str, sizes: Sequence[int], quality: int = 80,
+                      max_pixels: int = MAX_IMAGE_PIXELS) -> Dict[int, bytes]:
+    """
+    Tạo ảnh thu nhỏ JPEG cho từng kích thước nhỏ hơn ảnh gốc.
+
+    Chạy trong process con của ThumbnailService nên chỉ nhận đường dẫn blob,
+    không nhận nội dung ảnh. Ảnh quá ``max_pixels`` pixel bị từ chối trước khi giải mã.
+    """
+    results: Dict[int, bytes] = {}
+    with Image.open(source_path) as image:
+        # Image.open chỉ đọc header: kiểm tra kích thước trước khi giải mã
+        width, height = image.size
+        if width * height > max_pixels:
+            raise ValueError(f"Ảnh quá lớn ({width}x{height} pixel, tối đa {max_pixels})")
+        image.seek(0)  # GIF động: lấy khung đầu tiên
+        if image.mode not in ('RGB', 'L'):
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.split()[-1])
+        else:
+            image.load()
+        longest = max(image.size)
+        # Từ lớn đến nhỏ để mỗi lần thu nhỏ xuất phát từ ảnh đã nhỏ hơn
+        for size in sorted(sizes, reverse=True):
+            if size >= longest:
+                continue
+            image.thumbnail((size, size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=quality, optimize=True)
+            results[size] = buffer.getvalue()
+    return results
+
+
+class ThumbnailService:
+    """
+    Tạo ảnh thu nhỏ cho file ảnh và avatar trong một process pool.
+
+    Giải mã/thu nhỏ ảnh tốn CPU và giữ GIL, nên được đẩy sang process riêng để
+    thread xử lý request không bị chặn. Ảnh thu nhỏ được lưu cạnh blob gốc
+    (``<hash>.<size>.jpg``) nên file trùng nội dung chỉ được xử lý một lần.
+    """
+
+    def __init__(self, blob_store: BlobStore, sizes: Sequence[int] = THUMBNAIL_SIZES,
+                 max_workers: int = 2):
+        self.blobs = blob_store
+        self.sizes = tuple(sorted(sizes))
+        self.max_workers = max_workers
+        self.enabled = Image is not None and max_workers > 0 and bool(self.sizes)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # RLock: _store có thể được gọi ngay trong submit nếu job xong quá nhanh
+        self._lock = threading.RLock()
+        # Blob đang được xử lý: {sha256: Future}
+        self._pending: Dict[str, Future] = {}
+        if Image is None and max_workers > 0:
+            print("⚠️ Chưa cài Pillow, không tạo ảnh thu nhỏ (pip install Pillow)")
+
+    @staticmethod
+    def is_image(file_name: Optional[str]) -> bool:
+        ext = file_name.lower().rsplit('.', 1)[-1] if file_name and '.' in file_name else ''
+        return ext in IMAGE_EXTENSIONS
+
+    def is_pending(self, sha256: str) -> bool:
+        return sha256 in self._pending
+
+    def available_sizes(self, sha256: Optional[str]) -> List[int]:
+        if not sha256:
+            return []
+        return self.blobs.thumbnail_sizes(sha256, self.sizes)
+
+    def best_size(self, sha256: Optional[str], wanted: int) -> Optional[int]:
+        """Ảnh thu nhỏ nhỏ nhất không nhỏ hơn ``wanted`` (hoặc lớn nhất hiện có)."""
+        sizes = self.available_sizes(sha256)
+        if not sizes:
+            return None
+        for size in sizes:
+            if size >= wanted:
+                return size
+        return sizes[-1]
+
+    def submit(self, sha256: str) -> bool:
+        """
+        Bắt đầu tạo ảnh thu nhỏ cho blob ``sha256`` trong nền.
+
+        Trả về True nếu đang có job cho blob này (vừa tạo hoặc đã có từ trước),
+        False nếu không cần tạo (đã có ảnh thu nhỏ hoặc service bị tắt).
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            if sha256 in self._pending:
+                return True
+            if self.available_sizes(sha256):
+                return False
+            try:
+                try:
+                    executor, future = self._submit_render(sha256)
+                except BrokenProcessPool:
+                    # Process con đã chết từ trước mà chưa job nào báo lỗi: tạo pool mới
+                    self._discard_executor(self._executor)
+                    executor, future = self._submit_render(sha256)
+            except Exception as e:
+                # Không có ảnh thu nhỏ thì client dùng ảnh gốc; không làm hỏng upload
+                print(f"⚠️ Không khởi động được job ảnh thu nhỏ: {e}")
+                return False
+            self._pending[sha256] = future
+            future.add_done_callback(lambda f: self._store(sha256, f, executor))
+        return True
+
+    def _submit_render(self, sha256: str):
+        if self._executor is None:
+            # spawn: process con không thừa hưởng socket/kết nối database của server
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        executor = self._executor
+        return executor, executor.submit(render_thumbnails, self.blobs.path_for(sha256), self.sizes)
+
+    def when_done(self, sha256: str, callback: Callable[[List[int]], None]):
+        """
+        Gọi ``callback(sizes)`` khi job của blob xong (từ thread của pool), hoặc
+        ngay lập tức nếu không có job nào đang chạy.
+        """
+        future = self._pending.get(sha256)
+        if future is None:
+            callback(self.available_sizes(sha256))
+            return
+        # Chạy sau _store (callback được gọi theo thứ tự đăng ký) nên ảnh đã nằm trên đĩa
+        future.add_done_callback(lambda f: callback(self.available_sizes(sha256)))
+
+    def _store(self, sha256: str, future: Future, executor: ProcessPoolExecutor):
+        try:
+            for size, data in future.result().items():
+                self.blobs.put_thumbnail(sha256, size, data)
+        except BrokenProcessPool as e:
+            # Một process con chết (hết bộ nhớ, Pillow crash): pool không dùng lại được nữa,
+            # bỏ đi để lần upload sau tạo pool mới
+            print(f"⚠️ Process tạo ảnh thu nhỏ bị dừng đột ngột ({sha256[:12]}), tạo lại pool: {e}")
+            self._discard_executor(executor)
+        except Exception as e:
+            print(f"⚠️ Không tạo được ảnh thu nhỏ cho {sha256[:12]}: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(sha256, None)
+
+    def _discard_executor(self, executor: Optional[ProcessPoolExecutor]):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        if executor:
+            executor.shutdown(wait=False)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False)
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+_SHA256_HEX = re.compile(r'^[0-9a-f]{64}$')
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """Upload không hợp lệ; thông báo lỗi được gửi lại cho client."""
+
+
+class UploadSession:
+    """
+    Trạng thái của một upload đang diễn ra.
+
+    Dữ liệu được ghi thẳng xuống ``<upload_id>.part``; thông tin của upload
+    được lưu kèm trong ``<upload_id>.json`` để có thể tiếp tục sau khi client
+    mất kết nối hoặc server khởi động lại.
+    """
+
+    def __init__(self, upload_id: str, user_id: int, file_name: str, file_size: int, sha256: str,
+                 path: str, receiver_id: Optional[int] = None, group_id: Optional[int] = None,
+                 created_at: Optional[float] = None):
+        self.upload_id = upload_id
+        self.user_id = user_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.sha256 = sha256
+        self.path = path
+        self.receiver_id = receiver_id
+        self.group_id = group_id
+        self.received = 0
+        self.created_at = created_at or time.time()
+        self.last_activity = time.time()
+        self.lock = threading.Lock()
+        self._hasher = hashlib.sha256()
+        self._file = None
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.splitext(self.path)[0] + '.json'
+
+    def open(self):
+        """Mở file tạm; nếu đã có dữ liệu từ trước thì hash lại để tiếp tục."""
+        with self.lock:
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        self._hasher.update(block)
+                        self.received += len(block)
+            self._file = open(self.path, 'ab')
+
+    def save_meta(self):
+        meta = {
+            "upload_id": self.upload_id,
+            "user_id": self.user_id,
+            "file_name": self.file_name,
+            "file_size": self.file_size,
+            "sha256": self.sha256,
+            "receiver_id": self.receiver_id,
+            "group_id": self.group_id,
+            "created_at": self.created_at,
+        }
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, self.meta_path)
+
+    def write(self, offset: int, data) -> int:
+        with self.lock:
+            if self._file is None:
+                raise UploadError("Upload đã kết thúc")
+            if offset != self.received:
+                raise UploadError(f"Chunk sai thứ tự: offset {offset}, đã nhận {self.received}")
+            if self.received + len(data) > self.file_size:
+                raise UploadError("Dữ liệu vượt quá kích thước đã khai báo")
+            self._file.write(data)
+            self._hasher.update(data)
+            self.received += len(data)
+            self.last_activity = time.time()
+            return self.received
+
+    def flush(self):
+        """Ghi dữ liệu đang đệm xuống đĩa để offset báo cho client là chính xác."""
+        with self.lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def finish(self):
+        """Đóng file và kiểm tra kích thước, hash."""
+        with self.lock:
+            if self._file is None:
+                raise UploadError("Upload đã kết thúc")
+            self._file.close()
+            self._file = None
+            if self.received != self.file_size:
+                raise UploadError(f"Upload chưa đủ dữ liệu: {self.received}/{self.file_size} bytes")
+            if self._hasher.hexdigest() != self.sha256:
+                raise UploadError("Hash SHA-256 không khớp")
+
+    def discard(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        for path in (self.path, self.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class UploadManager:
+    """
+    Quản lý các phiên upload theo chunk.
+
+    Kích thước được kiểm tra ngay ở ``begin()``, dữ liệu được ghi xuống đĩa theo
+    từng chunk nên bộ nhớ dùng cho mỗi upload không phụ thuộc kích thước file.
+    Upload dở dang được giữ trên đĩa đến khi hết ``resume_ttl`` giây không có
+    dữ liệu mới, kể cả qua các lần khởi động lại server.
+    """
+
+    def __init__(self, upload_dir: str = "uploads", max_file_size: int = 10 * 1024 * 1024,
+                 max_active_per_user: int = 4, resume_ttl: float = 3600):
+        self.upload_dir = os.path.abspath(upload_dir)
+        self.max_file_size = max_file_size
+        self.max_active_per_user = max_active_per_user
+        self.resume_ttl = resume_ttl
+        self._sessions: Dict[str, UploadSession] = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self._load_pending()
+
+    def _load_pending(self):
+        """Nạp lại các upload dở dang còn trên đĩa."""
+        now = time.time()
+        for entry in os.listdir(self.upload_dir):
+            if not entry.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.upload_dir, entry)
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                upload_id = meta["upload_id"]
+                if not _UPLOAD_ID.match(upload_id):
+                    raise ValueError(f"upload_id không hợp lệ: {upload_id!r}")
+                session = UploadSession(
+                    upload_id, meta["user_id"], meta["file_name"], meta["file_size"], meta["sha256"],
+                    os.path.join(self.upload_dir, f"{upload_id}.part"),
+                    receiver_id=meta.get("receiver_id"), group_id=meta.get("group_id"),
+                    created_at=meta.get("created_at"))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"⚠️ Bỏ qua upload hỏng {entry}: {e}")
+                continue
+            part_mtime = os.path.getmtime(session.path) if os.path.exists(session.path) else session.created_at
+            if now - part_mtime > self.resume_ttl:
+                session.discard()
+                continue
+            session.open()
+            self._sessions[upload_id] = session
+        if self._sessions:
+            print(f"📂 Nạp lại {len(self._sessions)} upload dở dang")
+
+    def begin(self, user_id: int, file_name: str, file_size: int, sha256: str,
+              receiver_id: Optional[int] = None, group_id: Optional[int] = None) -> UploadSession:
+        file_name = os.path.basename(file_name or "").strip()
+        if not file_name:
+            raise UploadError("Tên file không hợp lệ")
+        if not isinstance(file_size, int) or file_size <= 0:
+            raise UploadError("Kích thước file không hợp lệ")
+        if file_size > self.max_file_size:
+            raise UploadError(f"File quá lớn (tối đa {self.max_file_size // (1024 * 1024)}MB)")
+        sha256 = (sha256 or "").lower()
+        if not _SHA256_HEX.match(sha256):
+            raise UploadError("Hash SHA-256 không hợp lệ")
+        if not receiver_id and not group_id:
+            raise UploadError("Thiếu người nhận hoặc nhóm")
+        with self._lock:
+            active = sum(1 for s in self._sessions.values() if s.user_id == user_id)
+            if active >= self.max_active_per_user:
+                raise UploadError(f"Đã đạt giới hạn {self.max_active_per_user} upload đồng thời")
+            upload_id = uuid.uuid4().hex
+            path = os.path.join(self.upload_dir, f"{upload_id}.part")
+            session = UploadSession(upload_id, user_id, file_name, file_size, sha256, path,
+                                    receiver_id=receiver_id, group_id=group_id)
+            session.save_meta()
+            session.open()
+            self._sessions[upload_id] = session
+        return session
+
+    def get(self, upload_id: str, user_id: int) -> UploadSession:
+        with self._lock:
+            session = self._sessions.get(upload_id)
+        if not session or session.user_id != user_id:
+            raise UploadError("Upload không tồn tại")
+        return session
+
+    def resume(self, upload_id: str, user_id: int) -> UploadSession:
+        """Lấy upload dở dang để client gửi tiếp từ ``session.received``."""
+        session = self.get(upload_id, user_id)
+        session.flush()
+        session.last_activity = time.time()
+        return session
+
+    def write_chunk(self, upload_id: str, user_id: int, offset: int, data) -> int:
+        """Ghi một chunk; trả về tổng số byte đã nhận."""
+        return self.get(upload_id, user_id).write(offset, data)
+
+    def commit(self, upload_id: str, user_id: int) -> UploadSession:
+        """
+        Hoàn tất upload. Phiên được gỡ khỏi danh sách; người gọi chịu trách
+        nhiệm gọi ``discard()`` sau khi đã dùng xong file tạm.
+        """
+        session = self.get(upload_id, user_id)
+        with self._lock:
+            self._sessions.pop(upload_id, None)
+        try:
+            session.finish()
+        except UploadError:
+            session.discard()
+            raise
+        return session
+
+    def abort(self, upload_id: str, user_id: Optional[int] = None):
+        with self._lock:
+            session = self._sessions.get(upload_id)
+            if not session or (user_id is not None and session.user_id != user_id):
+                return
+            del self._sessions[upload_id]
+        session.discard()
+
+    def suspend_user(self, user_id: int):
+        """Ghi xuống đĩa các upload dở dang của user khi họ mất kết nối, để tiếp tục sau."""
+        with self._lock:
+            sessions = [s for s in self._sessions.values() if s.user_id == user_id]
+        for session in sessions:
+            session.flush()
+
+    def cleanup_expired(self, max_idle_seconds: Optional[float] = None) -> List[str]:
+        """Hủy các upload không nhận thêm dữ liệu trong ``max_idle_seconds`` giây (mặc định ``resume_ttl``)."""
+        if max_idle_seconds is None:
+            max_idle_seconds = self.resume_ttl
+        now = time.time()
+        with self._lock:
+            expired = [uid for uid, s in self._sessions.items() if now - s.last_activity > max_idle_seconds]
+        for upload_id in expired:
+            self.abort(upload_id)
+        return expired
@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+@dataclass(frozen=True)
+class DirectoryUser:
+    """
+    Ảnh chụp chỉ đọc một dòng ``users`` (không có cột avatar cũ), kèm
+    ``profile`` là dict đã tính sẵn như ``DatabaseManager._user_to_dict``.
+    ``profile`` được dùng chung cho mọi gói tin nên không được sửa.
+    """
+    id: int
+    username: str
+    display_name: Optional[str]
+    email: Optional[str]
+    status: Optional[str]
+    status_message: Optional[str]
+    is_online: bool
+    last_seen: Optional[datetime]
+    avatar_hash: Optional[str]
+    created_at: Optional[datetime]
+    profile: Dict[str, Any]
+
+
+class UserDirectory:
+    """
+    Danh bạ user trong bộ nhớ, tra theo id và theo username, để các handler
+    không phải truy vấn bảng ``users`` mỗi lần cần người gửi/người nhận.
+
+    DatabaseManager gọi :meth:`invalidate` sau khi commit mọi thay đổi của
+    user (trạng thái, avatar, hồ sơ); lần tra cứu sau đọc lại từ database.
+    Tránh lưu ảnh chụp cũ: trước khi đọc database, người đọc lấy phiên bản
+    bằng :meth:`reserve`; một lần invalidate bất kỳ trong lúc đọc làm
+    :meth:`fill` bỏ qua kết quả. Giữ tối đa ``max_users`` user, bỏ user lâu
+    không được tra cứu nhất (LRU); ``max_users`` = 0 để tắt.
+    """
+
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max(0, max_users)
+        self._lock = threading.Lock()
+        self._by_id: "OrderedDict[int, DirectoryUser]" = OrderedDict()
+        self._ids_by_username: Dict[str, int] = {}
+        self._version = 0
+        self._counters = {"hits": 0, "misses": 0, "fills": 0, "stale_fills": 0,
+                          "invalidations": 0, "evictions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_users > 0
+
+    def get(self, user_id: int) -> Optional[DirectoryUser]:
+        with self._lock:
+            return self._hit(self._by_id.get(user_id))
+
+    def get_by_username(self, username: str) -> Optional[DirectoryUser]:
+        with self._lock:
+            user_id = self._ids_by_username.get(username)
+            return self._hit(self._by_id.get(user_id) if user_id is not None else None)
+
+    def reserve(self) -> int:
+        """Phiên bản hiện tại, lấy trước khi đọc user từ database để đưa vào :meth:`fill`."""
+        with self._lock:
+            return self._version
+
+    def fill(self, token: int, user: DirectoryUser) -> bool:
+        """Lưu user đọc được sau :meth:`reserve`; bỏ qua nếu đã có invalidate kể từ lúc đó."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if token != self._version:
+                self._counters["stale_fills"] += 1
+                return False
+            self._drop(user.id)
+            self._by_id[user.id] = user
+            self._ids_by_username[user.username] = user.id
+            self._counters["fills"] += 1
+            while len(self._by_id) > self.max_users:
+                _, evicted = self._by_id.popitem(last=False)
+                self._ids_by_username.pop(evicted.username, None)
+                self._counters["evictions"] += 1
+            return True
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Bỏ một user (hoặc toàn bộ danh bạ nếu ``user_id`` là None) sau khi dữ liệu đã đổi."""
+        with self._lock:
+            self._version += 1
+            self._counters["invalidations"] += 1
+            if user_id is None:
+                self._by_id.clear()
+                self._ids_by_username.clear()
+            else:
+                self._drop(user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["users"] = len(self._by_id)
+            stats["max_users"] = self.max_users
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+    def _hit(self, user: Optional[DirectoryUser]) -> Optional[DirectoryUser]:
+        if user is None:
+            self._counters["misses"] += 1
+            return None
+        self._by_id.move_to_end(user.id)
+        self._counters["hits"] += 1
+        return user
+
+    def _drop(self, user_id: int):
+        user = self._by_id.pop(user_id, None)
+        if user is not None and self._ids_by_username.get(user.username) == user_id:
+            del self._ids_by_username[user.username]
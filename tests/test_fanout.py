@@ -0,0 +1,30 @@
+import socket
+
+import pytest
+
+from server.connection import ClientConnection
+from server.fanout import EncodedMessage
+
+PROFILE = {"id": 1, "username": "alice", "is_online": True, "avatar_hash": "ab" * 32}
+
+
+@pytest.fixture
+def congested():
+    local, remote = socket.socketpair()
+    connection = ClientConnection(local, ("127.0.0.1", 0))
+    connection.congested = True
+    yield connection
+    connection.close()
+    remote.close()
+
+
+@pytest.mark.parametrize("message, droppable", [
+    ({"type": "typing_status", "user": PROFILE, "is_typing": True}, True),
+    ({"type": "user_status", "user": PROFILE}, True),
+    ({"type": "user_status", "user": PROFILE, "avatar_hash": PROFILE["avatar_hash"]}, False),
+    ({"type": "new_message", "message": {"id": 1}}, False),
+])
+def test_only_transient_packets_are_dropped_when_congested(congested, message, droppable):
+    encoded = EncodedMessage(message)
+    assert encoded.droppable is droppable
+    assert congested.send(encoded.framed, droppable=encoded.droppable) is not droppable
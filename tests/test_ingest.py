@@ -0,0 +1,103 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy.exc import OperationalError
+
+from server.blob_store import BlobStore
+from server.database import DatabaseManager
+from server.ingest import MessageIngestor
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DatabaseManager(f"sqlite:///{tmp_path / 'chat.db'}", blob_store=BlobStore(str(tmp_path / "blobs")))
+    db.register_user("alice", "secret1")
+    db.register_user("bob", "secret1")
+    yield db
+    db.remove_session()
+
+
+@pytest.fixture
+def ingestor(db, tmp_path):
+    ingestor = MessageIngestor(db, str(tmp_path / "ingest.journal"), flush_interval_ms=10)
+    ingestor.start()
+    yield ingestor
+    ingestor.stop()
+
+
+def _users(db):
+    return db.get_user_by_username("alice"), db.get_user_by_username("bob")
+
+
+@pytest.mark.parametrize("content, message_type, client_message_id", [
+    (12345, "text", None),
+    ("x" * (MessageIngestor.MAX_CONTENT_LENGTH + 1), "text", None),
+    ("xin chào", "system", None),
+    ("xin chào", "text", "c" * 101),
+    ("xin chào", "text", 7),
+])
+def test_submit_rejects_invalid_message(db, ingestor, content, message_type, client_message_id):
+    alice, bob = _users(db)
+    assert MessageIngestor.validate(content, message_type, client_message_id)
+    with pytest.raises(ValueError):
+        ingestor.submit(alice, receiver=bob, content=content, message_type=message_type,
+                        client_message_id=client_message_id)
+    assert ingestor.stats()["submitted"] == 0
+
+
+def test_bad_row_is_dropped_without_blocking_later_messages(db, ingestor, monkeypatch):
+    alice, bob = _users(db)
+    # Dòng không ghi được vào database nhưng đã lọt qua kiểm tra
+    monkeypatch.setattr(MessageIngestor, "validate", classmethod(lambda cls, *args: None))
+    ingestor.submit(alice, receiver=bob, content=12345)
+    good = ingestor.submit(alice, receiver=bob, content="xin chào")
+    assert ingestor.wait_persisted(timeout=5)
+    stats = ingestor.stats()
+    assert (stats["persisted"], stats["rejected"]) == (1, 1)
+    assert db.existing_message_ids([good["id"]]) == {good["id"]}
+
+
+def test_replay_skips_bad_rows(db, tmp_path):
+    alice, bob = _users(db)
+    journal = tmp_path / "ingest.journal"
+    rows = [{"id": message_id, "sender_id": alice.id, "receiver_id": bob.id, "group_id": None, "content": content,
+             "message_type": "text", "reply_to_id": None, "client_message_id": None,
+             "timestamp": "2026-01-01T10:00:00", "is_read": False, "is_edited": False}
+            for message_id, content in ((1, 12345), (2, "xin chào"))]
+    journal.write_text("".join(json.dumps(row) + "\n" for row in rows))
+    ingestor = MessageIngestor(db, str(journal))
+    ingestor.start()
+    ingestor.stop()
+    assert db.existing_message_ids([1, 2]) == {2}
+    assert ingestor.stats()["replayed"] == 1
+
+
+def test_stop_keeps_unsaved_rows_in_journal(db, tmp_path, monkeypatch):
+    alice, bob = _users(db)
+    journal = tmp_path / "ingest.journal"
+    ingestor = MessageIngestor(db, str(journal), batch_size=1, flush_interval_ms=0)
+    monkeypatch.setattr(MessageIngestor, "RETRY_DELAY", 0.01)
+    insert_messages = db.insert_messages
+
+    def insert_failing_first(rows):
+        if rows[0]["id"] == 1:
+            raise OperationalError("INSERT", {}, Exception("connection lost"))
+        insert_messages(rows)
+    monkeypatch.setattr(db, "insert_messages", insert_failing_first)
+    ingestor.start()
+    ingestor.submit(alice, receiver=bob, content="chưa ghi được")
+    while ingestor.stats()["retries"] == 0:
+        time.sleep(0.01)
+    ingestor.submit(alice, receiver=bob, content="ghi được")
+    ingestor.stop()
+    # Lô sau ghi thành công không được cắt tin nhắn 1 khỏi journal
+    assert [json.loads(line)["id"] for line in journal.read_text().splitlines()][:1] == [1]
+    monkeypatch.setattr(db, "insert_messages", insert_messages)
+    ingestor = MessageIngestor(db, str(journal))
+    ingestor.start()
+    ingestor.stop()
+    assert db.existing_message_ids([1, 2]) == {1, 2}
@@ -0,0 +1,111 @@
+import inspect
+import socket
+
+import pytest
+
+pytest.importorskip("PyQt5")
+
+from client.socket_client import SocketClient
+from common.protocol import FrameDecoder, decode_json
+
+# Phương thức public gửi yêu cầu đến server: tên -> (tham số, type của gói tin)
+REQUESTS = {
+    "register": (("alice", "secret1"), "register"),
+    "login": (("alice", "secret1"), "login"),
+    "send_group_message": ((1, "xin chào"), "send_message"),
+    "send_private_message": (("bob", "xin chào"), "send_private_message"),
+    "cancel_upload": (("upload-1",), "cancel_upload"),
+    "get_attachment": ((1,), "get_attachment"),
+    "get_avatar": ((1,), "get_avatar"),
+    "get_contacts": ((), "get_contacts"),
+    "get_conversations": ((), "get_conversations"),
+    "get_messages": (("bob",), "get_messages"),
+    "sync": (({"group:1": 10},), "sync"),
+    "mark_messages_read": (("bob",), "mark_read"),
+    "start_typing": (("bob",), "typing_start"),
+    "stop_typing": (("bob",), "typing_stop"),
+    "update_status": (("busy",), "update_status"),
+    "search_messages": (("xin chào",), "search_messages"),
+    "delete_message": ((1,), "delete_message"),
+    "clear_chat": (("bob",), "clear_chat"),
+    "pin_conversation": (("bob",), "pin_conversation"),
+    "upload_avatar": ((b"\x89PNG",), "upload_avatar"),
+    "create_group": (("Nhóm", [2, 3]), "create_group"),
+    "get_group_members": ((1,), "get_group_members"),
+    "add_group_member": ((1, 2), "add_group_member"),
+    "remove_group_member": ((1, 2), "remove_group_member"),
+}
+# Phương thức public không phải yêu cầu đơn giản (kết nối, trạng thái, file trên đĩa)
+OTHER_METHODS = {"connect_to_server", "disconnect", "send_message", "is_connected", "is_logged_in",
+                 "upload_file", "download_file"}
+
+
+@pytest.fixture
+def client():
+    local, remote = socket.socketpair()
+    remote.settimeout(5)
+    client = SocketClient()
+    client.socket = local
+    client.connected_flag = True
+    client.session_token = "token"
+    yield client, remote
+    local.close()
+    remote.close()
+
+
+def _receive(remote):
+    decoder = FrameDecoder()
+    while True:
+        frames = decoder.feed(remote.recv(65536))
+        if frames:
+            return decode_json(frames[0].payload)
+
+
+def test_every_public_method_is_covered():
+    public = {name for name, _ in inspect.getmembers(SocketClient, inspect.isfunction)
+              if not name.startswith("_") and name in vars(SocketClient)}
+    assert public == set(REQUESTS) | OTHER_METHODS
+
+
+@pytest.mark.parametrize("name", sorted(REQUESTS))
+def test_request_method_sends_packet(client, name):
+    client, remote = client
+    args, packet_type = REQUESTS[name]
+    assert getattr(client, name)(*args) is True
+    packet = _receive(remote)
+    assert packet["type"] == packet_type
+    if name not in ("register", "login"):
+        assert packet["session_token"] == "token"
+
+
+def test_upload_file_sends_begin_upload(client, tmp_path):
+    client, remote = client
+    path = tmp_path / "report.txt"
+    path.write_bytes(b"noi dung")
+    assert client.upload_file(str(path), receiver="bob") is True
+    packet = _receive(remote)
+    assert (packet["type"], packet["file_name"], packet["file_size"]) == ("begin_upload", "report.txt", 8)
+
+
+def test_download_file_requests_from_offset(client, tmp_path):
+    client, remote = client
+    save_path = tmp_path / "report.txt"
+    (tmp_path / "report.txt.part").write_bytes(b"noi")
+    assert client.download_file(7, str(save_path)) is True
+    packet = _receive(remote)
+    assert (packet["type"], packet["message_id"], packet["offset"]) == ("download_file", 7, 3)
+    for info in client.pending_downloads.values():
+        info["file"].close()
+
+
+def test_download_window_requests_next_range(client, tmp_path):
+    client, remote = client
+    save_path = tmp_path / "report.txt"
+    assert client.download_file(7, str(save_path)) is True
+    download_id = _receive(remote)["download_id"]
+    client.pending_downloads[download_id]["file"].write(b"noi dung")
+    client._handle_download_message({"type": "download_window", "success": True,
+                                     "download_id": download_id, "message_id": 7, "next_offset": 8})
+    packet = _receive(remote)
+    assert (packet["type"], packet["download_id"], packet["offset"]) == ("download_file", download_id, 8)
+    client.pending_downloads[download_id]["file"].close()